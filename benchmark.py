@@ -0,0 +1,187 @@
+# benchmark.py
+"""
+Микробенчмарки бота.
+
+    python benchmark.py db [--iterations N]
+    python benchmark.py render [--iterations N]
+    python benchmark.py load [параметры нагрузки, см. --help]
+
+db — сравнивает задержку одного запроса к SQLite:
+старый подход (aiosqlite.connect на каждый вызов) против пула database.engine
+(и, отдельно, с кэшем партнеров поверх пула).
+render — время и память на подготовку ответа одного апдейта (текст + клавиатура):
+прежний код (клавиатуры создаются на каждый вызов, текст — f-строками) против
+keyboards.py / templates.py. Отдельно — вместе с сериализацией запроса в aiogram.
+load — нагрузочный тест всего бота с заглушками Telegram и Битрикс (см. loadtest.py).
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+import tracemalloc
+from html import escape
+
+import aiosqlite
+from aiogram.methods import SendMessage
+from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
+
+import database as db
+import keyboards as kb
+import loadtest
+import templates as tpl
+
+
+def _report(title: str, samples: list):
+    samples = sorted(samples)
+    p50 = samples[len(samples) // 2]
+    p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+    print(f"{title:<28} mean={statistics.mean(samples) * 1e6:8.1f} µs  "
+          f"p50={p50 * 1e6:8.1f} µs  p99={p99 * 1e6:8.1f} µs")
+
+
+async def _old_get_partner_status(path: str, user_id: int):
+    """Копия прежней реализации: новое соединение (и поток) на каждый вызов."""
+    async with aiosqlite.connect(path) as conn:
+        async with conn.execute("SELECT status FROM partners WHERE user_id = ?", (user_id,)) as cursor:
+            row = await cursor.fetchone()
+            return row[0] if row else None
+
+
+async def _pooled_get_partner_status(user_id: int):
+    """Тот же запрос через пул database.engine, без кэша партнеров."""
+    async with db.engine.read() as conn:
+        async with conn.execute("SELECT status FROM partners WHERE user_id = ?", (user_id,)) as cursor:
+            row = await cursor.fetchone()
+            return row[0] if row else None
+
+
+async def bench_db(iterations: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        db.engine.path = os.path.join(tmp, "bench.db")
+        await db.init_db()
+        for uid in range(1000):
+            await db.add_partner(uid, f"Partner {uid}", "+70000000000", uid, "Риэлтор")
+
+        samples = []
+        for i in range(iterations):
+            t0 = time.perf_counter()
+            await _old_get_partner_status(db.engine.path, i % 1000)
+            samples.append(time.perf_counter() - t0)
+        _report("per-call connect", samples)
+
+        samples = []
+        for i in range(iterations):
+            t0 = time.perf_counter()
+            await _pooled_get_partner_status(i % 1000)
+            samples.append(time.perf_counter() - t0)
+        _report("pooled engine", samples)
+
+        # Для сравнения: db.get_partner_status отвечает из partner_cache
+        samples = []
+        for i in range(iterations):
+            t0 = time.perf_counter()
+            await db.get_partner_status(i % 1000)
+            samples.append(time.perf_counter() - t0)
+        _report("pooled engine + cache", samples)
+
+        await db.close_db()
+
+
+# Страница «Мои клиенты»: (client_id, name, status, address)
+_RENDER_CLIENTS = [(100 - i, f"Клиент <{i}>", "Клиенты в обработке", f"ул. Ленина, {i}" if i % 2 else None)
+                   for i in range(kb.CLIENTS_PER_PAGE)]
+
+
+def _old_verified_partner_menu():
+    """Копия прежней реализации keyboards.get_verified_partner_menu."""
+    keyboard = [
+        [KeyboardButton(text="🚀 Отправить клиента")],
+        [KeyboardButton(text="📊 Мои клиенты"), KeyboardButton(text="📈 Статистика")],
+        [KeyboardButton(text="ℹ️ Инфо Программа")]
+    ]
+    return ReplyKeyboardMarkup(keyboard=keyboard, resize_keyboard=True)
+
+
+def _old_pagination_keyboard(current_offset: int, total_clients: int, first_client_id: int, last_client_id: int):
+    """Прежнее поведение keyboards.get_clients_pagination_keyboard: новая клавиатура на каждый вызов."""
+    return kb.get_clients_pagination_keyboard.__wrapped__(current_offset, total_clients,
+                                                          first_client_id, last_client_id)
+
+
+def _old_update(offset: int, total: int):
+    """Прежний код: «Мои клиенты» + уведомление о стадии + главное меню."""
+    text = f"<b>Ваши клиенты ({offset + 1}-{min(offset + len(_RENDER_CLIENTS), total)} из {total}):</b>\n\n"
+    for i, (_, name, status, addr) in enumerate(_RENDER_CLIENTS, start=offset + 1):
+        a_info = f" ({addr})" if addr else ""
+        text += f"{i}. <b>{escape(name)}</b>{escape(a_info)}\n   Статус: <i>{escape(status)}</i>\n"
+    pages = _old_pagination_keyboard(offset, total, _RENDER_CLIENTS[0][0], _RENDER_CLIENTS[-1][0])
+    notice = f"✅ С клиентом <b>{escape(_RENDER_CLIENTS[0][1])}</b> заключен договор! Ваша выплата: {12345.6:,.0f} руб."
+    return [(text, pages), (notice, _old_verified_partner_menu())]
+
+
+def _new_update(offset: int, total: int):
+    """То же через templates.py и keyboards.py."""
+    lines = [tpl.CLIENTS_PAGE_HEADER.render(first=offset + 1, last=min(offset + len(_RENDER_CLIENTS), total),
+                                            total=total)]
+    for i, (_, name, status, addr) in enumerate(_RENDER_CLIENTS, start=offset + 1):
+        lines.append(tpl.CLIENTS_PAGE_LINE.render(number=i, name=name, address=f" ({addr})" if addr else "",
+                                                  status=status))
+    pages = kb.get_clients_pagination_keyboard(offset, total, _RENDER_CLIENTS[0][0], _RENDER_CLIENTS[-1][0])
+    notice = tpl.DEAL_WIN.render(name=_RENDER_CLIENTS[0][1], payout=12345.6)
+    return [("".join(lines), pages), (notice, kb.get_verified_partner_menu())]
+
+
+def _serialize(replies):
+    """Что делает aiogram перед отправкой: модель запроса -> dict."""
+    return [SendMessage(chat_id=1, text=text, reply_markup=markup).model_dump(warnings=False)
+            for text, markup in replies]
+
+
+def bench_render(iterations: int):
+    cases = [
+        ("old: text + keyboards", lambda i: _old_update(i % 4 * 5, 20)),
+        ("new: text + keyboards", lambda i: _new_update(i % 4 * 5, 20)),
+        ("old: + aiogram request", lambda i: _serialize(_old_update(i % 4 * 5, 20))),
+        ("new: + aiogram request", lambda i: _serialize(_new_update(i % 4 * 5, 20))),
+    ]
+    for title, update in cases:
+        for i in range(100):  # Прогрев: заполняем lru_cache и ленивую сборку моделей pydantic
+            update(i)
+        samples = []
+        for i in range(iterations):
+            t0 = time.perf_counter()
+            update(i)
+            samples.append(time.perf_counter() - t0)
+        _report(title, samples)
+
+        # Память отдельно: tracemalloc заметно замедляет сам код
+        tracemalloc.start()
+        peaks = []
+        for i in range(min(iterations, 500)):
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            update(i)
+            peaks.append(tracemalloc.get_traced_memory()[1] - base)
+        tracemalloc.stop()
+        print(f"{'':<28} alloc peak/update={statistics.mean(peaks) / 1024:6.1f} KiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Микробенчмарки бота")
+    parser.add_argument("suite", choices=["db", "render", "load"])
+    parser.add_argument("--iterations", type=int, default=2000)
+    loadtest.add_arguments(parser)
+    args = parser.parse_args()
+
+    if args.suite == "db":
+        asyncio.run(bench_db(args.iterations))
+    elif args.suite == "render":
+        bench_render(args.iterations)
+    elif args.suite == "load":
+        loadtest.run(args)
+
+
+if __name__ == "__main__":
+    main()
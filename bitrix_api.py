@@ -1,12 +1,319 @@
 # bitrix_api.py
+import asyncio
+import itertools
+import logging
+import random
+import re
+import time
+from urllib.parse import urlencode
+
 import aiohttp
 import traceback
 from config import (
     BITRIX_PARTNER_WEBHOOK, BITRIX_CLIENT_WEBHOOK,
     PARTNER_FUNNEL_ID, PARTNER_DEAL_TG_ID_FIELD, PARTNER_DEAL_TG_USERNAME_FIELD,
     BITRIX_CLIENT_FUNNEL_ID, PARTNER_DEAL_FIELD,
-    PARTNER_ROLE_FIELD, CLIENT_AREA_FIELD, CLIENT_ADDRESS_DEAL_FIELD,BITRIX_CLIENT_STAGE_1
+    PARTNER_ROLE_FIELD, CLIENT_AREA_FIELD, CLIENT_ADDRESS_DEAL_FIELD,BITRIX_CLIENT_STAGE_1,
+    BITRIX_POOL_LIMIT, BITRIX_POOL_LIMIT_PER_HOST, BITRIX_DNS_CACHE_TTL,
+    BITRIX_KEEPALIVE_TIMEOUT, BITRIX_REQUEST_TIMEOUT, BITRIX_BATCH_WINDOW,
+    BITRIX_RATE, BITRIX_BURST, BITRIX_MAX_RETRIES, BITRIX_RETRY_BASE_DELAY, BITRIX_RETRY_MAX_DELAY
 )
+import metrics
+from ratelimit import PriorityBucket
+
+# Битрикс принимает не больше 50 команд в одном batch-запросе
+BITRIX_BATCH_LIMIT = 50
+
+# Приоритеты запросов: пока ждут ответа пользователи, фоновые задачи стоят в очереди
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+
+
+def _flatten_params(params, prefix: str = None):
+    """Раскладывает вложенные параметры в пары для query-строки: fields[PHONE][0][VALUE]=..."""
+    if isinstance(params, dict):
+        items = params.items()
+    elif isinstance(params, (list, tuple)):
+        items = enumerate(params)
+    else:
+        if params is None:
+            return []
+        if isinstance(params, bool):
+            params = 'Y' if params else 'N'
+        return [(prefix, str(params))]
+
+    pairs = []
+    for key, value in items:
+        name = f"{prefix}[{key}]" if prefix else str(key)
+        pairs.extend(_flatten_params(value, name))
+    return pairs
+
+
+def _rename_refs(params, renames: dict):
+    """Заменяет ссылки $result[имя] на новые имена команд (при объединении групп в один batch)."""
+    if isinstance(params, dict):
+        return {key: _rename_refs(value, renames) for key, value in params.items()}
+    if isinstance(params, list):
+        return [_rename_refs(value, renames) for value in params]
+    if isinstance(params, str) and '$result[' in params:
+        return re.sub(r'\$result\[([^\]]+)\]',
+                      lambda m: f"$result[{renames.get(m.group(1), m.group(1))}]", params)
+    return params
+
+
+def _has_refs(params) -> bool:
+    """Есть ли в параметрах ссылки $result[...] на другие команды."""
+    if isinstance(params, dict):
+        return any(_has_refs(value) for value in params.values())
+    if isinstance(params, list):
+        return any(_has_refs(value) for value in params)
+    return isinstance(params, str) and '$result[' in params
+
+
+class _BatchCollector:
+    """
+    Собирает команды от одновременных вызовов в общий batch-запрос к одному вебхуку.
+    Общий batch идет с halt=0, чтобы ошибка одной группы не срывала чужие. Поэтому группы
+    со ссылками $result[...] (контакт + сделка на этот контакт) не объединяются с другими:
+    они уходят отдельным batch с halt=1 — если первая команда не выполнилась, следующие
+    тоже не выполняются (иначе сделка создалась бы с пустой ссылкой на контакт).
+    """
+
+    def __init__(self, client: 'BitrixClient', webhook: str, window: float):
+        self.client = client
+        self.webhook = webhook
+        self.window = window
+        self._pending = []  # [(names, {ключ_в_batch: (method, params)}, future, priority)]
+        self._size = 0
+        self._timer = None
+        self._ids = itertools.count(1)
+        self._tasks = set()  # Выполняющиеся batch-запросы
+
+    async def submit(self, commands: dict, priority: int = PRIORITY_INTERACTIVE) -> dict:
+        if self._size + len(commands) > BITRIX_BATCH_LIMIT:
+            self.flush()
+
+        group_id = next(self._ids)
+        renames = {name: f"g{group_id}_{name}" for name in commands}
+        renamed = {renames[name]: (method, _rename_refs(params, renames))
+                   for name, (method, params) in commands.items()}
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((renames, renamed, future, priority))
+        self._size += len(commands)
+
+        if self._size >= BITRIX_BATCH_LIMIT:
+            self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.window, self.flush)
+        return await future
+
+    async def submit_dependent(self, commands: dict, priority: int = PRIORITY_INTERACTIVE) -> dict:
+        """Группа со ссылками $result[...] — отдельным batch с halt=1."""
+        future = asyncio.get_running_loop().create_future()
+        pending = [({name: name for name in commands}, dict(commands), future, priority)]
+        task = asyncio.create_task(self._execute(pending, halt=1))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return await future
+
+    def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        pending, self._pending, self._size = self._pending, [], 0
+        task = asyncio.create_task(self._execute(pending))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def drain(self):
+        """Отправляет накопленные команды и ждет ответов на все начатые batch-запросы."""
+        self.flush()
+        while self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _execute(self, pending: list, halt: int = 0):
+        # Запрос идет с приоритетом самого срочного из попутчиков
+        priority = min(p for *_, p in pending)
+        try:
+            if len(pending) == 1 and len(pending[0][0]) == 1:
+                # Одна команда — batch не нужен
+                renames, renamed, future, _ = pending[0]
+                (method, params), = renamed.values()
+                name, = renames
+                result = await self.client.call(self.webhook, method, params, priority)
+                if not future.done():
+                    future.set_result({name: result})
+                return
+
+            cmd = {}
+            for _, renamed, _, _ in pending:
+                for key, (method, params) in renamed.items():
+                    cmd[key] = f"{method}?{urlencode(_flatten_params(params))}"
+            data = await self.client.call(self.webhook, "batch", {'halt': halt, 'cmd': cmd}, priority)
+
+            if 'result' not in data:
+                # Ошибка всего запроса (например, QUERY_LIMIT_EXCEEDED) — она же для каждой команды
+                error = {k: v for k, v in data.items() if k.startswith('error')}
+                for renames, _, future, _ in pending:
+                    if not future.done():
+                        future.set_result({name: error for name in renames})
+                return
+
+            # Пустые словари PHP отдает как []
+            results = data['result'].get('result') or {}
+            errors = data['result'].get('result_error') or {}
+            for renames, _, future, _ in pending:
+                group = {}
+                for name, key in renames.items():
+                    if key in results and key not in errors:
+                        group[name] = {'result': results[key]}
+                    else:
+                        group[name] = errors.get(key) or {'error': 'BATCH_NO_RESULT'}
+                if not future.done():
+                    future.set_result(group)
+        except Exception as e:
+            for _, _, future, _ in pending:
+                if not future.done():
+                    future.set_exception(e)
+
+
+class BitrixClient:
+    """
+    Долгоживущий клиент Битрикс24.
+    Держит одну aiohttp-сессию с пулом keep-alive соединений и кэшем DNS,
+    чтобы не делать TCP+TLS рукопожатие на каждый запрос.
+    Все запросы (к обоим вебхукам) проходят через общее ведро с приоритетами,
+    а ответы QUERY_LIMIT_EXCEEDED и 5xx повторяются с паузой.
+    """
+
+    def __init__(self, limit: int = BITRIX_POOL_LIMIT, limit_per_host: int = BITRIX_POOL_LIMIT_PER_HOST,
+                 dns_cache_ttl: int = BITRIX_DNS_CACHE_TTL, keepalive_timeout: float = BITRIX_KEEPALIVE_TIMEOUT,
+                 request_timeout: float = BITRIX_REQUEST_TIMEOUT, rate: float = BITRIX_RATE,
+                 burst: int = BITRIX_BURST, max_retries: int = BITRIX_MAX_RETRIES,
+                 retry_base_delay: float = BITRIX_RETRY_BASE_DELAY,
+                 retry_max_delay: float = BITRIX_RETRY_MAX_DELAY):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.dns_cache_ttl = dns_cache_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self.request_timeout = request_timeout
+        self.batch_window = BITRIX_BATCH_WINDOW
+        self.bucket = PriorityBucket(rate, burst)
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.retries = 0
+        self.throttled = 0
+        self._session = None
+        self._closed = False  # Закрыт явно через close(): новых сессий сам не открывает
+        self._collectors = {}
+
+    async def start(self):
+        """Открывает сессию (вызывается в on_startup)."""
+        self._closed = False
+        if self._session is not None and not self._session.closed:
+            return
+        connector = aiohttp.TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            ttl_dns_cache=self.dns_cache_ttl,
+            keepalive_timeout=self.keepalive_timeout,
+        )
+        self._session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=self.request_timeout),
+        )
+
+    async def close(self):
+        """Дожидается начатых запросов, закрывает сессию и все соединения пула (вызывается в on_shutdown)."""
+        for collector in list(self._collectors.values()):
+            await collector.drain()
+        self._closed = True
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    def stats(self) -> dict:
+        """Очередь к Битрикс: глубина, ожидание токена и число повторов."""
+        return {**self.bucket.stats(), "retries": self.retries, "throttled": self.throttled}
+
+    def _retry_delay(self, attempt: int) -> float:
+        delay = min(self.retry_max_delay, self.retry_base_delay * 2 ** (attempt - 1))
+        return delay * random.uniform(0.5, 1.0)
+
+    async def _post(self, webhook: str, method: str, params: dict):
+        started = time.perf_counter()
+        try:
+            async with self._session.post(webhook + method + ".json", json=params or {}) as response:
+                try:
+                    return response.status, await response.json(content_type=None)
+                except ValueError:
+                    # 5xx от балансировщика приходит HTML-страницей
+                    return response.status, {'error': f'HTTP_{response.status}'}
+        except Exception:
+            metrics.BITRIX_ERRORS.inc(method)
+            raise
+        finally:
+            metrics.BITRIX_SECONDS.observe(time.perf_counter() - started, method)
+
+    async def call(self, webhook: str, method: str, params: dict = None,
+                   priority: int = PRIORITY_INTERACTIVE) -> dict:
+        """Вызывает REST-метод (например, 'crm.deal.get') и возвращает разобранный JSON."""
+        if self._session is None or self._session.closed:
+            if self._closed:
+                raise RuntimeError("Клиент Битрикс закрыт")
+            # Страховка для вызовов вне веб-сервера (скрипты, консоль)
+            await self.start()
+        attempt = 0
+        while True:
+            attempt += 1
+            metrics.BITRIX_WAIT_SECONDS.observe(await self.bucket.acquire(priority))
+            status, data = await self._post(webhook, method, params)
+            limited = isinstance(data, dict) and data.get('error') == 'QUERY_LIMIT_EXCEEDED'
+            if not (limited or status >= 500) or attempt > self.max_retries:
+                if isinstance(data, dict) and 'error' in data:
+                    metrics.BITRIX_ERRORS.inc(method)
+                return data
+
+            delay = self._retry_delay(attempt)
+            self.retries += 1
+            metrics.BITRIX_RETRIES.inc(method, 'rate_limit' if limited else 'server_error')
+            if limited:
+                # Портал уже перегружен — притормаживаем всю очередь, а не только этот запрос
+                self.throttled += 1
+                self.bucket.pause(delay)
+            logging.warning(f"Bitrix {method}: {data.get('error') if isinstance(data, dict) else status}, "
+                            f"retry {attempt} in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+    async def batch(self, webhook: str, commands: dict, priority: int = PRIORITY_INTERACTIVE) -> dict:
+        """
+        Выполняет группу команд одним batch-запросом.
+        commands: {'имя': ('crm.deal.add', params), ...}; в params можно ссылаться
+        на результат предыдущей команды строкой '$result[имя]'.
+        Возвращает {'имя': ответ как у call(): {'result': ...} или {'error': ...}}.
+        Команды одновременных вызовов объединяются в общие batch-запросы (до 50 команд);
+        группа со ссылками выполняется отдельно и до первой ошибки (остальные команды — BATCH_NO_RESULT).
+        """
+        if len(commands) > BITRIX_BATCH_LIMIT:
+            raise ValueError(f"В одном batch не больше {BITRIX_BATCH_LIMIT} команд")
+        collector = self._collectors.get(webhook)
+        if collector is None:
+            collector = self._collectors[webhook] = _BatchCollector(self, webhook, self.batch_window)
+        if any(_has_refs(params) for _, params in commands.values()):
+            return await collector.submit_dependent(commands, priority)
+        return await collector.submit(commands, priority)
+
+    async def call_batched(self, webhook: str, method: str, params: dict = None,
+                           priority: int = PRIORITY_INTERACTIVE) -> dict:
+        """То же, что call(), но запрос может уйти в общем batch с соседними вызовами."""
+        return (await self.batch(webhook, {'cmd': (method, params or {})}, priority))['cmd']
+
+
+# Общий клиент для всех функций модуля
+client = BitrixClient()
 
 
 async def check_contact_exists_by_phone(phone: str):
@@ -14,7 +321,6 @@ async def check_contact_exists_by_phone(phone: str):
     Проверяет, есть ли контакт с таким телефоном в базе CRM.
     Возвращает ID контакта или None.
     """
-    url = BITRIX_CLIENT_WEBHOOK + "crm.contact.list.json"
     # Ищем контакт, у которого телефон совпадает
     params = {
         'filter': {'PHONE': phone},
@@ -22,24 +328,69 @@ async def check_contact_exists_by_phone(phone: str):
     }
 
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, json=params) as response:
-                result = await response.json()
-                if 'result' in result and len(result['result']) > 0:
-                    # Контакт найден
-                    contact = result['result'][0]
-                    return contact['ID']
-                return None
+        result = await client.call_batched(BITRIX_CLIENT_WEBHOOK, "crm.contact.list", params)
+        if 'result' in result and len(result['result']) > 0:
+            # Контакт найден
+            contact = result['result'][0]
+            return contact['ID']
+        return None
+    except Exception as e:
+        logging.exception(f"Error checking contact: {e}")
+        return None
+
+
+async def list_contacts_modified_since(date_modify: str = None, start: int = 0):
+    """
+    Порция контактов (ID, PHONE, DATE_MODIFY), измененных не раньше date_modify, по возрастанию даты.
+    Возвращает (список контактов, start следующей порции или None) либо None при ошибке.
+    """
+    params = {
+        'order': {'DATE_MODIFY': 'ASC', 'ID': 'ASC'},
+        'select': ['ID', 'PHONE', 'DATE_MODIFY'],
+        'start': start,
+    }
+    if date_modify:
+        params['filter'] = {'>=DATE_MODIFY': date_modify}
+
+    try:
+        result = await client.call(BITRIX_CLIENT_WEBHOOK, "crm.contact.list", params, PRIORITY_BACKGROUND)
+        if 'result' not in result:
+            logging.error(f"Error listing contacts: {result.get('error_description') or result.get('error')}")
+            return None
+        return result['result'], result.get('next')
     except Exception as e:
-        print(f"Error checking contact: {e}")
+        logging.error(f"Error listing contacts: {e}")
+        return None
+
+
+async def list_client_deals_modified_since(date_modify: str = None, start: int = 0):
+    """
+    Порция сделок воронки клиентов (ID, STAGE_ID, OPPORTUNITY, DATE_MODIFY),
+    измененных не раньше date_modify, по возрастанию даты.
+    Возвращает (список сделок, start следующей порции или None) либо None при ошибке.
+    """
+    params = {
+        'filter': {'CATEGORY_ID': BITRIX_CLIENT_FUNNEL_ID},
+        'order': {'DATE_MODIFY': 'ASC', 'ID': 'ASC'},
+        'select': ['ID', 'STAGE_ID', 'OPPORTUNITY', 'DATE_MODIFY'],
+        'start': start,
+    }
+    if date_modify:
+        params['filter']['>=DATE_MODIFY'] = date_modify
+
+    try:
+        result = await client.call(BITRIX_CLIENT_WEBHOOK, "crm.deal.list", params, PRIORITY_BACKGROUND)
+        if 'result' not in result:
+            logging.error(f"Error listing deals: {result.get('error_description') or result.get('error')}")
+            return None
+        return result['result'], result.get('next')
+    except Exception as e:
+        logging.error(f"Error listing deals: {e}")
         return None
 
 
 async def create_partner_deal(full_name: str, phone: str, user_id: int, username: str = None, role: str = None):
     """Создает сделку партнера (верификация)."""
-    url_deal_add = BITRIX_PARTNER_WEBHOOK + "crm.deal.add.json"
-    url_contact_add = BITRIX_PARTNER_WEBHOOK + "crm.contact.add.json"
-
     deal_title = f"Новый партнер (бот): {full_name}"
     deal_fields = {
         'TITLE': deal_title,
@@ -63,28 +414,23 @@ async def create_partner_deal(full_name: str, phone: str, user_id: int, username
     }
 
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url_contact_add, json=contact_params) as contact_response:
-                contact_id = (await contact_response.json()).get('result')
-
-            if contact_id:
-                deal_fields['CONTACT_ID'] = contact_id
-
-            async with session.post(url_deal_add, json={'fields': deal_fields}) as deal_response:
-                deal_id = (await deal_response.json()).get('result')
-                return deal_id
+        # Контакт и сделка — одним запросом, сделка ссылается на ID созданного контакта
+        deal_fields['CONTACT_ID'] = '$result[contact]'
+        result = await client.batch(BITRIX_PARTNER_WEBHOOK, {
+            'contact': ('crm.contact.add', contact_params),
+            'deal': ('crm.deal.add', {'fields': deal_fields}),
+        }, PRIORITY_BACKGROUND)
+        deal_id = result['deal'].get('result')
+        return deal_id
 
     except Exception as e:
-        print(f"Error creating partner deal: {e}")
+        logging.exception(f"Error creating partner deal: {e}")
         return None
 
 
 async def create_client_deal(client_name: str, client_phone: str, client_address: str, partner_name: str,
                              client_comment: str = None, client_area: str = None):
     """Создает сделку клиента (лид от партнера)."""
-    url_deal_add = BITRIX_CLIENT_WEBHOOK + "crm.deal.add.json"
-    url_contact_add = BITRIX_CLIENT_WEBHOOK + "crm.contact.add.json"
-
     deal_title = f"Заявка от партнера {partner_name} (Клиент: {client_name})"
 
     deal_fields = {
@@ -117,19 +463,17 @@ async def create_client_deal(client_name: str, client_phone: str, client_address
     }
 
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url_contact_add, json=contact_params) as contact_response:
-                contact_id = (await contact_response.json()).get('result')
-
-            if contact_id:
-                deal_fields['CONTACT_ID'] = contact_id
-
-            async with session.post(url_deal_add, json={'fields': deal_fields}) as deal_response:
-                deal_id = (await deal_response.json()).get('result')
-                return deal_id
+        # Контакт и сделка — одним запросом, сделка ссылается на ID созданного контакта
+        deal_fields['CONTACT_ID'] = '$result[contact]'
+        result = await client.batch(BITRIX_CLIENT_WEBHOOK, {
+            'contact': ('crm.contact.add', contact_params),
+            'deal': ('crm.deal.add', {'fields': deal_fields}),
+        }, PRIORITY_BACKGROUND)
+        deal_id = result['deal'].get('result')
+        return deal_id
 
     except Exception as e:
-        print(f"Error creating client deal: {e}")
+        logging.exception(f"Error creating client deal: {e}")
         return None
 
 
@@ -138,8 +482,6 @@ async def create_duplicate_alert_deal(client_name: str, client_phone: str, partn
     Создает сделку в ВОРОНКЕ ПАРТНЕРОВ для менеджера,
     если найден дубль клиента.
     """
-    url_deal_add = BITRIX_PARTNER_WEBHOOK + "crm.deal.add.json"
-
     deal_title = f"ДУБЛЬ КЛИЕНТА от {partner_name}"
     description = (
         f"Партнер {partner_name} пытался передать клиента, который уже есть в базе.\n"
@@ -157,36 +499,30 @@ async def create_duplicate_alert_deal(client_name: str, client_phone: str, partn
     }
 
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url_deal_add, json={'fields': deal_fields}) as response:
-                return (await response.json()).get('result')
+        result = await client.call_batched(BITRIX_PARTNER_WEBHOOK, "crm.deal.add", {'fields': deal_fields})
+        return result.get('result')
     except Exception as e:
-        print(f"Error creating duplicate alert: {e}")
+        logging.exception(f"Error creating duplicate alert: {e}")
         return None
 
 
-async def get_deal(deal_id: int):
+async def get_deal(deal_id: int, priority: int = PRIORITY_INTERACTIVE):
     """Получает данные о сделке (чтобы узнать актуальную сумму)."""
-    url = BITRIX_CLIENT_WEBHOOK + "crm.deal.get.json"
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, json={'id': deal_id}) as response:
-                data = await response.json()
-                if 'result' in data:
-                    return data['result']
-                return None
+        data = await client.call_batched(BITRIX_CLIENT_WEBHOOK, "crm.deal.get", {'id': deal_id}, priority)
+        if 'result' in data:
+            return data['result']
+        return None
     except Exception as e:
-        print(f"Error getting deal: {e}")
+        logging.exception(f"Error getting deal: {e}")
         return None
 
 
-async def move_deal_stage(deal_id: int, stage_id: str):
+async def move_deal_stage(deal_id: int, stage_id: str, priority: int = PRIORITY_INTERACTIVE):
     # (Оставляем как было)
-    url_deal_update = BITRIX_PARTNER_WEBHOOK + "crm.deal.update.json"
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url_deal_update,
-                                    json={'id': deal_id, 'fields': {'STAGE_ID': stage_id}}) as response:
-                return 'result' in (await response.json())
+        result = await client.call_batched(BITRIX_PARTNER_WEBHOOK, "crm.deal.update",
+                                   {'id': deal_id, 'fields': {'STAGE_ID': stage_id}}, priority)
+        return 'result' in result
     except Exception:
         return False
\ No newline at end of file
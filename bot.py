@@ -1,29 +1,82 @@
 # bot.py
-import re
+import asyncio
+import os
+import random
+import socket
+import time
+from datetime import datetime
 import logging
 from aiohttp import web
-from aiogram import Bot, Dispatcher, F
+from aiogram import Bot, Dispatcher, F, BaseMiddleware
 from aiogram.filters import CommandStart, Command, Filter
 from aiogram.fsm.context import FSMContext
 from aiogram.types import Message, CallbackQuery, ReplyKeyboardRemove
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramForbiddenError
 from html import escape
 import math
 
 # Импортируем модули проекта
 import config
+import metrics
 import database as db
 import bitrix_api
 from states import PartnerRegistration, ClientSubmission
 import keyboards as kb
+import templates as tpl
+from broadcast import Broadcaster
+from notifier import Notifier
+from jobs import JobQueue
+from update_queue import UpdateQueue, update_chat_key
+from inbox import WebhookInbox
+from phone_index import PhoneIndex, normalize_phone
+from deal_sync import DealSync
+from fsm_storage import create_storage
 
 # --- Настройка логирования ---
 logging.basicConfig(level=logging.INFO)
 
 # --- Инициализация ---
 bot = Bot(token=config.BOT_TOKEN, default=DefaultBotProperties(parse_mode="HTML"))
-dp = Dispatcher()
+dp = Dispatcher(storage=create_storage(config.FSM_STORAGE))
 app = web.Application()
+broadcaster = Broadcaster(bot)
+notifier = Notifier(bot)
+job_queue = JobQueue()
+phone_index = PhoneIndex()
+
+
+# Имя этой реплики в блокировках чатов
+REPLICA_ID = f"{socket.gethostname()}:{os.getpid()}"
+# Пауза между попытками занять чат, который обрабатывает другая реплика: от и до, секунд
+CHAT_LEASE_MIN_DELAY = 0.05
+CHAT_LEASE_MAX_DELAY = 1.0
+
+
+async def process_telegram_update(data: dict):
+    chat_key = update_chat_key(data)
+    if config.REPLICAS == 1 or isinstance(chat_key, tuple):
+        await dp.feed_webhook_update(bot, data)
+        return
+    # UpdateQueue держит порядок апдейтов чата только внутри процесса. Между репликами чат
+    # занимается в БД, чтобы две реплики не меняли состояние FSM одного чата одновременно.
+    # Это взаимное исключение, а не порядок: апдейты одного чата, пришедшие на разные
+    # реплики почти одновременно, могут обработаться в любом порядке.
+    # Внутри процесса чат уже занят одним воркером UpdateQueue, поэтому ждут только апдейты,
+    # попавшие на разные реплики; попытки редеют, чтобы не занимать писателя SQLite
+    chat_key = str(chat_key)
+    delay = CHAT_LEASE_MIN_DELAY
+    while not await db.acquire_chat_lease(chat_key, REPLICA_ID, config.CHAT_LEASE_TTL):
+        await asyncio.sleep(delay * random.uniform(0.5, 1.0))
+        delay = min(CHAT_LEASE_MAX_DELAY, delay * 2)
+    try:
+        await dp.feed_webhook_update(bot, data)
+    finally:
+        await db.release_chat_lease(chat_key, REPLICA_ID)
+
+
+update_queue = UpdateQueue(process_telegram_update, config.UPDATE_WORKERS, config.UPDATE_QUEUE_MAX)
 
 # =================================================================
 # === СПИСОК СТАДИЙ ДЛЯ УВЕДОМЛЕНИЙ ===============================
@@ -61,26 +114,117 @@ class IsSeniorAdminFilter(Filter):
         return role == 'senior'
 
 
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Время и ошибки каждого обработчика — в метрики (/metrics)."""
+
+    async def __call__(self, handler, event, data):
+        name = data['handler'].callback.__name__
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            metrics.HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            metrics.HANDLER_SECONDS.observe(time.perf_counter() - started, name)
+
+
+dp.message.middleware(HandlerMetricsMiddleware())
+dp.callback_query.middleware(HandlerMetricsMiddleware())
+
+
+class ReachabilityMiddleware(BaseRequestMiddleware):
+    """
+    Запоминает пользователей, заблокировавших бота (любой запрос к Telegram вернул 403),
+    чтобы рассылки и уведомления больше не тратили на них запросы. Отметку снимает /start.
+    """
+
+    async def __call__(self, make_request, bot, method):
+        try:
+            return await make_request(bot, method)
+        except TelegramForbiddenError as e:
+            chat_id = getattr(method, 'chat_id', None)
+            if isinstance(chat_id, int) and chat_id > 0:
+                await db.mark_chat_unreachable(chat_id, str(e)[:200])
+            raise
+
+
+bot.session.middleware(ReachabilityMiddleware())
+
+
+async def count_fsm_sessions() -> int:
+    """Пользователи, которые сейчас находятся внутри сценария (FSM)."""
+    if hasattr(dp.storage, 'count_active'):
+        return await dp.storage.count_active()
+    records = getattr(dp.storage, 'storage', {})  # MemoryStorage
+    return sum(1 for record in records.values() if record.state)
+
+
+metrics.Gauge("bot_update_queue_depth", "Апдейтов Telegram в очереди", lambda: len(update_queue))
+metrics.Gauge("bot_update_queue_oldest_seconds", "Сколько ждет самый старый апдейт в очереди",
+              update_queue.oldest_age)
+metrics.Gauge("bot_webhook_inbox_pending", "Сделок/партнеров с необработанными вебхуками Битрикс",
+              lambda: len(webhook_inbox))
+metrics.Gauge("bot_bitrix_queue_depth", "Запросов к Битрикс в очереди лимита", lambda: len(bitrix_api.client.bucket))
+# Считаются запросом к БД / хранилищу FSM, поэтому обновляются в handle_metrics
+fsm_sessions_gauge = metrics.Gauge("bot_fsm_active_sessions", "Активных FSM-сессий")
+unreachable_chats_gauge = metrics.Gauge("bot_unreachable_chats", "Пользователей, заблокировавших бота")
+
+
+# Системный ID стадии -> понятное название
+CLIENT_STAGE_NAMES = {
+    config.BITRIX_CLIENT_STAGE_1: "Клиенты в обработке",
+    config.BITRIX_CLIENT_STAGE_2: "С клиентом назначена встреча",
+    config.BITRIX_CLIENT_STAGE_3: "Расчет сметы",
+    config.BITRIX_CLIENT_STAGE_WIN: "С клиентом заключен договор",
+    config.BITRIX_CLIENT_STAGE_LOSE: "Отказ клиента"
+}
+
+
 def get_client_stage_name(stage_id: str) -> str:
     """Превращает системный ID стадии в понятное название."""
-    stages_map = {
-        config.BITRIX_CLIENT_STAGE_1: "Клиенты в обработке",
-        config.BITRIX_CLIENT_STAGE_2: "С клиентом назначена встреча",
-        config.BITRIX_CLIENT_STAGE_3: "Расчет сметы",
-        config.BITRIX_CLIENT_STAGE_WIN: "С клиентом заключен договор",
-        config.BITRIX_CLIENT_STAGE_LOSE: "Отказ клиента"
-    }
-    return stages_map.get(stage_id, stage_id)
+    return CLIENT_STAGE_NAMES.get(stage_id, stage_id)
 
 
-async def process_partner_verification(admin_id: int, partner_user_id: int, new_status: str,
-                                       callback: CallbackQuery = None):
+async def apply_partner_verification(partner_user_id: int, new_status: str, move_stage: bool = True):
     """
-    Ядро верификации.
+    Ядро верификации: статус в БД, смена стадии сделки и уведомления.
     Позволяет менять статус даже если партнер уже был отклонен (re-verification).
+    move_stage=False — стадию сделки уже сменили в самом Битрикс (входящий вебхук).
+    Возвращает данные партнера или None, если его нет в БД. Ошибки не перехватывает.
     """
+    partner_data = await db.get_partner_data(partner_user_id)
+    if not partner_data:
+        return None
+
+    # 1-2. Статус в БД и задачу «перевести сделку в Битрикс» пишем одной транзакцией,
+    # сделку двигает воркер очереди (с повторами), админ получает ответ сразу
+    if move_stage:
+        await db.set_partner_status_with_job(partner_user_id, new_status, "move_partner_deal_stage",
+                                             {"user_id": partner_user_id})
+        job_queue.notify()
+    else:
+        await db.set_partner_status(partner_user_id, new_status)
+
+    # 3. Уведомляем партнера (в фоне, с сохранением итога доставки)
+    if new_status == 'verified':
+        await notifier.send("partner_verification", partner_user_id, [partner_user_id],
+                            "✅ Вы верифицированный партнер. Теперь вы можете отправлять нам клиентов!",
+                            kb.get_verified_partner_menu())
+    else:
+        await notifier.send("partner_verification", partner_user_id, [partner_user_id],
+                            "❌ К сожалению, ваша заявка была отклонена.", ReplyKeyboardRemove())
+
+    # 4. Отмечаем итог в заявке у всех админов, которым она пришла
+    notifier.edit("partner_application", partner_user_id, f"\n\n<b>Итог:</b> {new_status.capitalize()}")
+    return partner_data
+
+
+async def process_partner_verification(admin_id: int, partner_user_id: int, new_status: str,
+                                       callback: CallbackQuery = None):
+    """Верификация по команде админа: результат и ошибки — ответом админу."""
     try:
-        partner_data = await db.get_partner_data(partner_user_id)
+        partner_data = await apply_partner_verification(partner_user_id, new_status)
         if not partner_data:
             msg = "Партнер не найден в БД."
             if callback:
@@ -90,46 +234,124 @@ async def process_partner_verification(admin_id: int, partner_user_id: int, new_
             return
 
         partner_name = partner_data.get('full_name', f'ID: {partner_user_id}')
-
-        # 1. Обновляем статус в БД
-        await db.set_partner_status(partner_user_id, new_status)
-
-        # 2. Двигаем сделку в Битрикс
-        deal_id = await db.get_partner_deal_id_by_user_id(partner_user_id)
-        if deal_id:
-            target_stage = config.BITRIX_PARTNER_VERIFIED_STAGE_ID if new_status == 'verified' else config.BITRIX_PARTNER_REJECTED_STAGE_ID
-            if target_stage:
-                await bitrix_api.move_deal_stage(deal_id, target_stage)
-
-        # 3. Уведомляем партнера
-        if new_status == 'verified':
-            await bot.send_message(partner_user_id,
-                                   "✅ Вы верифицированный партнер. Теперь вы можете отправлять нам клиентов!",
-                                   reply_markup=kb.get_verified_partner_menu())
-        else:
-            await bot.send_message(partner_user_id, "❌ К сожалению, ваша заявка была отклонена.",
-                                   reply_markup=ReplyKeyboardRemove())
-
-        # 4. Ответ админу
         admin_text = f"Партнер {escape(partner_name)} (ID: {partner_user_id}) -> {new_status}."
         if callback:
-            # Пытаемся отредактировать сообщение, если оно не слишком старое
-            try:
-                await callback.message.edit_text(callback.message.text + f"\n\n<b>Итог:</b> {new_status.capitalize()}")
-            except:
-                pass
             await callback.answer(admin_text)
-        elif admin_id > 0:
+        else:
             await bot.send_message(admin_id, f"✅ {admin_text}")
 
     except Exception as e:
         logging.error(f"Ошибка верификации: {e}")
         if callback:
             await callback.answer("Ошибка при обработке.", show_alert=True)
-        elif admin_id > 0:
+        else:
             await bot.send_message(admin_id, f"Ошибка: {e}")
 
 
+# =================================================================
+# === ФОНОВЫЕ ЗАДАЧИ (СДЕЛКИ В БИТРИКС) ===========================
+# =================================================================
+
+async def on_partner_deal_failed(payload: dict, error: str):
+    # Заявку удаляем, чтобы партнер мог пройти регистрацию заново — но только если сделки еще нет
+    if not await db.delete_partner_without_deal(payload['user_id']):
+        logging.warning(f"Сделка партнера {payload['user_id']} создана, но заявка не разослана админам: {error}")
+        return
+    await notifier.send("partner_registration_failed", payload['user_id'], [payload['user_id']],
+                        "Произошла ошибка при регистрации. Попробуйте позже.", ReplyKeyboardRemove())
+
+
+@job_queue.handler("create_partner_deal", on_failure=on_partner_deal_failed)
+async def job_create_partner_deal(payload: dict):
+    user_id = payload['user_id']
+    # Повтор задачи не должен создавать вторую сделку: ID сохраняем сразу после создания
+    if not await db.get_partner_deal_id_by_user_id(user_id):
+        deal_id = await bitrix_api.create_partner_deal(payload['full_name'], payload['phone'], user_id,
+                                                       payload.get('username'), payload.get('role'))
+        if not deal_id:
+            raise RuntimeError("Битрикс не вернул ID сделки партнера")
+        await db.set_partner_deal_id(user_id, deal_id)
+
+    # Уведомление Junior-админов
+    notification_text = tpl.PARTNER_APPLICATION.render(full_name=payload['full_name'],
+                                                       role=payload.get('role') or '-', phone=payload['phone'])
+    await notifier.send("partner_application", user_id, await db.get_junior_admin_ids(), notification_text,
+                        kb.get_verification_keyboard(user_id))
+
+
+async def on_partner_stage_failed(payload: dict, error: str):
+    # Статус в БД уже изменен — повторяем, пока сделка в Битрикс его не догонит, но не бесконечно.
+    # Главному админу сообщаем при первом отказе и когда сдаемся
+    escalations = payload.get('escalations', 1 if payload.get('escalated') else 0) + 1
+    user_id = payload['user_id']
+    if escalations > config.JOB_MAX_ESCALATIONS:
+        logging.error(f"Стадия сделки партнера {user_id} так и не сменена: {error}")
+        await notifier.send("partner_stage_failed", user_id, [config.SUPER_ADMIN_ID],
+                            f"❌ Стадия сделки партнера {user_id} в Битрикс так и не сменена: "
+                            f"{escape(error)}\nСмените ее вручную.")
+        return
+    await job_queue.enqueue("move_partner_deal_stage", {"user_id": user_id, "escalations": escalations},
+                            delay=config.JOB_RETRY_MAX_DELAY)
+    if escalations == 1:
+        await notifier.send("partner_stage_failed", user_id, [config.SUPER_ADMIN_ID],
+                            f"⚠️ Не удается сменить стадию сделки партнера {user_id} в Битрикс: "
+                            f"{escape(error)}\nПовторяем в фоне.")
+
+
+@job_queue.handler("move_partner_deal_stage", on_failure=on_partner_stage_failed)
+async def job_move_partner_deal_stage(payload: dict):
+    """
+    Переводит сделку партнера в стадию, соответствующую его ТЕКУЩЕМУ статусу в БД.
+    Поэтому повтор безопасен, а при нескольких сменах статуса подряд побеждает последний.
+    """
+    user_id = payload['user_id']
+    status = await db.get_partner_status(user_id)
+    if status == 'verified':
+        target_stage = config.BITRIX_PARTNER_VERIFIED_STAGE_ID
+    elif status == 'rejected':
+        target_stage = config.BITRIX_PARTNER_REJECTED_STAGE_ID
+    else:
+        return
+    if not target_stage:
+        return
+    deal_id = await db.get_partner_deal_id_by_user_id(user_id)
+    if not deal_id:
+        if await db.has_unfinished_job("create_partner_deal", user_id):
+            raise RuntimeError("У партнера еще нет сделки в Битрикс")
+        # Сделки нет и не будет (старые партнеры, импорт без --create-deals) — двигать нечего
+        logging.info(f"Стадия не сменена: у партнера {user_id} нет сделки в Битрикс")
+        return
+    if not await bitrix_api.move_deal_stage(deal_id, target_stage, bitrix_api.PRIORITY_BACKGROUND):
+        raise RuntimeError(f"Битрикс не сменил стадию сделки {deal_id}")
+
+
+async def on_client_deal_failed(payload: dict, error: str):
+    # Клиента со сделкой в Битрикс не удаляем — иначе партнер потеряет его и выплату
+    if not await db.delete_client_without_deal(payload['client_id']):
+        logging.warning(f"Сделка клиента #{payload['client_id']} создана, но задача не завершена: {error}")
+        return
+    await notifier.send("client_send_failed", payload['client_id'], [payload['partner_user_id']],
+                        tpl.CLIENT_SEND_FAILED.render(name=payload['client_name']), kb.get_verified_partner_menu())
+
+
+@job_queue.handler("create_client_deal", on_failure=on_client_deal_failed)
+async def job_create_client_deal(payload: dict):
+    client_id = payload['client_id']
+    # Повтор задачи не должен создавать вторую сделку: ID сохраняем сразу после создания
+    if not await db.get_client_deal_id(client_id):
+        deal_id = await bitrix_api.create_client_deal(
+            payload['client_name'], payload['client_phone'], payload['client_address'],
+            payload['partner_name'], payload.get('client_comment'), payload.get('client_area')
+        )
+        if not deal_id:
+            raise RuntimeError("Битрикс не вернул ID сделки клиента")
+        await db.confirm_client_deal(client_id, deal_id)
+    await phone_index.remember(payload['client_phone'])
+    # Сообщение уходит через notifier: сбой Telegram не должен проваливать задачу
+    await notifier.send("client_sent", client_id, [payload['partner_user_id']],
+                        tpl.CLIENT_SENT.render(name=payload['client_name']), kb.get_verified_partner_menu())
+
+
 # =================================================================
 # === ОБРАБОТЧИКИ TELEGRAM: ОБЩИЕ =================================
 # =================================================================
@@ -137,6 +359,7 @@ async def process_partner_verification(admin_id: int, partner_user_id: int, new_
 @dp.message(CommandStart())
 async def cmd_start(message: Message, state: FSMContext):
     await state.clear()
+    await db.mark_chat_reachable(message.from_user.id)
     status = await db.get_partner_status(message.from_user.id)
 
     if status == 'verified':
@@ -203,29 +426,14 @@ async def process_phone(message: Message, state: FSMContext):
     username = message.from_user.username
     await state.clear()
 
-    # 1. Создаем сделку
-    deal_id = await bitrix_api.create_partner_deal(full_name, phone, user_id, username, role)
+    # 1. Сохраняем заявку и ставим создание сделки в очередь (одной транзакцией)
+    await db.add_partner_with_job(user_id, full_name, phone, role, "create_partner_deal", {
+        "user_id": user_id, "full_name": full_name, "phone": phone, "username": username, "role": role
+    })
+    job_queue.notify()
 
-    if deal_id:
-        # 2. Сохраняем в БД (теперь add_partner поддерживает role)
-        await db.add_partner(user_id, full_name, phone, deal_id, role)
-        await message.answer("⏳ Ваша заявка принята. Менеджер свяжется с вами.", reply_markup=ReplyKeyboardRemove())
-
-        # Уведомление Junior-админов
-        notification_text = (
-            f"🔔 <b>Новая заявка на партнерство!</b>\n"
-            f"<b>ФИО:</b> {escape(full_name)}\n"
-            f"<b>Роль:</b> {escape(role)}\n"
-            f"<b>Телефон:</b> {escape(phone)}\n"
-        )
-        keyboard = kb.get_verification_keyboard(user_id)
-        for admin_id in await db.get_junior_admin_ids():
-            try:
-                await bot.send_message(admin_id, notification_text, reply_markup=keyboard)
-            except:
-                pass
-    else:
-        await message.answer("Произошла ошибка при регистрации. Попробуйте позже.", reply_markup=ReplyKeyboardRemove())
+    # 2. Отвечаем сразу, не дожидаясь Битрикса. Админов уведомит задача, когда сделка будет создана.
+    await message.answer("⏳ Ваша заявка принята. Менеджер свяжется с вами.", reply_markup=ReplyKeyboardRemove())
 
 
 @dp.message(PartnerRegistration.waiting_for_phone)
@@ -256,20 +464,14 @@ async def client_name_received(message: Message, state: FSMContext):
 
 @dp.message(ClientSubmission.waiting_for_client_phone, F.text)
 async def client_phone_received(message: Message, state: FSMContext):
-    phone_text = message.text
-    cleaned = re.sub(r'\D', '', phone_text)
-    if cleaned.startswith('8') and len(cleaned) == 11:
-        cleaned = '7' + cleaned[1:]
-    elif len(cleaned) == 10:
-        cleaned = '7' + cleaned
-
-    if not (len(cleaned) == 11 and cleaned.startswith('7')):
+    cleaned = normalize_phone(message.text)
+    if not cleaned:
         await message.answer("❌ Неверный формат. Введите номер РФ (начинается с +7, 8 или 9).")
         return
     formatted_phone = '+' + cleaned
 
-    # Проверка дубля
-    contact_id = await bitrix_api.check_contact_exists_by_phone(formatted_phone)
+    # Проверка дубля (по локальному индексу, в CRM — только вероятные совпадения)
+    contact_id = await phone_index.find_contact(formatted_phone)
     if contact_id:
         p_data = await db.get_partner_data(message.from_user.id)
         c_name = (await state.get_data()).get('client_name')
@@ -311,15 +513,9 @@ async def client_comment_received(message: Message, state: FSMContext):
     client_name = data.get('client_name') or "Не указано"
     client_address = data.get('client_address') or "Не указано"
 
-    txt = (
-        f"<b>Проверьте данные:</b>\n\n"
-        f"👤 <b>Имя:</b> {escape(client_name)}\n"
-        f"📞 <b>Тел:</b> {data.get('client_phone', '-')}\n"
-        f"🏠 <b>Адрес:</b> {escape(client_address)}\n"
-        f"📐 <b>Площадь:</b> {escape(data.get('client_area') or '-')}\n"
-        f"💬 <b>Коммент:</b> {escape(comm or '-')}\n\n"
-        f"Все верно?"
-    )
+    txt = tpl.CLIENT_CONFIRMATION.render(name=client_name, phone=data.get('client_phone', '-'),
+                                         address=client_address, area=data.get('client_area') or '-',
+                                         comment=comm or '-')
     await message.answer(txt, reply_markup=kb.get_client_confirmation_keyboard())
     await state.set_state(ClientSubmission.confirming_data)
 
@@ -330,18 +526,20 @@ async def confirm_client(callback: CallbackQuery, state: FSMContext):
     d = await state.get_data()
     p_data = await db.get_partner_data(p_id)
     await state.clear()
-    await callback.message.edit_text("⏳ Отправка...", reply_markup=None)
 
-    deal_id = await bitrix_api.create_client_deal(
-        d['client_name'], d['client_phone'], d['client_address'],
-        p_data['full_name'], d['client_comment'], d['client_area']
-    )
-    if deal_id:
-        await db.add_client(p_id, deal_id, d['client_name'], d['client_address'])
-        await callback.message.answer(f"✅ Клиент '{escape(d['client_name'])}' отправлен!",
-                                      reply_markup=kb.get_verified_partner_menu())
-    else:
-        await callback.message.answer("Ошибка при отправке.", reply_markup=kb.get_verified_partner_menu())
+    # Сохраняем клиента и задачу на создание сделки; сам запрос в Битрикс выполнит воркер
+    await db.add_client_with_job(p_id, d['client_name'], d['client_address'], "create_client_deal", {
+        "partner_user_id": p_id,
+        "partner_name": p_data['full_name'],
+        "client_name": d['client_name'],
+        "client_phone": d['client_phone'],
+        "client_address": d['client_address'],
+        "client_comment": d['client_comment'],
+        "client_area": d['client_area'],
+    })
+    job_queue.notify()
+
+    await callback.message.edit_text(tpl.CLIENT_ACCEPTED.render(name=d['client_name']), reply_markup=None)
     await callback.answer()
 
 
@@ -356,96 +554,148 @@ async def retry_client(callback: CallbackQuery, state: FSMContext):
 # === СТАТИСТИКА И СПИСКИ =========================================
 # =================================================================
 
-@dp.message(F.text == "📈 Статистика")
-async def show_statistics(message: Message):
-    # Проверка прав доступа
-    if await db.get_partner_status(message.from_user.id) != 'verified':
-        return
-
-    # 1. Получаем всех клиентов партнера из БД
-    # Функция get_all_partner_clients возвращает (Имя, Статус, Сумма)
-    clients = await db.get_all_partner_clients(message.from_user.id)
+# Лимит Telegram — 4096 символов, оставляем запас
+STATS_TEXT_LIMIT = 4000
+STATS_PAGE_SIZE = 50
 
-    total_clients = len(clients)
-    sum_in_work = 0.0  # Сумма "В работе"
-    sum_on_approval = 0.0  # Сумма "На согласовании" (Победа)
 
-    details_text = ""
-
-    # Получаем названия стадий из конфига для точного сравнения
+async def build_stats_details(p_id: int, budget: int, before_id: int = None):
+    """
+    Строки детализации, пока они помещаются в budget символов.
+    Клиенты читаются из БД порциями, а не все сразу.
+    Возвращает (строки, курсор для продолжения или None, если показаны все).
+    """
     win_stage_name = get_client_stage_name(config.BITRIX_CLIENT_STAGE_WIN)
     lose_stage_name = get_client_stage_name(config.BITRIX_CLIENT_STAGE_LOSE)
 
-    # 2. Проходим по списку клиентов и считаем деньги
-    for name, status, payout in clients:
-        payout = payout or 0.0
-
-        if status == win_stage_name:
-            # Если статус "Договор заключен" -> деньги на согласовании
-            sum_on_approval += payout
-            icon = "🟢"
-        elif status == lose_stage_name:
-            # Если статус "Отказ" -> деньги не считаем
-            icon = "🔴"
-        else:
-            # Все остальные статусы -> деньги в работе
-            sum_in_work += payout
-            icon = "🟡"
+    lines = []
+    used = 0
+    cursor = before_id
+    while True:
+        rows = await db.get_partner_clients_page(p_id, before_id=cursor, limit=STATS_PAGE_SIZE)
+        for client_id, name, status, payout in rows:
+            payout = payout or 0.0
+            if status == win_stage_name:
+                icon = "🟢"
+            elif status == lose_stage_name:
+                icon = "🔴"
+            else:
+                icon = "🟡"
+
+            line = tpl.STATS_LINE.render(name=name[:200], payout=payout, icon=icon)
+            if used + len(line) > budget:
+                return lines, cursor
+            lines.append(line)
+            used += len(line)
+            cursor = client_id
+
+        if len(rows) < STATS_PAGE_SIZE:
+            return lines, None
 
-        # Добавляем строку в список детализации
-        details_text += f"• {escape(name)}: <b>{payout:,.0f} ₽</b> {icon}\n"
 
-    # 3. Формируем итоговое сообщение
-    text = (
+@dp.message(F.text == "📈 Статистика")
+async def show_statistics(message: Message):
+    # Проверка прав доступа
+    if await db.get_partner_status(message.from_user.id) != 'verified':
+        return
+
+    # 1. Итоги считает SQLite, одним запросом
+    summary = await db.get_partner_payout_summary(
+        message.from_user.id,
+        get_client_stage_name(config.BITRIX_CLIENT_STAGE_WIN),
+        get_client_stage_name(config.BITRIX_CLIENT_STAGE_LOSE)
+    )
+
+    header = (
         f"<b>📊 Финансовая статистика:</b>\n\n"
-        f"🟡 <b>В работе:</b> {sum_in_work:,.0f} руб.\n"
+        f"🟡 <b>В работе:</b> {summary['in_work']:,.0f} руб.\n"
         f"<i>(Прогноз по активным сделкам)</i>\n\n"
-        f"🟢 <b>На согласовании:</b> {sum_on_approval:,.0f} руб.\n"
+        f"🟢 <b>На согласовании:</b> {summary['on_approval']:,.0f} руб.\n"
         f"<i>(Договор подписан, ожидайте выплату)</i>\n\n"
-        f"👥 <b>Всего клиентов:</b> {total_clients}\n"
+        f"👥 <b>Всего клиентов:</b> {summary['total_clients']}\n"
         f"--------------------------\n"
         f"<b>Детализация:</b>\n"
-        f"{details_text}"
     )
 
-    # Обрезаем сообщение, если оно длиннее лимита Telegram (4096 символов)
-    if len(text) > 4000:
-        text = text[:4000] + "\n\n... (список обрезан)"
+    # 2. Детализация — сколько поместится в одно сообщение, остальное по кнопке
+    lines, cursor = await build_stats_details(message.from_user.id, STATS_TEXT_LIMIT - len(header))
+    keyboard = kb.get_stats_more_keyboard(cursor) if cursor is not None else None
+    await message.answer(header + "".join(lines), reply_markup=keyboard)
+
+
+@dp.callback_query(F.data.startswith("stats_more:"))
+async def show_statistics_more(callback: CallbackQuery):
+    """Следующая порция детализации (полный отчет)."""
+    p_id = callback.from_user.id
+    if await db.get_partner_status(p_id) != 'verified':
+        await callback.answer()
+        return
+
+    header = "<b>Детализация (продолжение):</b>\n"
+    before_id = int(callback.data.split(":")[1])
+    lines, cursor = await build_stats_details(p_id, STATS_TEXT_LIMIT - len(header), before_id)
+
+    # Убираем кнопку с предыдущего сообщения, чтобы не листать дважды
+    try:
+        await callback.message.edit_reply_markup(reply_markup=None)
+    except Exception:
+        pass
+
+    if lines:
+        keyboard = kb.get_stats_more_keyboard(cursor) if cursor is not None else None
+        await callback.message.answer(header + "".join(lines), reply_markup=keyboard)
+    await callback.answer()
+
+
+async def render_clients_page(p_id: int, offset: int = 0, before_id: int = None, after_id: int = None):
+    """Текст и клавиатура страницы «Мои клиенты». Возвращает (None, None), если клиентов нет."""
+    total = await db.count_clients_by_partner_id(p_id)
+    if total == 0:
+        return None, None
+    clients = await db.get_clients_by_partner_id(p_id, limit=kb.CLIENTS_PER_PAGE,
+                                                 before_id=before_id, after_id=after_id)
+    if not clients:
+        # Курсор устарел — показываем первую страницу
+        offset = 0
+        clients = await db.get_clients_by_partner_id(p_id, limit=kb.CLIENTS_PER_PAGE)
+
+    lines = [tpl.CLIENTS_PAGE_HEADER.render(first=offset + 1, last=min(offset + len(clients), total), total=total)]
+    for i, (_, name, status, addr) in enumerate(clients, start=offset + 1):
+        lines.append(tpl.CLIENTS_PAGE_LINE.render(number=i, name=name, address=f" ({addr})" if addr else "",
+                                                  status=tpl.CLIENT_STATUS_LABELS.get(status, status)))
+    text = "".join(lines)
+
+    keyboard = kb.get_clients_pagination_keyboard(offset, total, clients[0][0], clients[-1][0])
+    return text, keyboard
 
-    await message.answer(text)
 
 @dp.message(F.text == "📊 Мои клиенты")
-async def show_my_clients(message: Message, state: FSMContext, offset: int = 0):
+async def show_my_clients(message: Message, state: FSMContext):
     p_id = message.from_user.id
     if await db.get_partner_status(p_id) != 'verified': return
-    total = await db.count_clients_by_partner_id(p_id)
-    if total == 0:
+    text, keyboard = await render_clients_page(p_id)
+    if text is None:
         await message.answer("Вы еще не отправляли клиентов.")
         return
-    clients = await db.get_clients_by_partner_id(p_id, limit=kb.CLIENTS_PER_PAGE, offset=offset)
-
-    text = f"<b>Ваши клиенты ({offset + 1}-{min(offset + kb.CLIENTS_PER_PAGE, total)} из {total}):</b>\n\n"
-    for i, (name, status, addr) in enumerate(clients, start=offset + 1):
-        a_info = f" ({addr})" if addr else ""
-        text += f"{i}. <b>{escape(name)}</b>{escape(a_info)}\n   Статус: <i>{escape(status)}</i>\n"
-
-    await message.answer(text, reply_markup=kb.get_clients_pagination_keyboard(offset, total))
+    await message.answer(text, reply_markup=keyboard)
 
 
 @dp.callback_query(F.data.startswith("prev_clients:") | F.data.startswith("next_clients:"))
 async def paginate_clients(callback: CallbackQuery, state: FSMContext):
-    off = int(callback.data.split(":")[1])
-    # Повтор логики show_my_clients
-    p_id = callback.from_user.id
-    total = await db.count_clients_by_partner_id(p_id)
-    clients = await db.get_clients_by_partner_id(p_id, limit=kb.CLIENTS_PER_PAGE, offset=off)
-
-    text = f"<b>Ваши клиенты ({off + 1}-{min(off + kb.CLIENTS_PER_PAGE, total)} из {total}):</b>\n\n"
-    for i, (name, status, addr) in enumerate(clients, start=off + 1):
-        a_info = f" ({addr})" if addr else ""
-        text += f"{i}. <b>{escape(name)}</b>{escape(a_info)}\n   Статус: <i>{escape(status)}</i>\n"
+    # Формат: next_clients:<client_id>:<offset> / prev_clients:<client_id>:<offset>
+    direction, *args = callback.data.split(":")
+    before_id = after_id = None
+    off = 0
+    if len(args) == 2:
+        cursor_id, off = int(args[0]), int(args[1])
+        if direction == "next_clients":
+            before_id = cursor_id
+        else:
+            after_id = cursor_id
 
-    await callback.message.edit_text(text, reply_markup=kb.get_clients_pagination_keyboard(off, total))
+    text, keyboard = await render_clients_page(callback.from_user.id, off, before_id, after_id)
+    if text:
+        await callback.message.edit_text(text, reply_markup=keyboard)
     await callback.answer()
 
 
@@ -520,6 +770,67 @@ async def cmd_list_admins(message: Message):
     await message.answer(txt)
 
 
+@dp.message(Command("cachestats"), IsSeniorAdminFilter())
+async def cmd_cache_stats(message: Message):
+    """Показывает попадания/промахи кэшей БД."""
+    lines = [f"• {name}: {st['hits']} hit / {st['misses']} miss, размер {st['size']}"
+             for name, st in db.get_cache_stats().items()]
+    await message.answer("<b>Кэши:</b>\n" + "\n".join(lines))
+
+
+@dp.message(Command("queuestats"), IsSeniorAdminFilter())
+async def cmd_queue_stats(message: Message):
+    """Показывает состояние очередей (апдейты, вебхуки, запросы к Битрикс) и фоновых индексов."""
+    st = update_queue.stats()
+    bx = bitrix_api.client.stats()
+    wh = await db.count_webhook_events()
+    ib = webhook_inbox.stats()
+    ph = phone_index.stats()
+    ds = deal_sync.stats()
+    await message.answer(
+        f"<b>Очередь апдейтов:</b>\n"
+        f"• В очереди: {st['depth']} (чатов: {st['chats']})\n"
+        f"• Обработано: {st['processed']}, отклонено: {st['rejected']}\n"
+        f"• Задержка: {st['last_lag'] * 1000:.0f} мс (макс. {st['max_lag'] * 1000:.0f} мс)\n\n"
+        f"<b>Вебхуки Битрикс:</b>\n"
+        f"• Ждут обработки: {wh.get('pending', 0) + wh.get('processing', 0)}, обработано: {wh.get('done', 0)}\n"
+        f"• Дублей: {wh.get('duplicate', 0)}, ошибок: {wh.get('failed', 0)}\n"
+        f"• На этой реплике: получено {ib['received']} (дублей {ib['duplicates']}), "
+        f"обработано {ib['processed']}, отказов {ib['failed']}\n\n"
+        f"<b>Запросы к Битрикс:</b>\n"
+        f"• В очереди: {bx['depth']}, выполнено: {bx['granted']}\n"
+        f"• Ожидание: {bx['last_wait'] * 1000:.0f} мс (макс. {bx['max_wait'] * 1000:.0f} мс)\n"
+        f"• Повторов: {bx['retries']} (из них по лимиту: {bx['throttled']})\n\n"
+        f"<b>Индекс телефонов:</b>\n"
+        f"• Синхронизирован: {'да' if ph['ready'] else 'нет'}\n"
+        f"• Проверок дублей: локально {ph['local_negatives']}, в Битрикс {ph['remote_checks']}\n\n"
+        f"<b>Сверка сделок</b> (только на основной реплике):\n"
+        f"• Проходов: {ds['runs']}, получено сделок: {ds['fetched']}, исправлено клиентов: {ds['updated']}"
+    )
+
+
+@dp.message(Command("replaywebhooks"), IsSeniorAdminFilter())
+async def cmd_replay_webhooks(message: Message):
+    """
+    /replaywebhooks 2026-10-16T10:00 [2026-10-16T12:00]
+    Повторно обрабатывает вебхуки Битрикс, полученные за интервал (по умолчанию — до текущего момента).
+    Журнал хранит события WEBHOOK_RETENTION_DAYS дней — более ранние повторить нельзя.
+    """
+    try:
+        args = message.text.split()[1:]
+        if not 1 <= len(args) <= 2:
+            raise ValueError("нужно начало интервала и, возможно, конец")
+        since = datetime.fromisoformat(args[0]).timestamp()
+        until = datetime.fromisoformat(args[1]).timestamp() if len(args) == 2 else time.time()
+    except ValueError as e:
+        await message.answer(f"Ошибка: {escape(str(e))}\n/replaywebhooks 2026-10-16T10:00 [2026-10-16T12:00]")
+        return
+    count = await webhook_inbox.replay(since, until)
+    await message.answer(f"🔁 Поставлено на повторную обработку событий: {count}.\n"
+                         f"Берется последнее событие по каждой сделке/партнеру, если позже ничего не приходило. "
+                         f"Журнал хранит события {config.WEBHOOK_RETENTION_DAYS:g} дн.")
+
+
 @dp.message(Command("setinfotext"), IsSeniorAdminFilter())
 async def cmd_set_info_text(message: Message):
     """/setinfotext info ТЕКСТ"""
@@ -566,6 +877,17 @@ async def cmd_set_percent(message: Message):
         )
 
 
+@dp.message(Command("recalcpayouts"), IsSeniorAdminFilter())
+async def cmd_recalc_payouts(message: Message):
+    """Пересчитывает выплаты всех клиентов по текущему проценту (по сохраненным суммам сделок)."""
+    try:
+        percent_val = float(await db.get_setting("payout_percent", "0"))
+    except ValueError:
+        percent_val = 0.0
+    updated = await db.recalculate_payouts(percent_val, config.BITRIX_CLIENT_STAGE_LOSE)
+    await message.answer(f"✅ Выплаты пересчитаны по ставке {percent_val}%: обновлено клиентов — {updated}.")
+
+
 @dp.message(Command("broadcast"), IsAdminFilter())
 async def cmd_broadcast(message: Message):
     """
@@ -584,36 +906,22 @@ async def cmd_broadcast(message: Message):
 
     text_to_send = parts[1]
 
-    # 2. Получаем список ID из базы
+    # 2. Сохраняем рассылку и список получателей в БД
     # Шлем только 'verified', чтобы не беспокоить тех, кому отказали или кто еще ждет
-    partner_ids = await db.get_all_partner_ids(status='verified')
+    broadcast_id, total = await db.create_broadcast(message.from_user.id, text_to_send, status='verified')
 
-    if not partner_ids:
+    if not total:
         await message.answer("ℹ️ В базе нет верифицированных партнеров для рассылки.")
         return
 
-    await message.answer(f"⏳ Начинаю рассылку на <b>{len(partner_ids)}</b> пользователей...")
+    # 3. Это сообщение будет обновляться по ходу рассылки
+    progress = await message.answer(f"⏳ Начинаю рассылку на <b>{total}</b> пользователей...")
+    await db.set_broadcast_progress_message(broadcast_id, progress.chat.id, progress.message_id)
 
-    # 3. Рассылаем
-    success_count = 0
-    fail_count = 0
+    # 4. Рассылаем в фоне, не задерживая обработку вебхука
+    broadcaster.start(broadcast_id)
 
-    for user_id in partner_ids:
-        try:
-            # Можно добавить небольшую задержку, если партнеров очень много (>1000)
-            # await asyncio.sleep(0.05)
-            await bot.send_message(user_id, text_to_send)
-            success_count += 1
-        except Exception:
-            # Ошибка возникает, если пользователь заблокировал бота
-            fail_count += 1
 
-    # 4. Отчет
-    await message.answer(
-        f"✅ <b>Рассылка завершена.</b>\n\n"
-        f"📨 Успешно отправлено: {success_count}\n"
-        f"🚫 Не доставлено (бот заблокирован): {fail_count}"
-    )
 # =================================================================
 # === ВЕБ-СЕРВЕР ==================================================
 # =================================================================
@@ -622,80 +930,191 @@ async def handle_telegram_GET(request: web.Request):
     return web.Response(text="OK")
 
 
+async def handle_metrics(request: web.Request):
+    fsm_sessions_gauge.set(await count_fsm_sessions())
+    unreachable_chats_gauge.set(await db.count_unreachable_chats())
+    return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+
 async def handle_telegram_POST(request: web.Request):
     try:
         data = await request.json()
-        await dp.feed_webhook_update(bot, data)
+        # Обработка идет в воркерах, Telegram получает ответ сразу
+        if not update_queue.put(data):
+            # Очередь переполнена — Telegram повторит доставку позже
+            logging.warning("Очередь апдейтов переполнена")
+            return web.Response(status=503, text="Busy")
         return web.Response(text="OK")
     except Exception as e:
         logging.error(f"Telegram webhook error: {e}")
         return web.Response(status=500, text="Server Error")
 
 
+def bitrix_event_key(event_type: str, object_id) -> str:
+    """Ключ события в журнале вебхуков: события по одному ключу схлопываются."""
+    return f"{event_type}:{object_id}"
+
+
 async def handle_bitrix_webhook(request: web.Request):
+    """Только сохраняет событие в журнал и сразу отвечает — обработка в webhook_inbox."""
+    data = dict(request.query)
+    if data.pop('secret', None) != config.BITRIX_INCOMING_SECRET:
+        return web.Response(status=403, text="Forbidden")
     try:
-        data = dict(request.query)
-        if data.get('secret') != config.BITRIX_INCOMING_SECRET:
-            return web.Response(status=403, text="Forbidden")
-
-        evt = data.get('event_type')
-        status_text = data.get('STAGE_ID') or data.get('status')
-        did = int(data.get('deal_id', 0))
-        uid = int(data.get('user_id', 0))
-
-        # --- 1. Верификация Партнера ---
-        if evt == 'partner_verification' and uid:
-            cur = await db.get_partner_status(uid)
-            if cur != status_text:
-                await process_partner_verification(0, uid, status_text)
-
-        # --- 2. Обновление Клиента ---
-        elif evt == 'client_deal_update':
-            pid, cname = await db.get_partner_and_client_by_deal_id(did)
-            if pid:
-                # А. Получаем данные о сумме сделки
-                ddata = await bitrix_api.get_deal(did)
-                full_opportunity = float(ddata.get('OPPORTUNITY', 0)) if ddata else 0
-
-                # Б. Получаем актуальный ПРОЦЕНТ из БД
-                percent_str = await db.get_setting("payout_percent", "0")
-                try:
-                    percent_val = float(percent_str)
-                except ValueError:
-                    percent_val = 0.0
-
-                # В. Считаем сумму выплаты
-                # (Сумма * Процент / 100)
-                partner_payout = full_opportunity * (percent_val / 100.0)
-
-                # Г. Если стадия ОТКАЗ -> обнуляем выплату
-                if status_text == config.BITRIX_CLIENT_STAGE_LOSE:
-                    partner_payout = 0.0
-
-                # Д. Обновляем статус и сумму в БД
-                sname = get_client_stage_name(status_text)
-                await db.update_client_status_and_payout(did, sname, partner_payout)
-
-                # Е. Уведомления
-                if status_text in NOTIFICATIONS_MAP:
-                    action_type = NOTIFICATIONS_MAP[status_text]
-
-                    if action_type == "win":
-                        await bot.send_message(pid,
-                                               f"✅ С клиентом <b>{escape(cname)}</b> заключен договор! Ваша выплата: {partner_payout:,.0f} руб.")
-
-                    elif action_type == "lose":
-                        await bot.send_message(pid, f"❌ Клиент <b>{escape(cname)}</b> отказ. Выплата отменена.")
-
-                    elif action_type == "meeting":
-                        await bot.send_message(pid, f"ℹ️ Встреча с клиентом <b>{escape(cname)}</b> назначена.")
-
+        key = bitrix_event_key(data.get('event_type'), data.get('deal_id') or data.get('user_id'))
+        await webhook_inbox.append(key, data)
         return web.Response(text="OK")
     except Exception as e:
         logging.error(f"Bitrix webhook error: {e}", exc_info=True)
         return web.Response(status=500)
+
+
+async def process_bitrix_event(data: dict):
+    """Обработка события из журнала. Исключение — событие будет обработано повторно."""
+    evt = data.get('event_type')
+    status_text = data.get('STAGE_ID') or data.get('status')
+    did = int(data.get('deal_id') or 0)
+    uid = int(data.get('user_id') or 0)
+
+    # --- 1. Верификация Партнера ---
+    if evt == 'partner_verification' and uid:
+        cur = await db.get_partner_status(uid)
+        if cur != status_text:
+            # Ошибка уходит в журнал вебхуков — событие будет обработано повторно
+            if not await apply_partner_verification(uid, status_text, move_stage=False):
+                logging.warning(f"Вебхук верификации: партнер {uid} не найден в БД")
+
+    # --- 2. Обновление Клиента ---
+    # Серию событий по сделке журнал схлопывает: сюда приходит только последнее
+    elif evt == 'client_deal_update' and did:
+        await process_client_deal_update(did, {
+            'stage_id': status_text,
+            'opportunity': data.get('OPPORTUNITY') or data.get('opportunity'),
+            'date_modify': data.get('DATE_MODIFY') or data.get('date_modify'),
+        })
+
+
+async def get_deal_opportunity(did: int, event: dict) -> float:
+    """
+    Сумма сделки. Запрос в Битрикс делаем, только если сумма не пришла в вебхуке
+    и сохраненный снимок сделки устарел.
+    """
+    try:
+        opportunity = float(event.get('opportunity'))
+        await db.save_deal_snapshot(did, event.get('stage_id'), opportunity, event.get('date_modify'))
+        return opportunity
+    except (TypeError, ValueError):
+        pass
+
+    snapshot = await db.get_deal_snapshot(did)
+    if snapshot and snapshot['opportunity'] is not None:
+        # Свежий снимок с той же стадией: сумма вряд ли успела измениться
+        fresh = (snapshot['stage_id'] == event.get('stage_id')
+                 and time.time() - (snapshot['fetched_at'] or 0) < config.BITRIX_DEAL_SNAPSHOT_TTL)
+        # Если вебхук передал время изменения сделки, снимок не старше него тоже годится
+        if event.get('date_modify') and snapshot['date_modify']:
+            fresh = fresh or snapshot['date_modify'] >= event['date_modify']
+        if fresh:
+            return snapshot['opportunity']
+
+    ddata = await bitrix_api.get_deal(did, bitrix_api.PRIORITY_BACKGROUND)
+    if ddata:
+        opportunity = float(ddata.get('OPPORTUNITY') or 0)
+        await db.save_deal_snapshot(did, event.get('stage_id') or ddata.get('STAGE_ID'), opportunity,
+                                    ddata.get('DATE_MODIFY'))
+        return opportunity
+
+    # Битрикс недоступен — лучше устаревшая сумма, чем ноль
+    if snapshot and snapshot['opportunity'] is not None:
+        return snapshot['opportunity']
+    return 0
+
+
+async def process_client_deal_update(did: int, event: dict):
+    """Смена стадии сделки клиента (после схлопывания серии вебхуков)."""
+    status_text = event['stage_id']
+    client = await db.get_client_deal_state(did)
+    if not client:
+        return
+    pid, cname = client['partner_user_id'], client['client_name']
+
+    # А. Сумма сделки (из вебхука, снимка или Битрикса)
+    full_opportunity = await get_deal_opportunity(did, event)
+
+    # Ничего не изменилось с прошлого раза — повторный вебхук, пропускаем
+    if client['stage_id'] == status_text and client['opportunity'] == full_opportunity:
+        return
+
+    # Б. Получаем актуальный ПРОЦЕНТ из БД
+    percent_str = await db.get_setting("payout_percent", "0")
+    try:
+        percent_val = float(percent_str)
+    except ValueError:
+        percent_val = 0.0
+
+    # В. Считаем сумму выплаты
+    # (Сумма * Процент / 100)
+    partner_payout = full_opportunity * (percent_val / 100.0)
+
+    # Г. Если стадия ОТКАЗ -> обнуляем выплату
+    if status_text == config.BITRIX_CLIENT_STAGE_LOSE:
+        partner_payout = 0.0
+
+    # Д. Обновляем статус и сумму в БД
+    sname = get_client_stage_name(status_text)
+    await db.update_client_status_and_payout(did, sname, partner_payout, status_text, full_opportunity)
+
+    # Е. Уведомления (только при смене стадии, а не суммы).
+    # Через notifier: отправка сохраняется в БД, поэтому сбой Telegram не теряет уведомление,
+    # а партнеру, заблокировавшему бота, запрос не уходит вовсе
+    if client['stage_id'] != status_text and status_text in NOTIFICATIONS_MAP:
+        action_type = NOTIFICATIONS_MAP[status_text]
+
+        if action_type == "win":
+            text = tpl.DEAL_WIN.render(name=cname, payout=partner_payout)
+        elif action_type == "lose":
+            text = tpl.DEAL_LOSE.render(name=cname)
+        else:
+            text = tpl.DEAL_MEETING.render(name=cname)
+        await notifier.send("client_deal_stage", did, [pid], text)
+
+
+webhook_inbox = WebhookInbox(process_bitrix_event)
+# Сделки, по которым ждет обработки вебхук, сверка не трогает — иначе партнер не получит уведомление
+deal_sync = DealSync(get_client_stage_name,
+                     skip=lambda did: bitrix_event_key('client_deal_update', did) in webhook_inbox)
+
+
+async def watch_settings():
+    """Подхватывает настройки, измененные другим процессом бота с той же базой."""
+    while True:
+        await asyncio.sleep(config.SETTINGS_POLL_INTERVAL)
+        try:
+            if await db.refresh_settings():
+                logging.info("Настройки изменены другим процессом — кэш обновлен")
+        except Exception as e:
+            logging.error(f"Ошибка проверки настроек: {e}")
+
+
 async def on_startup(app):
+    if config.REPLICAS > 1:
+        # Кэши в памяти у каждой реплики свои: чужие изменения видны не позже REPLICA_CACHE_TTL.
+        # До init_db — он уже загружает кэш админов
+        db.partner_cache.ttl = db.admin_roles.ttl = config.REPLICA_CACHE_TTL
     await db.init_db()
+    await bitrix_api.client.start()
+    await job_queue.start(requeue=config.PRIMARY_REPLICA)
+    update_queue.start()
+    # Фильтр телефонов догружается из БД на всех репликах, контакты из Битрикс тянет только основная
+    await phone_index.start(sync=config.PRIMARY_REPLICA)
+    if config.PRIMARY_REPLICA:
+        # Задачи, которые должны идти в одном экземпляре, даже если реплик несколько
+        await broadcaster.resume()
+        await notifier.resume()
+        # События разбирает одна реплика, чтобы события одной сделки шли по порядку; принимают все
+        await webhook_inbox.start()
+        deal_sync.start()
+    app['settings_watcher'] = asyncio.create_task(watch_settings())
     await db.add_admin(config.SUPER_ADMIN_ID, "SUPER", "senior")
     if not await db.get_setting("partnership_info"): await db.set_setting("partnership_info", "Инфо...")
     if not await db.get_setting("welcome_text"): await db.set_setting("welcome_text", "Приветствие...")
@@ -705,16 +1124,34 @@ async def on_startup(app):
 
 
 async def on_shutdown(app):
-    await bot.delete_webhook()
-
-
-def main():
+    if config.PRIMARY_REPLICA:
+        # Остальные реплики продолжают принимать апдейты — вебхук снимает только основная
+        await bot.delete_webhook()
+    await update_queue.stop()
+    await webhook_inbox.stop()
+    await phone_index.stop()
+    await deal_sync.stop()
+    app['settings_watcher'].cancel()
+    await broadcaster.stop()
+    await job_queue.stop()
+    await notifier.stop()
+    await bitrix_api.client.close()
+    await db.close_db()
+
+
+def setup_app() -> web.Application:
+    """Маршруты и хуки запуска/остановки (отдельно от main — для запуска внутри нагрузочного теста)."""
     app.router.add_get(config.TELEGRAM_WEBHOOK_PATH, handle_telegram_GET)
     app.router.add_post(config.TELEGRAM_WEBHOOK_PATH, handle_telegram_POST)
     app.router.add_post(config.BITRIX_WEBHOOK_PATH, handle_bitrix_webhook)
+    app.router.add_get(config.METRICS_PATH, handle_metrics)
     app.on_startup.append(on_startup)
     app.on_shutdown.append(on_shutdown)
-    web.run_app(app, host=config.WEB_SERVER_HOST, port=config.WEB_SERVER_PORT)
+    return app
+
+
+def main():
+    web.run_app(setup_app(), host=config.WEB_SERVER_HOST, port=config.WEB_SERVER_PORT)
 
 
 if __name__ == "__main__":
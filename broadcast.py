@@ -0,0 +1,144 @@
+# broadcast.py
+import asyncio
+import logging
+import time
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError
+
+import config
+import database as db
+from ratelimit import TokenBucket
+
+# Сколько получателей берем из базы за один раз
+BROADCAST_CHUNK = 100
+
+
+class Broadcaster:
+    """
+    Фоновые рассылки.
+    Отправка идет параллельно (не больше concurrency одновременно) через общее
+    ведро токенов, чтобы не упереться в лимиты Telegram. Итог по каждому получателю
+    сохраняется в БД, поэтому после рестарта рассылка продолжается с места остановки.
+    """
+
+    def __init__(self, bot: Bot, rate: float = config.BROADCAST_RATE, burst: int = config.BROADCAST_BURST,
+                 concurrency: int = config.BROADCAST_CONCURRENCY,
+                 progress_interval: float = config.BROADCAST_PROGRESS_INTERVAL):
+        self.bot = bot
+        self.bucket = TokenBucket(rate, burst)
+        self.concurrency = concurrency
+        self.progress_interval = progress_interval
+        self._tasks = {}
+
+    def start(self, broadcast_id: int):
+        """Запускает рассылку в фоне и сразу возвращает управление."""
+        if broadcast_id in self._tasks:
+            return
+        task = asyncio.create_task(self._run(broadcast_id))
+        self._tasks[broadcast_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(broadcast_id, None))
+
+    async def resume(self):
+        """Продолжает рассылки, прерванные остановкой бота."""
+        for broadcast_id in await db.get_unfinished_broadcast_ids():
+            logging.info(f"Возобновляем рассылку #{broadcast_id}")
+            self.start(broadcast_id)
+
+    async def stop(self):
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _run(self, broadcast_id: int):
+        info = await db.get_broadcast(broadcast_id)
+        if not info:
+            return
+        queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        results = []
+        workers = [asyncio.create_task(self._worker(queue, info['text'], results))
+                   for _ in range(self.concurrency)]
+        last_progress = 0.0
+        try:
+            while True:
+                user_ids = await db.get_pending_broadcast_recipients(broadcast_id, BROADCAST_CHUNK)
+                if not user_ids:
+                    break
+                for user_id in user_ids:
+                    await queue.put(user_id)
+                await queue.join()
+
+                # Сохраняем итоги пачки до того, как брать следующую
+                batch, results[:] = results[:], []
+                await db.mark_broadcast_deliveries(broadcast_id, batch)
+
+                if time.monotonic() - last_progress >= self.progress_interval:
+                    last_progress = time.monotonic()
+                    await self._report(broadcast_id, info, finished=False)
+        except Exception as e:
+            logging.error(f"Ошибка рассылки #{broadcast_id}: {e}", exc_info=True)
+            return
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            # При остановке бота сохраняем то, что уже успели отправить, чтобы не слать повторно
+            if results:
+                await db.mark_broadcast_deliveries(broadcast_id, results)
+
+        await db.finish_broadcast(broadcast_id)
+        await self._report(broadcast_id, info, finished=True)
+
+    async def _worker(self, queue: asyncio.Queue, text: str, results: list):
+        while True:
+            user_id = await queue.get()
+            try:
+                results.append(await self._deliver(user_id, text))
+            finally:
+                queue.task_done()
+
+    async def _deliver(self, user_id: int, text: str):
+        """Отправляет одно сообщение. Возвращает (user_id, status, error)."""
+        while True:
+            await self.bucket.acquire()
+            try:
+                await self.bot.send_message(user_id, text)
+                return user_id, 'sent', None
+            except TelegramRetryAfter as e:
+                # Telegram просит подождать — притормаживаем всю рассылку, а не только этот запрос
+                self.bucket.pause(e.retry_after)
+            except TelegramForbiddenError as e:
+                return user_id, 'blocked', str(e)[:200]
+            except Exception as e:
+                return user_id, 'failed', str(e)[:200]
+
+    async def _report(self, broadcast_id: int, info: dict, finished: bool):
+        """Правит одно сообщение админа с прогрессом (или присылает новое, если править нечего)."""
+        counts = await db.count_broadcast_deliveries(broadcast_id)
+        sent = counts.get('sent', 0)
+        failed = counts.get('blocked', 0) + counts.get('failed', 0)
+        total = sum(counts.values())
+
+        if finished:
+            text = (
+                f"✅ <b>Рассылка завершена.</b>\n\n"
+                f"📨 Успешно отправлено: {sent}\n"
+                f"🚫 Не доставлено (бот заблокирован): {failed}"
+            )
+        else:
+            text = (
+                f"⏳ <b>Рассылка:</b> {sent + failed} из {total}\n\n"
+                f"📨 Отправлено: {sent}\n"
+                f"🚫 Не доставлено: {failed}"
+            )
+
+        chat_id = info['progress_chat_id'] or info['admin_id']
+        message_id = info['progress_message_id']
+        try:
+            if message_id:
+                await self.bot.edit_message_text(text, chat_id=chat_id, message_id=message_id)
+            else:
+                await self.bot.send_message(chat_id, text)
+        except Exception as e:
+            logging.warning(f"Не удалось обновить прогресс рассылки #{broadcast_id}: {e}")
@@ -37,6 +37,35 @@ BITRIX_CLIENT_STAGE_3 = os.getenv("BITRIX_CLIENT_STAGE_3")
 BITRIX_CLIENT_STAGE_WIN = os.getenv("BITRIX_CLIENT_STAGE_WIN")
 BITRIX_CLIENT_STAGE_LOSE = os.getenv("BITRIX_CLIENT_STAGE_LOSE")
 
+# Пул HTTP-соединений к порталу Битрикс24
+BITRIX_POOL_LIMIT = int(os.getenv("BITRIX_POOL_LIMIT", 100))  # Всего соединений
+BITRIX_POOL_LIMIT_PER_HOST = int(os.getenv("BITRIX_POOL_LIMIT_PER_HOST", 10))  # Соединений на один хост
+BITRIX_DNS_CACHE_TTL = int(os.getenv("BITRIX_DNS_CACHE_TTL", 300))  # Кэш DNS, секунд
+BITRIX_KEEPALIVE_TIMEOUT = float(os.getenv("BITRIX_KEEPALIVE_TIMEOUT", 30))  # Keep-alive простоя, секунд
+BITRIX_REQUEST_TIMEOUT = float(os.getenv("BITRIX_REQUEST_TIMEOUT", 30))  # Таймаут запроса, секунд
+BITRIX_BATCH_WINDOW = float(os.getenv("BITRIX_BATCH_WINDOW", 0.02))  # Сколько ждать попутных команд для batch, секунд
+
+# Лимит запросов к Битрикс (общий для обоих вебхуков портала)
+BITRIX_RATE = float(os.getenv("BITRIX_RATE", 2))  # Запросов в секунду в среднем
+BITRIX_BURST = int(os.getenv("BITRIX_BURST", 10))  # Запросов подряд без ожидания
+BITRIX_MAX_RETRIES = int(os.getenv("BITRIX_MAX_RETRIES", 4))  # Повторов при QUERY_LIMIT_EXCEEDED и 5xx
+BITRIX_RETRY_BASE_DELAY = float(os.getenv("BITRIX_RETRY_BASE_DELAY", 1))  # Первая пауза перед повтором, секунд
+BITRIX_RETRY_MAX_DELAY = float(os.getenv("BITRIX_RETRY_MAX_DELAY", 30))  # Предел паузы, секунд
+
+# Входящие вебхуки смены стадии: серия событий по одной сделке схлопывается в одно
+BITRIX_DEAL_DEBOUNCE_WINDOW = float(os.getenv("BITRIX_DEAL_DEBOUNCE_WINDOW", 3))  # Тишина перед обработкой, секунд
+BITRIX_DEAL_DEBOUNCE_MAX_DELAY = float(os.getenv("BITRIX_DEAL_DEBOUNCE_MAX_DELAY", 15))  # Не дольше, секунд
+BITRIX_DEAL_SNAPSHOT_TTL = float(os.getenv("BITRIX_DEAL_SNAPSHOT_TTL", 60))  # Снимок сделки моложе — не запрашиваем
+
+# Локальный индекс телефонов контактов (проверка дублей клиентов)
+PHONE_SYNC_INTERVAL = float(os.getenv("PHONE_SYNC_INTERVAL", 600))  # Синхронизация индекса телефонов, секунд
+PHONE_REFRESH_INTERVAL = float(os.getenv("PHONE_REFRESH_INTERVAL", 30))  # Подгрузка новых телефонов из БД в фильтр, секунд
+PHONE_BLOOM_CAPACITY = int(os.getenv("PHONE_BLOOM_CAPACITY", 1_000_000))  # Ожидаемое число телефонов
+
+# Сверка сделок клиентов с Битрикс (на случай потерянных вебхуков)
+DEAL_SYNC_INTERVAL = float(os.getenv("DEAL_SYNC_INTERVAL", 900))  # Между запусками, секунд
+DEAL_SYNC_PAGE_DELAY = float(os.getenv("DEAL_SYNC_PAGE_DELAY", 0.5))  # Пауза между страницами, секунд
+
 # Проверяем критические переменные
 critical_b24_vars = [
     BITRIX_PARTNER_WEBHOOK,
@@ -58,6 +87,30 @@ if not SUPER_ADMIN_ID or not SUPER_ADMIN_ID.isdigit():
     raise ValueError("SUPER_ADMIN_ID (число) не указан в .env")
 SUPER_ADMIN_ID = int(SUPER_ADMIN_ID)
 
+# --- 3.1. Рассылки ---
+# Telegram допускает ~30 сообщений в секунду на бота и ~1 в секунду в один чат
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", 25))  # Сообщений в секунду
+BROADCAST_BURST = int(os.getenv("BROADCAST_BURST", 5))  # Допустимая пачка подряд
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", 10))  # Одновременных отправок
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", 3))  # Секунд между правками прогресса
+NOTIFY_CONCURRENCY = int(os.getenv("NOTIFY_CONCURRENCY", 10))  # Одновременных отправок уведомлений админам
+
+# --- 3.2. Фоновые задачи (создание сделок в Битрикс) ---
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 4))  # Параллельных воркеров
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", 6))  # Попыток до отказа
+JOB_RETRY_BASE_DELAY = float(os.getenv("JOB_RETRY_BASE_DELAY", 5))  # Первая задержка, секунд (далее x2)
+JOB_RETRY_MAX_DELAY = float(os.getenv("JOB_RETRY_MAX_DELAY", 300))  # Потолок задержки, секунд
+JOB_MAX_ESCALATIONS = int(os.getenv("JOB_MAX_ESCALATIONS", 12))  # Сколько раз перезапускать смену стадии партнера после отказа
+JOB_RETENTION_DAYS = float(os.getenv("JOB_RETENTION_DAYS", 30))  # Сколько хранить проваленные задачи, дней
+
+# --- 3.3. Входящие вебхуки Битрикс (журнал webhook_inbox) ---
+# Серии событий по одной сделке схлопываются по BITRIX_DEAL_DEBOUNCE_WINDOW / BITRIX_DEAL_DEBOUNCE_MAX_DELAY
+WEBHOOK_INBOX_BATCH = int(os.getenv("WEBHOOK_INBOX_BATCH", 50))  # Сделок/партнеров за один проход воркера
+WEBHOOK_DEDUP_WINDOW = float(os.getenv("WEBHOOK_DEDUP_WINDOW", 300))  # Повтор того же события за это время — дубль, секунд
+WEBHOOK_DELIVERY_ID_FIELD = os.getenv("WEBHOOK_DELIVERY_ID_FIELD", "event_id")  # Параметр вебхука с ID доставки (если передается)
+WEBHOOK_RETENTION_DAYS = float(os.getenv("WEBHOOK_RETENTION_DAYS", 14))  # Сколько хранить обработанные события (и сколько можно повторить)
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv("WEBHOOK_MAX_ATTEMPTS", 8))  # Попыток обработки до отказа (задержки как у JOB_*)
+
 # --- 4. Веб-сервер ---
 BASE_WEBHOOK_URL = os.getenv("BASE_WEBHOOK_URL")
 if not BASE_WEBHOOK_URL:
@@ -67,4 +120,19 @@ if not BASE_WEBHOOK_URL:
 TELEGRAM_WEBHOOK_PATH = f"/webhook/telegram/{BOT_TOKEN[-10:]}"
 BITRIX_WEBHOOK_PATH = f"/webhook/bitrix/{BITRIX_INCOMING_SECRET}"
 WEB_SERVER_HOST = "0.0.0.0"
-WEB_SERVER_PORT = int(os.getenv("WEB_SERVER_PORT", 8080))
\ No newline at end of file
+WEB_SERVER_PORT = int(os.getenv("WEB_SERVER_PORT", 8080))
+METRICS_PATH = os.getenv("METRICS_PATH", "/metrics")  # Метрики Prometheus
+
+# Очередь входящих апдейтов Telegram
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", 8))  # Воркеров обработки апдейтов
+UPDATE_QUEUE_MAX = int(os.getenv("UPDATE_QUEUE_MAX", 1000))  # Максимум апдейтов в очереди
+
+# Кэш настроек: как часто проверять, не изменил ли их другой процесс бота
+SETTINGS_POLL_INTERVAL = float(os.getenv("SETTINGS_POLL_INTERVAL", 30))  # Секунд
+
+# Несколько реплик бота за балансировщиком
+FSM_STORAGE = os.getenv("FSM_STORAGE", "sqlite")  # sqlite | memory | redis://host:6379/0
+PRIMARY_REPLICA = os.getenv("PRIMARY_REPLICA", "1") == "1"  # Рассылки, разбор вебхуков, сверка сделок и контактов, снятие вебхука — только здесь
+REPLICAS = int(os.getenv("REPLICAS", 1))  # Сколько реплик работает с одной базой (>1: блокировка чатов в БД, короткие кэши)
+REPLICA_CACHE_TTL = float(os.getenv("REPLICA_CACHE_TTL", 15))  # Жизнь кэшей партнеров и админов при нескольких репликах, секунд
+CHAT_LEASE_TTL = float(os.getenv("CHAT_LEASE_TTL", 60))  # Блокировка чата репликой на время обработки апдейта, секунд
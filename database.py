@@ -1,13 +1,226 @@
 # database.py
+import asyncio
+import json
+import time
+from collections import OrderedDict
 import aiosqlite
 import logging
+from contextlib import asynccontextmanager
+
+import metrics
 
 DB_NAME = 'data/partners.db'
 
+# Настройки пула соединений SQLite
+DB_READERS = 4  # Соединений для чтения (запись всегда идет через одно соединение)
+DB_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",  # Читатели не блокируют писателя
+    "PRAGMA synchronous=NORMAL",  # В режиме WAL это безопасно и намного быстрее FULL
+    "PRAGMA mmap_size=268435456",  # 256 МБ файла читаем через mmap
+    "PRAGMA cache_size=-16000",  # ~16 МБ страничного кэша на соединение
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA busy_timeout=5000",
+)
+
+ADMIN_CACHE_TTL = 60  # Секунд до повторной загрузки таблицы admins
+SETTINGS_VERSION = "settings_version"  # Счетчик изменений настроек в sync_state (для других процессов)
+PARTNER_CACHE_SIZE = 200_000  # Максимум партнеров в кэше (~200 байт на запись)
+PARTNER_CACHE_TTL = 600  # Секунд жизни записи о партнере
+DEAL_SNAPSHOT_CACHE_SIZE = 50_000  # Снимков сделок в памяти
+DEAL_SNAPSHOT_CACHE_TTL = 3600  # Секунд хранения снимка в памяти (сама таблица хранится всегда)
+# Условие WHERE для таблиц с user_id: пользователь не заблокировал бота
+REACHABLE_USER_SQL = "user_id NOT IN (SELECT chat_id FROM chat_reachability)"
+
+
+class Database:
+    """
+    Долгоживущие соединения с SQLite: один писатель и небольшой пул читателей.
+    Открывается один раз при старте, вместо aiosqlite.connect() на каждый запрос.
+    """
+
+    def __init__(self, path: str, readers: int = DB_READERS):
+        self.path = path
+        self.readers = readers
+        self._writer = None
+        self._readers = None
+        self._write_lock = asyncio.Lock()
+        self._open_lock = asyncio.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self._writer is not None
+
+    async def _connect(self):
+        conn = await aiosqlite.connect(self.path)
+        for pragma in DB_PRAGMAS:
+            await conn.execute(pragma)
+        return conn
+
+    async def open(self):
+        async with self._open_lock:
+            if self.is_open:
+                return
+            # Писатель открывается первым: он переводит файл в режим WAL
+            writer = await self._connect()
+            readers = asyncio.Queue()
+            for _ in range(self.readers):
+                readers.put_nowait(await self._connect())
+            self._writer, self._readers = writer, readers
+
+    async def close(self):
+        async with self._open_lock:
+            if not self.is_open:
+                return
+            while not self._readers.empty():
+                await self._readers.get_nowait().close()
+            await self._writer.close()
+            self._writer, self._readers = None, None
+
+    @asynccontextmanager
+    async def read(self):
+        """Берет свободное соединение для чтения из пула."""
+        if not self.is_open:
+            await self.open()
+        conn = await self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put_nowait(conn)
+
+    @asynccontextmanager
+    async def write(self):
+        """Единственное соединение для записи. Коммит при выходе, откат при ошибке."""
+        if not self.is_open:
+            await self.open()
+        async with self._write_lock:
+            try:
+                yield self._writer
+                await self._writer.commit()
+            except BaseException:
+                await self._writer.rollback()
+                raise
+
+
+class SnapshotCache:
+    """
+    Копия небольшой таблицы в памяти (ключ -> значение) с ограниченным TTL.
+    Чтение — поиск в словаре; по истечении TTL таблица перечитывается целиком.
+    Запись через set()/discard() применяется сразу, без ожидания TTL.
+    """
+
+    def __init__(self, loader, ttl: float):
+        self._loader = loader  # async () -> dict
+        self.ttl = ttl
+        self._data = {}
+        self._expires_at = 0.0
+        self._generation = 0
+        self._lock = asyncio.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    async def load(self, force: bool = True):
+        """Перечитывает таблицу. force=False — только если снимок все еще устарел."""
+        async with self._lock:
+            if not force and time.monotonic() < self._expires_at:
+                return  # Пока ждали блокировку, таблицу уже перечитал другой вызов
+            generation = self._generation
+            data = await self._loader()
+            if generation != self._generation:
+                # Во время загрузки кэш изменили — снимок мог устареть, перечитаем при следующем обращении
+                self._expires_at = 0.0
+                return
+            self._data = data
+            self._expires_at = time.monotonic() + self.ttl
+
+    async def get(self, key, default=None):
+        if time.monotonic() >= self._expires_at:
+            self.misses += 1
+            await self.load(force=False)
+        else:
+            self.hits += 1
+        return self._data.get(key, default)
+
+    def set(self, key, value):
+        self._generation += 1
+        self._data[key] = value
+
+    def discard(self, key):
+        self._generation += 1
+        self._data.pop(key, None)
+
+    def invalidate(self):
+        self._generation += 1
+        self._expires_at = 0.0
+
+    def stats(self) -> dict:
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses}
+
+
+class LRUCache:
+    """
+    Ограниченный кэш «ключ -> значение» с вытеснением давно неиспользуемых записей и TTL.
+    Хранит и отрицательные ответы (None), чтобы не ходить в базу за незарегистрированными.
+    """
+
+    _MISSING = object()
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=_MISSING):
+        """Возвращает значение или LRUCache._MISSING (либо default), если записи нет или она устарела."""
+        item = self._data.get(key)
+        if item is not None:
+            if item[0] > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return item[1]
+            del self._data[key]
+        self.misses += 1
+        return default
+
+    def put(self, key, value, generation: int = None):
+        """
+        Кладет значение в кэш. generation — значение self.generation до чтения из базы:
+        если кэш за это время меняли, результат чтения мог устареть и не сохраняется.
+        """
+        if generation is not None and generation != self._generation:
+            return
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def evict(self, key):
+        self._generation += 1
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._generation += 1
+        self._data.clear()
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    def stats(self) -> dict:
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+
+engine = Database(DB_NAME)
+
 
 async def init_db():
     """Инициализирует базу данных и обновляет структуру при необходимости."""
-    async with aiosqlite.connect(DB_NAME) as db:
+    await engine.open()
+    async with engine.write() as db:
         # Таблица партнеров (создаем, если нет)
         await db.execute('''
                 CREATE TABLE IF NOT EXISTS partners (
@@ -39,6 +252,43 @@ async def init_db():
             ON clients (bitrix_deal_id)
         ''')
 
+        # Для постраничного вывода клиентов партнера (keyset по client_id)
+        await db.execute('''
+            CREATE INDEX IF NOT EXISTS idx_clients_partner
+            ON clients (partner_user_id, client_id)
+        ''')
+
+        # Количество клиентов у партнера, поддерживается триггерами
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS partner_client_counts (
+                partner_user_id INTEGER PRIMARY KEY,
+                total INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+
+        await db.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_clients_count_insert
+            AFTER INSERT ON clients
+            BEGIN
+                INSERT INTO partner_client_counts (partner_user_id, total) VALUES (NEW.partner_user_id, 1)
+                ON CONFLICT (partner_user_id) DO UPDATE SET total = total + 1;
+            END
+        ''')
+
+        await db.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_clients_count_delete
+            AFTER DELETE ON clients
+            BEGIN
+                UPDATE partner_client_counts SET total = total - 1 WHERE partner_user_id = OLD.partner_user_id;
+            END
+        ''')
+
+        # Заполняем счетчики для клиентов, добавленных до появления триггеров
+        await db.execute('''
+            INSERT OR IGNORE INTO partner_client_counts (partner_user_id, total)
+            SELECT partner_user_id, COUNT(*) FROM clients GROUP BY partner_user_id
+        ''')
+
         await db.execute('''
             CREATE TABLE IF NOT EXISTS admins (
                 user_id INTEGER PRIMARY KEY,
@@ -53,15 +303,200 @@ async def init_db():
                 value TEXT
             )
         ''')
-        await db.commit()
+
+        # Последнее известное состояние сделок клиентов в Битрикс
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS deal_snapshots (
+                deal_id INTEGER PRIMARY KEY,
+                stage_id TEXT,
+                opportunity REAL,
+                date_modify TEXT,
+                fetched_at REAL
+            )
+        ''')
+
+        # Нормализованные телефоны контактов Битрикс (поиск дублей без запроса в CRM)
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS phone_index (
+                phone TEXT PRIMARY KEY,
+                contact_id INTEGER
+            )
+        ''')
+
+        # Состояния FSM (сценарии регистрации и передачи клиента), см. fsm_storage.py
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS fsm_states (
+                key TEXT PRIMARY KEY,
+                state TEXT,
+                data TEXT NOT NULL DEFAULT '{}',
+                updated_at REAL
+            )
+        ''')
+
+        # Чаты, апдейты которых сейчас обрабатывает одна из реплик (см. process_telegram_update в bot.py)
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS chat_leases (
+                chat_key TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            )
+        ''')
+
+        # Состояние фоновых синхронизаций (водяные знаки и т.п.)
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS sync_state (
+                name TEXT PRIMARY KEY,
+                value TEXT
+            )
+        ''')
+
+        # Очередь фоновых задач (см. jobs.py)
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_run_at REAL NOT NULL DEFAULT 0,
+                last_error TEXT,
+                created_at TEXT DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+        await db.execute('''
+            CREATE INDEX IF NOT EXISTS idx_jobs_pending
+            ON jobs (status, next_run_at)
+        ''')
+
+        # Рассылки и статус доставки по каждому получателю (для возобновления после рестарта)
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS broadcasts (
+                broadcast_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                admin_id INTEGER,
+                text TEXT NOT NULL,
+                status TEXT DEFAULT 'running',
+                progress_chat_id INTEGER,
+                progress_message_id INTEGER,
+                created_at TEXT DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+                broadcast_id INTEGER,
+                user_id INTEGER,
+                status TEXT DEFAULT 'pending',
+                error TEXT,
+                PRIMARY KEY (broadcast_id, user_id)
+            )
+        ''')
+
+        await db.execute('''
+            CREATE INDEX IF NOT EXISTS idx_broadcast_deliveries_status
+            ON broadcast_deliveries (broadcast_id, status)
+        ''')
+
+        # Уведомления (заявки партнеров админам и т.п.) и их доставка каждому получателю, см. notifier.py
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS notifications (
+                notification_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                ref TEXT,
+                text TEXT NOT NULL,
+                markup TEXT,
+                created_at REAL
+            )
+        ''')
+
+        await db.execute('''
+            CREATE INDEX IF NOT EXISTS idx_notifications_ref ON notifications (kind, ref)
+        ''')
+
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS notification_deliveries (
+                notification_id INTEGER,
+                user_id INTEGER,
+                status TEXT DEFAULT 'pending',
+                message_id INTEGER,
+                error TEXT,
+                updated_at REAL,
+                PRIMARY KEY (notification_id, user_id)
+            )
+        ''')
+
+        await db.execute('''
+            CREATE INDEX IF NOT EXISTS idx_notification_deliveries_user
+            ON notification_deliveries (user_id, updated_at)
+        ''')
+
+        # Журнал входящих вебхуков Битрикс (только дописывается, меняется лишь состояние обработки), см. inbox.py
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS webhook_inbox (
+                event_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                received_at REAL NOT NULL,
+                key TEXT NOT NULL,
+                dedup_key TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_run_at REAL NOT NULL DEFAULT 0,
+                last_error TEXT,
+                processed_at REAL
+            )
+        ''')
+
+        await db.execute('''
+            CREATE INDEX IF NOT EXISTS idx_webhook_inbox_status ON webhook_inbox (status, key)
+        ''')
+
+        await db.execute('''
+            CREATE INDEX IF NOT EXISTS idx_webhook_inbox_dedup ON webhook_inbox (dedup_key, received_at)
+        ''')
+
+        await db.execute('''
+            CREATE INDEX IF NOT EXISTS idx_webhook_inbox_key ON webhook_inbox (key, event_id)
+        ''')
+
+        await db.execute('''
+            CREATE INDEX IF NOT EXISTS idx_webhook_inbox_received ON webhook_inbox (received_at)
+        ''')
+
+        # Чаты, куда писать бесполезно (пользователь заблокировал бота). Запись удаляется по /start
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS chat_reachability (
+                chat_id INTEGER PRIMARY KEY,
+                blocked_at REAL,
+                error TEXT
+            )
+        ''')
 
     # Запускаем миграцию (добавляем колонки, если их нет в старой базе)
     await _migrate_db()
 
+    # Прогреваем кэши
+    await admin_roles.load()
+    await settings_cache.load()
+
+
+def get_cache_stats() -> dict:
+    """Счетчики попаданий/промахов кэшей (для мониторинга)."""
+    return {
+        "admin_roles": admin_roles.stats(),
+        "settings": settings_cache.stats(),
+        "partners": partner_cache.stats(),
+        "deal_snapshots": deal_snapshot_cache.stats(),
+    }
+
+
+async def close_db():
+    """Закрывает все соединения с базой (вызывается при остановке бота)."""
+    await engine.close()
+
 
 async def _migrate_db():
     """Безопасно добавляет новые колонки в существующие таблицы."""
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with engine.write() as db:
         # 1. Добавляем поле role в partners
         try:
             await db.execute("ALTER TABLE partners ADD COLUMN role TEXT")
@@ -83,67 +518,156 @@ async def _migrate_db():
         except Exception:
             pass
 
-        await db.commit()
+        # 4. Последние известные стадия и сумма сделки (чтобы не обрабатывать повторные вебхуки)
+        try:
+            await db.execute("ALTER TABLE clients ADD COLUMN stage_id TEXT")
+            await db.execute("ALTER TABLE clients ADD COLUMN opportunity REAL")
+            logging.info("MIGRATION: Added 'stage_id', 'opportunity' columns to clients table.")
+        except Exception:
+            pass
 
 
 # --- Партнеры ---
 
+# Кэш строк партнеров: user_id -> (status, full_name, phone_number, role, bitrix_deal_id) или None
+partner_cache = LRUCache(PARTNER_CACHE_SIZE, PARTNER_CACHE_TTL)
+
+
+async def _get_partner_row(user_id: int):
+    row = partner_cache.get(user_id)
+    if row is not LRUCache._MISSING:
+        return row
+    generation = partner_cache.generation
+    async with engine.read() as db:
+        query = "SELECT status, full_name, phone_number, role, bitrix_deal_id FROM partners WHERE user_id = ?"
+        async with db.execute(query, (user_id,)) as cursor:
+            row = await cursor.fetchone()
+    row = tuple(row) if row else None
+    partner_cache.put(user_id, row, generation)
+    return row
+
+
 async def add_partner(user_id: int, full_name: str, phone_number: str, bitrix_deal_id: int, role: str):
     """Добавляет партнера с ролью. Исправлена ошибка аргументов."""
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with engine.write() as db:
         await db.execute(
             "INSERT INTO partners (user_id, full_name, phone_number, status, bitrix_deal_id, role) VALUES (?, ?, ?, 'pending', ?, ?)",
             (user_id, full_name, phone_number, bitrix_deal_id, role)
         )
-        await db.commit()
+    partner_cache.evict(user_id)
+    partner_cache.put(user_id, ('pending', full_name, phone_number, role, bitrix_deal_id))
+
+
+async def add_partner_with_job(user_id: int, full_name: str, phone_number: str, role: str,
+                               job_kind: str, job_payload: dict):
+    """
+    Сохраняет партнера без сделки (bitrix_deal_id = NULL) и, в той же транзакции,
+    задачу на создание сделки в Битрикс.
+    """
+    async with engine.write() as db:
+        await db.execute(
+            "INSERT INTO partners (user_id, full_name, phone_number, status, bitrix_deal_id, role) VALUES (?, ?, ?, 'pending', NULL, ?)",
+            (user_id, full_name, phone_number, role)
+        )
+        await _insert_job(db, job_kind, job_payload)
+    partner_cache.evict(user_id)
+    partner_cache.put(user_id, ('pending', full_name, phone_number, role, None))
+
+
+async def set_partner_deal_id(user_id: int, bitrix_deal_id: int):
+    async with engine.write() as db:
+        await db.execute("UPDATE partners SET bitrix_deal_id = ? WHERE user_id = ?", (bitrix_deal_id, user_id))
+    partner_cache.evict(user_id)
+
+
+async def delete_partner_without_deal(user_id: int) -> bool:
+    """Удаляет заявку партнера, только если сделка в Битрикс к ней еще не привязана."""
+    async with engine.write() as db:
+        cursor = await db.execute("DELETE FROM partners WHERE user_id = ? AND bitrix_deal_id IS NULL", (user_id,))
+        deleted = cursor.rowcount > 0
+    partner_cache.evict(user_id)
+    return deleted
 
 
 async def get_partner_status(user_id: int):
-    async with aiosqlite.connect(DB_NAME) as db:
-        async with db.execute("SELECT status FROM partners WHERE user_id = ?", (user_id,)) as cursor:
-            row = await cursor.fetchone()
-            return row[0] if row else None
+    row = await _get_partner_row(user_id)
+    return row[0] if row else None
 
 
 async def get_partner_data(user_id: int):
-    async with aiosqlite.connect(DB_NAME) as db:
-        # Выбираем роль. Если её нет (старая запись), вернется None
-        async with db.execute("SELECT full_name, phone_number, role FROM partners WHERE user_id = ?",
-                              (user_id,)) as cursor:
-            row = await cursor.fetchone()
-            if row:
-                # row[2] - это роль. Если колонка есть, но пустая -> None
-                return {"full_name": row[0], "phone_number": row[1], "role": row[2] if len(row) > 2 else None}
-            return None
+    row = await _get_partner_row(user_id)
+    if row:
+        # Роль может быть None (старая запись)
+        return {"full_name": row[1], "phone_number": row[2], "role": row[3]}
+    return None
 
 
 async def set_partner_status(user_id: int, status: str):
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with engine.write() as db:
         await db.execute("UPDATE partners SET status = ? WHERE user_id = ?", (status, user_id))
-        await db.commit()
+    # Запись в кэше устарела — при следующем чтении перечитаем из базы
+    partner_cache.evict(user_id)
+
+
+async def set_partner_status_with_job(user_id: int, status: str, job_kind: str, job_payload: dict):
+    """
+    Меняет статус партнера и, в той же транзакции, ставит задачу для Битрикс (outbox):
+    если бот упадет или Битрикс недоступен, задача выполнится позже и CRM догонит базу.
+    """
+    async with engine.write() as db:
+        await db.execute("UPDATE partners SET status = ? WHERE user_id = ?", (status, user_id))
+        await _insert_job(db, job_kind, job_payload)
+    partner_cache.evict(user_id)
 
 
 async def get_partner_deal_id_by_user_id(user_id: int):
-    async with aiosqlite.connect(DB_NAME) as db:
-        query = "SELECT bitrix_deal_id FROM partners WHERE user_id = ?"
-        async with db.execute(query, (user_id,)) as cursor:
-            row = await cursor.fetchone()
-            return row[0] if row else None
+    row = await _get_partner_row(user_id)
+    return row[4] if row else None
 
 
 # --- Клиенты ---
 
-async def add_client(partner_user_id: int, bitrix_deal_id: int, client_name: str, client_address: str):
-    async with aiosqlite.connect(DB_NAME) as db:
+async def add_client_with_job(partner_user_id: int, client_name: str, client_address: str,
+                              job_kind: str, job_payload: dict) -> int:
+    """
+    Сохраняет клиента в статусе 'pending' (сделки еще нет) и, в той же транзакции,
+    задачу на создание сделки. В payload задачи добавляется client_id.
+    """
+    async with engine.write() as db:
+        cursor = await db.execute(
+            "INSERT INTO clients (partner_user_id, bitrix_deal_id, client_name, client_address, status) VALUES (?, NULL, ?, ?, 'pending')",
+            (partner_user_id, client_name, client_address)
+        )
+        client_id = cursor.lastrowid
+        await _insert_job(db, job_kind, dict(job_payload, client_id=client_id))
+    return client_id
+
+
+async def confirm_client_deal(client_id: int, bitrix_deal_id: int):
+    """Сделка создана: привязываем ее к клиенту и переводим в статус 'new'."""
+    async with engine.write() as db:
         await db.execute(
-            "INSERT INTO clients (partner_user_id, bitrix_deal_id, client_name, client_address, status) VALUES (?, ?, ?, ?, 'new')",
-            (partner_user_id, bitrix_deal_id, client_name, client_address)
+            "UPDATE clients SET bitrix_deal_id = ?, status = 'new' WHERE client_id = ?",
+            (bitrix_deal_id, client_id)
         )
-        await db.commit()
+
+
+async def delete_client_without_deal(client_id: int) -> bool:
+    """Удаляет клиента, только если сделка в Битрикс к нему еще не привязана."""
+    async with engine.write() as db:
+        cursor = await db.execute("DELETE FROM clients WHERE client_id = ? AND bitrix_deal_id IS NULL", (client_id,))
+        return cursor.rowcount > 0
+
+
+async def get_client_deal_id(client_id: int):
+    async with engine.read() as db:
+        async with db.execute("SELECT bitrix_deal_id FROM clients WHERE client_id = ?", (client_id,)) as cursor:
+            row = await cursor.fetchone()
+            return row[0] if row else None
 
 
 async def get_partner_and_client_by_deal_id(bitrix_deal_id: int):
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with engine.read() as db:
         query = "SELECT partner_user_id, client_name FROM clients WHERE bitrix_deal_id = ?"
         async with db.execute(query, (bitrix_deal_id,)) as cursor:
             row = await cursor.fetchone()
@@ -153,42 +677,134 @@ async def get_partner_and_client_by_deal_id(bitrix_deal_id: int):
                 return None, None
 
 
-async def update_client_status_and_payout(bitrix_deal_id: int, new_status_name: str, payout: float = 0):
-    """Обновляет статус и сумму выплаты."""
-    async with aiosqlite.connect(DB_NAME) as db:
+async def get_client_deal_state(bitrix_deal_id: int):
+    """
+    Данные клиента по сделке для обработки смены стадии.
+    Возвращает словарь (partner_user_id, client_name, stage_id, opportunity) или None.
+    """
+    async with engine.read() as db:
+        query = "SELECT partner_user_id, client_name, stage_id, opportunity FROM clients WHERE bitrix_deal_id = ?"
+        async with db.execute(query, (bitrix_deal_id,)) as cursor:
+            row = await cursor.fetchone()
+            if row:
+                return {"partner_user_id": row[0], "client_name": row[1], "stage_id": row[2], "opportunity": row[3]}
+            return None
+
+
+async def update_client_status_and_payout(bitrix_deal_id: int, new_status_name: str, payout: float = 0,
+                                          stage_id: str = None, opportunity: float = None):
+    """Обновляет статус и сумму выплаты (и, если переданы, последние стадию и сумму сделки)."""
+    async with engine.write() as db:
         if payout > 0:
             query = "UPDATE clients SET status = ?, payout_amount = ? WHERE bitrix_deal_id = ?"
             await db.execute(query, (new_status_name, payout, bitrix_deal_id))
         else:
             query = "UPDATE clients SET status = ? WHERE bitrix_deal_id = ?"
             await db.execute(query, (new_status_name, bitrix_deal_id))
+        if stage_id is not None:
+            await db.execute("UPDATE clients SET stage_id = ?, opportunity = ? WHERE bitrix_deal_id = ?",
+                             (stage_id, opportunity, bitrix_deal_id))
 
-        await db.commit()
 
+async def recalculate_payouts(percent: float, lose_stage_id: str) -> int:
+    """
+    Пересчитывает выплаты всех клиентов по сохраненным снимкам сделок, без запросов в Битрикс.
+    Возвращает количество обновленных клиентов.
+    """
+    async with engine.write() as db:
+        query = """
+            UPDATE clients
+            SET payout_amount = CASE
+                WHEN stage_id = ? THEN 0
+                ELSE (SELECT s.opportunity FROM deal_snapshots s WHERE s.deal_id = clients.bitrix_deal_id) * ? / 100.0
+            END
+            WHERE bitrix_deal_id IN (SELECT deal_id FROM deal_snapshots WHERE opportunity IS NOT NULL)
+        """
+        cursor = await db.execute(query, (lose_stage_id, percent))
+        return cursor.rowcount
+
+
+async def apply_deal_updates(updates: list) -> int:
+    """
+    Применяет состояние сделок из Битрикс одной транзакцией (сверка при потерянных вебхуках).
+    updates: [(deal_id, stage_id, status_name, opportunity, payout, date_modify), ...]
+    Обновляются только клиенты, у которых стадия или сумма отличаются. Возвращает их количество.
+    """
+    if not updates:
+        return 0
+    now = time.time()
+    async with engine.write() as db:
+        changed = db.total_changes
+        await db.executemany(
+            """
+            UPDATE clients
+            SET status = ?, stage_id = ?, opportunity = ?,
+                payout_amount = CASE WHEN ? > 0 THEN ? ELSE payout_amount END
+            WHERE bitrix_deal_id = ? AND (stage_id IS NOT ? OR opportunity IS NOT ?)
+            """,
+            [(name, stage, opp, payout, payout, deal_id, stage, opp)
+             for deal_id, stage, name, opp, payout, _ in updates]
+        )
+        changed = db.total_changes - changed
+        await db.executemany(
+            """
+            INSERT INTO deal_snapshots (deal_id, stage_id, opportunity, date_modify, fetched_at)
+            SELECT ?, ?, ?, ?, ? WHERE EXISTS (SELECT 1 FROM clients WHERE bitrix_deal_id = ?)
+            ON CONFLICT (deal_id) DO UPDATE SET
+                stage_id = excluded.stage_id,
+                opportunity = excluded.opportunity,
+                date_modify = excluded.date_modify,
+                fetched_at = excluded.fetched_at
+            """,
+            [(deal_id, stage, opp, date_modify, now, deal_id) for deal_id, stage, _, opp, _, date_modify in updates]
+        )
+    for deal_id, *_ in updates:
+        deal_snapshot_cache.evict(deal_id)
+    return changed
+
+
+async def get_clients_by_partner_id(partner_user_id: int, limit: int = 5,
+                                    before_id: int = None, after_id: int = None):
+    """
+    Страница клиентов партнера, от новых к старым.
+    Пагинация по курсору: before_id — следующая страница (клиенты старше),
+    after_id — предыдущая (клиенты новее). Без курсора — первая страница.
+    Результат: список кортежей [(client_id, client_name, status, client_address), ...]
+    """
+    async with engine.read() as db:
+        if after_id is not None:
+            query = """
+                SELECT client_id, client_name, status, client_address
+                FROM clients
+                WHERE partner_user_id = ? AND client_id > ?
+                ORDER BY client_id ASC
+                LIMIT ?
+            """
+            async with db.execute(query, (partner_user_id, after_id, limit)) as cursor:
+                return list(reversed(await cursor.fetchall()))
 
-async def get_clients_by_partner_id(partner_user_id: int, limit: int = 5, offset: int = 0):
-    async with aiosqlite.connect(DB_NAME) as db:
         query = """
-            SELECT client_name, status, client_address 
-            FROM clients 
-            WHERE partner_user_id = ? 
-            ORDER BY client_id DESC 
-            LIMIT ? OFFSET ? 
+            SELECT client_id, client_name, status, client_address
+            FROM clients
+            WHERE partner_user_id = ? AND client_id < ?
+            ORDER BY client_id DESC
+            LIMIT ?
         """
-        async with db.execute(query, (partner_user_id, limit, offset)) as cursor:
+        cursor_id = before_id if before_id is not None else 2 ** 63 - 1
+        async with db.execute(query, (partner_user_id, cursor_id, limit)) as cursor:
             return await cursor.fetchall()
 
 
 async def count_clients_by_partner_id(partner_user_id: int):
-    async with aiosqlite.connect(DB_NAME) as db:
-        query = "SELECT COUNT(*) FROM clients WHERE partner_user_id = ?"
+    async with engine.read() as db:
+        query = "SELECT total FROM partner_client_counts WHERE partner_user_id = ?"
         async with db.execute(query, (partner_user_id,)) as cursor:
             row = await cursor.fetchone()
             return row[0] if row else 0
 
 
 async def get_partner_statistics(partner_user_id: int):
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with engine.read() as db:
         # 1. Общее количество
         async with db.execute("SELECT COUNT(*) FROM clients WHERE partner_user_id=?", (partner_user_id,)) as cur:
             total = (await cur.fetchone())[0]
@@ -203,79 +819,815 @@ async def get_partner_statistics(partner_user_id: int):
             "total_clients": total,
             "total_payout": total_payout
         }
-async def get_all_partner_ids(status: str = 'verified'):
+async def get_partner_payout_summary(partner_user_id: int, win_status: str, lose_status: str):
     """
-    Возвращает список Telegram ID партнеров с указанным статусом.
-    По умолчанию берем только 'verified' (активных).
+    Итоги для «Статистики» одним запросом.
+    win_status / lose_status — названия стадий «Договор заключен» и «Отказ» (как в clients.status).
     """
-    async with aiosqlite.connect(DB_NAME) as db:
-        query = "SELECT user_id FROM partners WHERE status = ?"
-        async with db.execute(query, (status,)) as cursor:
-            rows = await cursor.fetchall()
-            # Превращаем список кортежей [(123,), (456,)] в простой список [123, 456]
-            return [row[0] for row in rows]
-async def get_all_partner_clients(partner_user_id: int):
+    async with engine.read() as db:
+        query = """
+            SELECT
+                COUNT(*),
+                COALESCE(SUM(CASE WHEN status = ? THEN payout_amount END), 0),
+                COALESCE(SUM(CASE WHEN status = ? THEN payout_amount END), 0),
+                COALESCE(SUM(CASE WHEN status IS NULL OR status NOT IN (?, ?) THEN payout_amount END), 0)
+            FROM clients
+            WHERE partner_user_id = ?
+        """
+        params = (win_status, lose_status, win_status, lose_status, partner_user_id)
+        async with db.execute(query, params) as cursor:
+            row = await cursor.fetchone()
+            return {
+                "total_clients": row[0],
+                "on_approval": row[1],
+                "lost": row[2],
+                "in_work": row[3],
+            }
+
+
+async def get_partner_clients_page(partner_user_id: int, before_id: int = None, limit: int = 50):
     """
-    Возвращает список ВСЕХ клиентов партнера для статистики.
-    Результат: список кортежей [(client_name, status, payout_amount), ...]
+    Порция клиентов партнера для детализации, от новых к старым (курсор — client_id).
+    Результат: список кортежей [(client_id, client_name, status, payout_amount), ...]
     """
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with engine.read() as db:
         query = """
-            SELECT client_name, status, payout_amount 
-            FROM clients 
-            WHERE partner_user_id = ?
+            SELECT client_id, client_name, status, payout_amount
+            FROM clients
+            WHERE partner_user_id = ? AND client_id < ?
             ORDER BY client_id DESC
+            LIMIT ?
         """
-        async with db.execute(query, (partner_user_id,)) as cursor:
+        cursor_id = before_id if before_id is not None else 2 ** 63 - 1
+        async with db.execute(query, (partner_user_id, cursor_id, limit)) as cursor:
             return await cursor.fetchall()
 
+# --- Снимки сделок ---
+
+# deal_id -> {'stage_id', 'opportunity', 'date_modify', 'fetched_at'} или None
+deal_snapshot_cache = LRUCache(DEAL_SNAPSHOT_CACHE_SIZE, DEAL_SNAPSHOT_CACHE_TTL)
+
+
+async def get_deal_snapshot(deal_id: int):
+    """Последнее известное состояние сделки (память, затем таблица deal_snapshots)."""
+    snapshot = deal_snapshot_cache.get(deal_id)
+    if snapshot is not LRUCache._MISSING:
+        return snapshot
+    generation = deal_snapshot_cache.generation
+    async with engine.read() as db:
+        query = "SELECT stage_id, opportunity, date_modify, fetched_at FROM deal_snapshots WHERE deal_id = ?"
+        async with db.execute(query, (deal_id,)) as cursor:
+            row = await cursor.fetchone()
+    snapshot = {"stage_id": row[0], "opportunity": row[1], "date_modify": row[2], "fetched_at": row[3]} if row else None
+    deal_snapshot_cache.put(deal_id, snapshot, generation)
+    return snapshot
+
+
+async def save_deal_snapshot(deal_id: int, stage_id: str = None, opportunity: float = None, date_modify: str = None):
+    """Сохраняет состояние сделки. Непереданные поля остаются прежними."""
+    fetched_at = time.time()
+    async with engine.write() as db:
+        await db.execute(
+            """
+            INSERT INTO deal_snapshots (deal_id, stage_id, opportunity, date_modify, fetched_at)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (deal_id) DO UPDATE SET
+                stage_id = COALESCE(excluded.stage_id, stage_id),
+                opportunity = COALESCE(excluded.opportunity, opportunity),
+                date_modify = COALESCE(excluded.date_modify, date_modify),
+                fetched_at = excluded.fetched_at
+            """,
+            (deal_id, stage_id, opportunity, date_modify, fetched_at)
+        )
+    deal_snapshot_cache.evict(deal_id)
+
+
 # --- Админы и Настройки ---
+async def _load_admin_roles():
+    async with engine.read() as db:
+        async with db.execute("SELECT user_id, role FROM admins") as cursor:
+            return {row[0]: row[1] for row in await cursor.fetchall()}
+
+
+# Роли админов: user_id -> 'junior' | 'senior'
+admin_roles = SnapshotCache(_load_admin_roles, ADMIN_CACHE_TTL)
+
+
 async def add_admin(user_id: int, username: str = "", role: str = 'junior'):
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with engine.write() as db:
         await db.execute("INSERT OR REPLACE INTO admins (user_id, username, role) VALUES (?, ?, ?)",
                          (user_id, username, role))
-        await db.commit()
+    admin_roles.set(user_id, role)
 
 
 async def list_admins():
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with engine.read() as db:
         async with db.execute("SELECT user_id, username, role FROM admins") as cursor:
             return await cursor.fetchall()
 
 
 async def get_admin_role(user_id: int):
-    async with aiosqlite.connect(DB_NAME) as db:
-        async with db.execute("SELECT role FROM admins WHERE user_id = ?", (user_id,)) as cursor:
-            row = await cursor.fetchone()
-            return row[0] if row else None
+    """Роль админа из кэша (без обращения к диску, пока не истек TTL)."""
+    return await admin_roles.get(user_id)
 
 
 async def remove_admin(user_id: int):
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with engine.write() as db:
         await db.execute("DELETE FROM admins WHERE user_id = ?", (user_id,))
-        await db.commit()
+    admin_roles.discard(user_id)
 
 
 async def get_all_admin_ids():
-    async with aiosqlite.connect(DB_NAME) as db:
+    async with engine.read() as db:
         async with db.execute("SELECT user_id FROM admins") as cursor:
             return [row[0] for row in await cursor.fetchall()]
 
 
 async def get_junior_admin_ids():
-    async with aiosqlite.connect(DB_NAME) as db:
-        async with db.execute("SELECT user_id FROM admins WHERE role = 'junior'") as cursor:
+    async with engine.read() as db:
+        query = f"SELECT user_id FROM admins WHERE role = 'junior' AND {REACHABLE_USER_SQL}"
+        async with db.execute(query) as cursor:
             return [row[0] for row in await cursor.fetchall()]
 
 
+_settings_version = None  # Версия настроек, с которой загружен кэш
+
+
+async def _read_settings_version(db):
+    async with db.execute("SELECT value FROM sync_state WHERE name = ?", (SETTINGS_VERSION,)) as cursor:
+        row = await cursor.fetchone()
+        return row[0] if row else None
+
+
+async def _load_settings():
+    global _settings_version
+    async with engine.read() as db:
+        # Версию читаем первой: если настройки поменяют между запросами, перечитаем их при следующей проверке
+        _settings_version = await _read_settings_version(db)
+        async with db.execute("SELECT key, value FROM settings") as cursor:
+            return {row[0]: row[1] for row in await cursor.fetchall()}
+
+
+# Настройки (тексты, процент выплат) меняются редко — держим всю таблицу в памяти без TTL
+settings_cache = SnapshotCache(_load_settings, float('inf'))
+
+
 async def get_setting(key: str, default: str = "") -> str:
-    async with aiosqlite.connect(DB_NAME) as db:
-        async with db.execute("SELECT value FROM settings WHERE key = ?", (key,)) as cursor:
-            row = await cursor.fetchone()
-            return row[0] if row else default
+    return await settings_cache.get(key, default)
 
 
 async def set_setting(key: str, value: str):
-    async with aiosqlite.connect(DB_NAME) as db:
+    global _settings_version
+    async with engine.write() as db:
         await db.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, value))
-        await db.commit()
\ No newline at end of file
+        async with db.execute(
+            """
+            INSERT INTO sync_state (name, value) VALUES (?, '1')
+            ON CONFLICT (name) DO UPDATE SET value = CAST(value AS INTEGER) + 1
+            RETURNING value
+            """,
+            (SETTINGS_VERSION,)
+        ) as cursor:
+            version = (await cursor.fetchone())[0]
+    settings_cache.set(key, value)
+    _settings_version = version
+
+
+async def refresh_settings():
+    """
+    Перечитывает настройки, если их изменил другой процесс бота (по счетчику версии).
+    Возвращает True, если кэш обновлен.
+    """
+    async with engine.read() as db:
+        version = await _read_settings_version(db)
+    if version == _settings_version:
+        return False
+    await settings_cache.load()
+    return True
+
+
+# --- Рассылки ---
+
+async def create_broadcast(admin_id: int, text: str, status: str = 'verified'):
+    """
+    Создает рассылку и список получателей (все партнеры с указанным статусом, кроме заблокировавших бота).
+    Возвращает (broadcast_id, количество получателей).
+    """
+    async with engine.write() as db:
+        cursor = await db.execute("INSERT INTO broadcasts (admin_id, text) VALUES (?, ?)", (admin_id, text))
+        broadcast_id = cursor.lastrowid
+        cursor = await db.execute(
+            f"""
+            INSERT INTO broadcast_deliveries (broadcast_id, user_id)
+            SELECT ?, user_id FROM partners WHERE status = ? AND {REACHABLE_USER_SQL}
+            """,
+            (broadcast_id, status)
+        )
+        total = cursor.rowcount
+        if total == 0:
+            await db.execute("UPDATE broadcasts SET status = 'done' WHERE broadcast_id = ?", (broadcast_id,))
+    return broadcast_id, total
+
+
+async def set_broadcast_progress_message(broadcast_id: int, chat_id: int, message_id: int):
+    async with engine.write() as db:
+        await db.execute(
+            "UPDATE broadcasts SET progress_chat_id = ?, progress_message_id = ? WHERE broadcast_id = ?",
+            (chat_id, message_id, broadcast_id)
+        )
+
+
+async def get_broadcast(broadcast_id: int):
+    """Возвращает словарь с данными рассылки или None."""
+    async with engine.read() as db:
+        query = """
+            SELECT admin_id, text, status, progress_chat_id, progress_message_id
+            FROM broadcasts
+            WHERE broadcast_id = ?
+        """
+        async with db.execute(query, (broadcast_id,)) as cursor:
+            row = await cursor.fetchone()
+            if row:
+                return {"admin_id": row[0], "text": row[1], "status": row[2],
+                        "progress_chat_id": row[3], "progress_message_id": row[4]}
+            return None
+
+
+async def get_unfinished_broadcast_ids():
+    async with engine.read() as db:
+        async with db.execute("SELECT broadcast_id FROM broadcasts WHERE status = 'running'") as cursor:
+            return [row[0] for row in await cursor.fetchall()]
+
+
+async def get_pending_broadcast_recipients(broadcast_id: int, limit: int):
+    async with engine.read() as db:
+        query = "SELECT user_id FROM broadcast_deliveries WHERE broadcast_id = ? AND status = 'pending' LIMIT ?"
+        async with db.execute(query, (broadcast_id, limit)) as cursor:
+            return [row[0] for row in await cursor.fetchall()]
+
+
+async def mark_broadcast_deliveries(broadcast_id: int, results: list):
+    """Сохраняет итоги доставки пачкой. results: [(user_id, status, error), ...]"""
+    if not results:
+        return
+    async with engine.write() as db:
+        await db.executemany(
+            "UPDATE broadcast_deliveries SET status = ?, error = ? WHERE broadcast_id = ? AND user_id = ?",
+            [(status, error, broadcast_id, user_id) for user_id, status, error in results]
+        )
+
+
+async def count_broadcast_deliveries(broadcast_id: int) -> dict:
+    """Количество получателей по статусам: {'pending': 10, 'sent': 90, ...}"""
+    async with engine.read() as db:
+        query = "SELECT status, COUNT(*) FROM broadcast_deliveries WHERE broadcast_id = ? GROUP BY status"
+        async with db.execute(query, (broadcast_id,)) as cursor:
+            return {row[0]: row[1] for row in await cursor.fetchall()}
+
+
+async def finish_broadcast(broadcast_id: int):
+    async with engine.write() as db:
+        await db.execute("UPDATE broadcasts SET status = 'done' WHERE broadcast_id = ?", (broadcast_id,))
+
+
+# --- Доступность чатов ---
+
+async def mark_chat_unreachable(chat_id: int, error: str = None):
+    """Пользователь заблокировал бота — больше ему не пишем (до /start)."""
+    async with engine.write() as db:
+        await db.execute(
+            """
+            INSERT INTO chat_reachability (chat_id, blocked_at, error) VALUES (?, ?, ?)
+            ON CONFLICT(chat_id) DO UPDATE SET blocked_at = excluded.blocked_at, error = excluded.error
+            """,
+            (chat_id, time.time(), error)
+        )
+
+
+async def is_chat_reachable(chat_id: int) -> bool:
+    async with engine.read() as db:
+        async with db.execute("SELECT 1 FROM chat_reachability WHERE chat_id = ?", (chat_id,)) as cursor:
+            return await cursor.fetchone() is None
+
+
+async def mark_chat_reachable(chat_id: int) -> bool:
+    """
+    Снимает отметку о блокировке. Возвращает True, если она была.
+    Вызывается на каждый /start, поэтому транзакция записи — только если отметка есть.
+    """
+    if await is_chat_reachable(chat_id):
+        return False
+    async with engine.write() as db:
+        cursor = await db.execute("DELETE FROM chat_reachability WHERE chat_id = ?", (chat_id,))
+        return cursor.rowcount > 0
+
+
+async def count_unreachable_chats() -> int:
+    async with engine.read() as db:
+        async with db.execute("SELECT COUNT(*) FROM chat_reachability") as cursor:
+            return (await cursor.fetchone())[0]
+
+
+# --- Уведомления ---
+
+async def create_notification(kind: str, ref: str, text: str, markup: str, user_ids: list) -> int:
+    """
+    Сохраняет уведомление и список получателей. Получатели, заблокировавшие бота
+    (см. chat_reachability), сразу помечаются 'skipped'.
+    Возвращает notification_id.
+    """
+    now = time.time()
+    async with engine.write() as db:
+        cursor = await db.execute(
+            "INSERT INTO notifications (kind, ref, text, markup, created_at) VALUES (?, ?, ?, ?, ?)",
+            (kind, ref, text, markup, now)
+        )
+        notification_id = cursor.lastrowid
+        await db.executemany(
+            """
+            INSERT OR IGNORE INTO notification_deliveries (notification_id, user_id, status, updated_at)
+            VALUES (?1, ?2, CASE WHEN EXISTS (SELECT 1 FROM chat_reachability WHERE chat_id = ?2)
+                THEN 'skipped' ELSE 'pending' END, ?3)
+            """,
+            [(notification_id, user_id, now) for user_id in user_ids]
+        )
+    return notification_id
+
+
+async def get_notification(notification_id: int):
+    """Возвращает словарь с данными уведомления или None."""
+    async with engine.read() as db:
+        query = "SELECT kind, ref, text, markup FROM notifications WHERE notification_id = ?"
+        async with db.execute(query, (notification_id,)) as cursor:
+            row = await cursor.fetchone()
+            if row:
+                return {"kind": row[0], "ref": row[1], "text": row[2], "markup": row[3]}
+            return None
+
+
+async def get_pending_notification_recipients(notification_id: int):
+    async with engine.read() as db:
+        query = "SELECT user_id FROM notification_deliveries WHERE notification_id = ? AND status = 'pending'"
+        async with db.execute(query, (notification_id,)) as cursor:
+            return [row[0] for row in await cursor.fetchall()]
+
+
+async def get_unfinished_notification_ids():
+    async with engine.read() as db:
+        query = "SELECT DISTINCT notification_id FROM notification_deliveries WHERE status = 'pending'"
+        async with db.execute(query) as cursor:
+            return [row[0] for row in await cursor.fetchall()]
+
+
+async def mark_notification_deliveries(notification_id: int, results: list):
+    """Сохраняет итоги доставки. results: [(user_id, status, message_id, error), ...]"""
+    if not results:
+        return
+    now = time.time()
+    async with engine.write() as db:
+        await db.executemany(
+            """
+            UPDATE notification_deliveries SET status = ?, message_id = ?, error = ?, updated_at = ?
+            WHERE notification_id = ? AND user_id = ?
+            """,
+            [(status, message_id, error, now, notification_id, user_id)
+             for user_id, status, message_id, error in results]
+        )
+
+
+async def get_delivered_notification_copies(kind: str, ref: str):
+    """Доставленные копии уведомлений вида kind по объекту ref: [(user_id, message_id, text), ...]"""
+    async with engine.read() as db:
+        query = """
+            SELECT d.user_id, d.message_id, n.text
+            FROM notifications n
+            JOIN notification_deliveries d ON d.notification_id = n.notification_id
+            WHERE n.kind = ? AND n.ref = ? AND d.status = 'sent' AND d.message_id IS NOT NULL
+        """
+        async with db.execute(query, (kind, ref)) as cursor:
+            return await cursor.fetchall()
+
+
+# --- Входящие вебхуки Битрикс ---
+
+async def append_webhook_event(key: str, dedup_key: str, payload: dict, dedup_window: float,
+                               by_delivery_id: bool = False) -> bool:
+    """
+    Дописывает событие в журнал. Дубль (сохраняется со статусом 'duplicate'), если за последние
+    dedup_window секунд:
+    - by_delivery_id=True (dedup_key — ID доставки): событие с тем же dedup_key уже приходило;
+    - иначе (dedup_key — хеш содержимого): с тем же dedup_key пришло последнее событие по ключу.
+      Поэтому переходы A -> B -> A не теряются, а повторная доставка подряд отбрасывается.
+    Возвращает True, если событие новое.
+    """
+    now = time.time()
+    async with engine.write() as db:
+        query = """
+            INSERT INTO webhook_inbox (received_at, key, dedup_key, payload, status)
+            VALUES (?1, ?2, ?3, ?4, CASE WHEN (CASE WHEN ?6 THEN EXISTS (
+                SELECT 1 FROM webhook_inbox WHERE dedup_key = ?3 AND received_at > ?5 AND status != 'duplicate'
+            ) ELSE (
+                SELECT dedup_key = ?3 AND received_at > ?5 FROM webhook_inbox
+                WHERE key = ?2 AND status != 'duplicate' ORDER BY event_id DESC LIMIT 1
+            ) END) THEN 'duplicate' ELSE 'pending' END)
+            RETURNING status
+        """
+        params = (now, key, dedup_key, json.dumps(payload, ensure_ascii=False), now - dedup_window,
+                  by_delivery_id)
+        async with db.execute(query, params) as cursor:
+            return (await cursor.fetchone())[0] == 'pending'
+
+
+async def get_pending_webhook_keys():
+    """
+    Ключи с необработанными событиями:
+    [(key, последний event_id, первое получение, последнее получение, next_run_at), ...]
+    """
+    async with engine.read() as db:
+        query = """
+            SELECT key, MAX(event_id), MIN(received_at), MAX(received_at), MAX(next_run_at)
+            FROM webhook_inbox WHERE status = 'pending' GROUP BY key
+        """
+        async with db.execute(query) as cursor:
+            return await cursor.fetchall()
+
+
+async def claim_webhook_events(key: str, last_event_id: int):
+    """
+    Забирает в обработку события ключа до last_event_id включительно (status -> 'processing').
+    Возвращает (payload последнего события, попыток) или None, если их уже забрали.
+    """
+    async with engine.write() as db:
+        query = """
+            UPDATE webhook_inbox SET status = 'processing'
+            WHERE key = ? AND status = 'pending' AND event_id <= ?
+            RETURNING event_id, payload, attempts
+        """
+        async with db.execute(query, (key, last_event_id)) as cursor:
+            rows = await cursor.fetchall()
+    if not rows:
+        return None
+    _, payload, attempts = max(rows)
+    return json.loads(payload), attempts
+
+
+async def finish_webhook_events(key: str, last_event_id: int):
+    async with engine.write() as db:
+        await db.execute(
+            """
+            UPDATE webhook_inbox SET status = 'done', processed_at = ?, last_error = NULL
+            WHERE key = ? AND status = 'processing' AND event_id <= ?
+            """,
+            (time.time(), key, last_event_id)
+        )
+
+
+async def retry_webhook_events(key: str, last_event_id: int, next_run_at: float, error: str, failed: bool = False):
+    """Возвращает события в очередь с задержкой (или помечает 'failed', если попытки исчерпаны)."""
+    async with engine.write() as db:
+        await db.execute(
+            """
+            UPDATE webhook_inbox SET status = ?, attempts = attempts + 1, next_run_at = ?, last_error = ?
+            WHERE key = ? AND status = 'processing' AND event_id <= ?
+            """,
+            ('failed' if failed else 'pending', next_run_at, error, key, last_event_id)
+        )
+
+
+async def requeue_processing_webhook_events() -> int:
+    """События, обработка которых прервалась остановкой бота, снова ставятся в очередь."""
+    async with engine.write() as db:
+        cursor = await db.execute("UPDATE webhook_inbox SET status = 'pending' WHERE status = 'processing'")
+        return cursor.rowcount
+
+
+async def replay_webhook_events(since: float, until: float) -> int:
+    """
+    Повторно ставит в обработку события, полученные в интервале [since, until].
+    По каждому ключу берется только последнее событие интервала, и только если после него
+    по этому ключу ничего не приходило — иначе повтор откатил бы более новое состояние.
+    Возвращает число поставленных событий.
+    """
+    async with engine.write() as db:
+        cursor = await db.execute(
+            """
+            UPDATE webhook_inbox SET status = 'pending', attempts = 0, next_run_at = 0, last_error = NULL
+            WHERE event_id IN (
+                SELECT MAX(event_id) FROM webhook_inbox
+                WHERE received_at BETWEEN ? AND ? AND status != 'duplicate'
+                GROUP BY key
+            )
+            AND status IN ('done', 'failed')
+            AND NOT EXISTS (
+                SELECT 1 FROM webhook_inbox later
+                WHERE later.key = webhook_inbox.key AND later.event_id > webhook_inbox.event_id
+                  AND later.status != 'duplicate'
+            )
+            """,
+            (since, until)
+        )
+        return cursor.rowcount
+
+
+async def prune_webhook_events(before: float) -> int:
+    """Удаляет разобранные события (done/duplicate/failed), полученные раньше before."""
+    async with engine.write() as db:
+        cursor = await db.execute(
+            "DELETE FROM webhook_inbox WHERE received_at < ? AND status IN ('done', 'duplicate', 'failed')",
+            (before,)
+        )
+        return cursor.rowcount
+
+
+async def count_webhook_events() -> dict:
+    """Количество событий в журнале по статусам."""
+    async with engine.read() as db:
+        async with db.execute("SELECT status, COUNT(*) FROM webhook_inbox GROUP BY status") as cursor:
+            return {row[0]: row[1] for row in await cursor.fetchall()}
+
+
+# --- Очередь задач ---
+
+async def _insert_job(db, kind: str, payload: dict, delay: float = 0) -> int:
+    cursor = await db.execute(
+        "INSERT INTO jobs (kind, payload, next_run_at) VALUES (?, ?, ?)",
+        (kind, json.dumps(payload, ensure_ascii=False), time.time() + delay)
+    )
+    return cursor.lastrowid
+
+
+async def enqueue_job(kind: str, payload: dict, delay: float = 0) -> int:
+    async with engine.write() as db:
+        return await _insert_job(db, kind, payload, delay)
+
+
+async def claim_job():
+    """
+    Забирает одну готовую к запуску задачу (status -> 'running', attempts + 1).
+    Возвращает (job_id, kind, payload, attempts) или None.
+    """
+    async with engine.write() as db:
+        query = """
+            UPDATE jobs SET status = 'running', attempts = attempts + 1
+            WHERE job_id = (
+                SELECT job_id FROM jobs
+                WHERE status = 'pending' AND next_run_at <= ?
+                ORDER BY next_run_at
+                LIMIT 1
+            )
+            RETURNING job_id, kind, payload, attempts
+        """
+        async with db.execute(query, (time.time(),)) as cursor:
+            row = await cursor.fetchone()
+    if row:
+        return row[0], row[1], json.loads(row[2]), row[3]
+    return None
+
+
+async def complete_job(job_id: int):
+    async with engine.write() as db:
+        await db.execute("DELETE FROM jobs WHERE job_id = ?", (job_id,))
+
+
+async def retry_job(job_id: int, next_run_at: float, error: str):
+    async with engine.write() as db:
+        await db.execute(
+            "UPDATE jobs SET status = 'pending', next_run_at = ?, last_error = ? WHERE job_id = ?",
+            (next_run_at, error, job_id)
+        )
+
+
+async def fail_job(job_id: int, error: str):
+    async with engine.write() as db:
+        await db.execute("UPDATE jobs SET status = 'failed', last_error = ? WHERE job_id = ?", (error, job_id))
+
+
+async def has_unfinished_job(kind: str, user_id: int) -> bool:
+    """Есть ли невыполненная задача kind с payload.user_id = user_id."""
+    async with engine.read() as db:
+        query = """
+            SELECT 1 FROM jobs
+            WHERE kind = ? AND status IN ('pending', 'running') AND json_extract(payload, '$.user_id') = ?
+            LIMIT 1
+        """
+        async with db.execute(query, (kind, user_id)) as cursor:
+            return await cursor.fetchone() is not None
+
+
+async def prune_failed_jobs(older_than_days: float) -> int:
+    """Удаляет проваленные задачи старше older_than_days (выполненные удаляются сразу, см. complete_job)."""
+    async with engine.write() as db:
+        cursor = await db.execute(
+            "DELETE FROM jobs WHERE status = 'failed' AND created_at < datetime('now', ?)",
+            (f"-{older_than_days} days",)
+        )
+        return cursor.rowcount
+
+
+async def requeue_running_jobs():
+    """Возвращает в очередь задачи, прерванные остановкой бота."""
+    async with engine.write() as db:
+        await db.execute("UPDATE jobs SET status = 'pending' WHERE status = 'running'")
+
+
+# --- Индекс телефонов ---
+
+async def get_phone_contact(phone: str):
+    """Возвращает (найден ли телефон в индексе, contact_id или None)."""
+    async with engine.read() as db:
+        async with db.execute("SELECT contact_id FROM phone_index WHERE phone = ?", (phone,)) as cursor:
+            row = await cursor.fetchone()
+            return (True, row[0]) if row else (False, None)
+
+
+async def add_phones(rows: list):
+    """Добавляет телефоны в индекс пачкой. rows: [(phone, contact_id), ...]"""
+    if not rows:
+        return
+    async with engine.write() as db:
+        await db.executemany(
+            """
+            INSERT INTO phone_index (phone, contact_id) VALUES (?, ?)
+            ON CONFLICT (phone) DO UPDATE SET contact_id = COALESCE(excluded.contact_id, contact_id)
+            """,
+            rows
+        )
+
+
+async def iter_indexed_phones(after_rowid: int = 0, batch_size: int = 10_000):
+    """
+    Перебирает телефоны индекса порциями в порядке добавления: (rowid, phone).
+    after_rowid — последний уже загруженный rowid (для подгрузки только новых записей).
+    """
+    last = after_rowid
+    while True:
+        async with engine.read() as db:
+            query = "SELECT rowid, phone FROM phone_index WHERE rowid > ? ORDER BY rowid LIMIT ?"
+            async with db.execute(query, (last, batch_size)) as cursor:
+                rows = await cursor.fetchall()
+        if not rows:
+            return
+        for row in rows:
+            yield row
+        last = rows[-1][0]
+
+
+# --- Состояние синхронизаций ---
+
+async def get_sync_state(name: str, default: str = None):
+    async with engine.read() as db:
+        async with db.execute("SELECT value FROM sync_state WHERE name = ?", (name,)) as cursor:
+            row = await cursor.fetchone()
+            return row[0] if row else default
+
+
+async def set_sync_state(name: str, value: str):
+    async with engine.write() as db:
+        await db.execute("INSERT OR REPLACE INTO sync_state (name, value) VALUES (?, ?)", (name, value))
+
+
+# --- Импорт и экспорт (см. import_export.py) ---
+
+# Порядок колонок в строках iter_*/import_*
+PARTNER_COLUMNS = ("user_id", "full_name", "phone_number", "status", "bitrix_deal_id", "role")
+CLIENT_COLUMNS = ("client_id", "partner_user_id", "bitrix_deal_id", "client_name", "client_address",
+                  "status", "payout_amount", "stage_id", "opportunity")
+
+
+async def _iter_rows(table: str, columns: tuple, batch_size: int):
+    """Перебирает таблицу порциями по первичному ключу (первая колонка), не держа ее в памяти."""
+    key = columns[0]
+    query = f"SELECT {', '.join(columns)} FROM {table} WHERE {key} > ? ORDER BY {key} LIMIT ?"
+    last = -1 << 63
+    while True:
+        async with engine.read() as db:
+            async with db.execute(query, (last, batch_size)) as cursor:
+                rows = await cursor.fetchall()
+        if not rows:
+            return
+        for row in rows:
+            yield row
+        last = rows[-1][0]
+
+
+def iter_partners(batch_size: int = 5000):
+    return _iter_rows("partners", PARTNER_COLUMNS, batch_size)
+
+
+def iter_clients(batch_size: int = 5000):
+    return _iter_rows("clients", CLIENT_COLUMNS, batch_size)
+
+
+async def import_partners(rows: list):
+    """
+    Добавляет или обновляет партнеров одной транзакцией. rows — кортежи в порядке PARTNER_COLUMNS.
+    Пустые (None) поля не затирают данные уже существующего партнера; новый получает статус 'pending'.
+    """
+    if any(row[0] is None for row in rows):
+        # Иначе SQLite сам выдаст rowid, и он станет Telegram ID партнера
+        raise ValueError("У партнера нет user_id")
+    async with engine.write() as db:
+        await db.executemany(
+            """
+            INSERT INTO partners (user_id, full_name, phone_number, status, bitrix_deal_id, role)
+            VALUES (?1, ?2, ?3, COALESCE(?4, 'pending'), ?5, ?6)
+            ON CONFLICT (user_id) DO UPDATE SET
+                full_name = COALESCE(?2, full_name),
+                phone_number = COALESCE(?3, phone_number),
+                status = COALESCE(?4, status),
+                bitrix_deal_id = COALESCE(?5, bitrix_deal_id),
+                role = COALESCE(?6, role)
+            """,
+            rows
+        )
+    for row in rows:
+        partner_cache.evict(row[0])
+
+
+async def import_clients(rows: list):
+    """
+    Добавляет клиентов одной транзакцией. rows — кортежи в порядке CLIENT_COLUMNS;
+    client_id = None — новый клиент, существующие client_id пропускаются.
+    """
+    async with engine.write() as db:
+        await db.executemany(
+            f"""
+            INSERT INTO clients ({', '.join(CLIENT_COLUMNS)}) VALUES ({', '.join('?' * len(CLIENT_COLUMNS))})
+            ON CONFLICT (client_id) DO NOTHING
+            """,
+            rows
+        )
+
+
+async def set_partner_deal_ids(pairs: list):
+    """Привязывает созданные сделки пачкой: pairs — [(bitrix_deal_id, user_id), ...]."""
+    async with engine.write() as db:
+        await db.executemany("UPDATE partners SET bitrix_deal_id = ? WHERE user_id = ?", pairs)
+    for _, user_id in pairs:
+        partner_cache.evict(user_id)
+
+
+# --- Блокировки чатов (несколько реплик) ---
+
+async def acquire_chat_lease(chat_key: str, owner: str, ttl: float) -> bool:
+    """Занимает чат на ttl секунд. False — чат занят другой репликой и блокировка не истекла."""
+    now = time.time()
+    async with engine.write() as db:
+        query = """
+            INSERT INTO chat_leases (chat_key, owner, expires_at) VALUES (?1, ?2, ?3)
+            ON CONFLICT (chat_key) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+            WHERE chat_leases.owner = excluded.owner OR chat_leases.expires_at < ?4
+            RETURNING owner
+        """
+        async with db.execute(query, (chat_key, owner, now + ttl, now)) as cursor:
+            return await cursor.fetchone() is not None
+
+
+async def release_chat_lease(chat_key: str, owner: str):
+    async with engine.write() as db:
+        await db.execute("DELETE FROM chat_leases WHERE chat_key = ? AND owner = ?", (chat_key, owner))
+
+
+# --- Состояния FSM ---
+
+async def get_fsm_record(key: str):
+    """Возвращает (state, data_json) или None, если записи нет."""
+    async with engine.read() as db:
+        async with db.execute("SELECT state, data FROM fsm_states WHERE key = ?", (key,)) as cursor:
+            return await cursor.fetchone()
+
+
+async def set_fsm_state(key: str, state):
+    async with engine.write() as db:
+        await db.execute(
+            """
+            INSERT INTO fsm_states (key, state, updated_at) VALUES (?, ?, ?)
+            ON CONFLICT (key) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at
+            """,
+            (key, state, time.time())
+        )
+        # Пустая запись (state.clear()) не нужна
+        await db.execute("DELETE FROM fsm_states WHERE key = ? AND state IS NULL AND data = '{}'", (key,))
+
+
+async def set_fsm_data(key: str, data: str):
+    async with engine.write() as db:
+        await db.execute(
+            """
+            INSERT INTO fsm_states (key, data, updated_at) VALUES (?, ?, ?)
+            ON CONFLICT (key) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at
+            """,
+            (key, data, time.time())
+        )
+        await db.execute("DELETE FROM fsm_states WHERE key = ? AND state IS NULL AND data = '{}'", (key,))
+
+
+async def count_fsm_sessions() -> int:
+    """Сколько пользователей сейчас внутри сценария."""
+    async with engine.read() as db:
+        async with db.execute("SELECT COUNT(*) FROM fsm_states WHERE state IS NOT NULL") as cursor:
+            return (await cursor.fetchone())[0]
+
+
+# Время и ошибки всех публичных функций модуля — в метрики (/metrics)
+metrics.instrument_module(globals(), metrics.DB_SECONDS, metrics.DB_ERRORS)
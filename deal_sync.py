@@ -0,0 +1,96 @@
+# deal_sync.py
+import asyncio
+import logging
+
+import bitrix_api
+import config
+import database as db
+
+# Водяной знак сверки сделок в таблице sync_state
+SYNC_STATE_NAME = "deals_date_modify"
+
+
+class DealSync:
+    """
+    Периодическая сверка сделок воронки клиентов с локальной базой.
+    Забирает из Битрикс только сделки, измененные с прошлого раза (по DATE_MODIFY),
+    и применяет их постранично одной транзакцией на страницу. Водяной знак сохраняется
+    после каждой страницы, поэтому после рестарта сверка продолжается с места остановки.
+    Уведомления партнерам здесь не отправляются — только исправляется расхождение данных.
+    """
+
+    def __init__(self, stage_name, skip=None, interval: float = config.DEAL_SYNC_INTERVAL,
+                 page_delay: float = config.DEAL_SYNC_PAGE_DELAY):
+        self._stage_name = stage_name  # (stage_id) -> название стадии для clients.status
+        self._skip = skip  # (deal_id) -> True, если сделку сейчас обрабатывает вебхук
+        self.interval = interval
+        self.page_delay = page_delay
+        self._task = None
+        self.runs = 0
+        self.fetched = 0
+        self.updated = 0
+
+    def start(self):
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def stats(self) -> dict:
+        return {"runs": self.runs, "fetched": self.fetched, "updated": self.updated}
+
+    async def sync(self):
+        """Один проход сверки. Возвращает количество исправленных клиентов."""
+        since = await db.get_sync_state(SYNC_STATE_NAME) or None
+        try:
+            percent = float(await db.get_setting("payout_percent", "0"))
+        except ValueError:
+            percent = 0.0
+
+        start = 0
+        updated = 0
+        while True:
+            page = await bitrix_api.list_client_deals_modified_since(since, start)
+            if page is None:
+                break  # Ошибка — продолжим с сохраненного водяного знака в следующий раз
+            deals, next_start = page
+            self.fetched += len(deals)
+
+            rows = []
+            watermark = None
+            for deal in deals:
+                deal_id = int(deal['ID'])
+                watermark = deal.get('DATE_MODIFY') or watermark
+                if self._skip and self._skip(deal_id):
+                    continue
+                stage_id = deal.get('STAGE_ID')
+                opportunity = float(deal.get('OPPORTUNITY') or 0)
+                payout = 0.0 if stage_id == config.BITRIX_CLIENT_STAGE_LOSE else opportunity * percent / 100.0
+                rows.append((deal_id, stage_id, self._stage_name(stage_id), opportunity, payout,
+                             deal.get('DATE_MODIFY')))
+            updated += await db.apply_deal_updates(rows)
+            if watermark:
+                await db.set_sync_state(SYNC_STATE_NAME, watermark)
+
+            if next_start is None:
+                break
+            start = next_start
+            # Фоновая задача не должна съедать лимит запросов к Битрикс
+            await asyncio.sleep(self.page_delay)
+
+        self.runs += 1
+        self.updated += updated
+        if updated:
+            logging.info(f"Сверка сделок: исправлено клиентов: {updated}")
+        return updated
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.sync()
+            except Exception as e:
+                logging.error(f"Ошибка сверки сделок: {e}", exc_info=True)
+            await asyncio.sleep(self.interval)
@@ -0,0 +1,60 @@
+# fsm_storage.py
+import json
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+import database as db
+
+
+def create_key_builder() -> DefaultKeyBuilder:
+    """Одинаковые ключи во всех хранилищах — чтобы их можно было менять местами."""
+    return DefaultKeyBuilder(with_bot_id=True, with_business_connection_id=True, with_destiny=True)
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    Хранилище FSM в таблице fsm_states: незаконченная регистрация или передача клиента
+    переживает рестарт, а несколько реплик бота с общей базой видят одно и то же состояние.
+    """
+
+    def __init__(self):
+        self.key_builder = create_key_builder()
+
+    async def set_state(self, key: StorageKey, state=None) -> None:
+        await db.set_fsm_state(self.key_builder.build(key), state.state if isinstance(state, State) else state)
+
+    async def get_state(self, key: StorageKey):
+        record = await db.get_fsm_record(self.key_builder.build(key))
+        return record[0] if record else None
+
+    async def set_data(self, key: StorageKey, data) -> None:
+        await db.set_fsm_data(self.key_builder.build(key), json.dumps(dict(data), ensure_ascii=False))
+
+    async def get_data(self, key: StorageKey) -> dict:
+        record = await db.get_fsm_record(self.key_builder.build(key))
+        return json.loads(record[1]) if record else {}
+
+    async def count_active(self) -> int:
+        return await db.count_fsm_sessions()
+
+    async def close(self) -> None:
+        # Соединения с базой закрывает db.close_db()
+        pass
+
+
+def create_storage(url: str) -> BaseStorage:
+    """
+    Хранилище FSM по настройке FSM_STORAGE:
+    'sqlite' — в базе бота (по умолчанию), 'memory' — в памяти процесса (одна реплика, без рестартов),
+    'redis://...' — общий Redis для реплик на разных серверах (нужен пакет redis).
+    """
+    if url == "sqlite":
+        return SQLiteStorage()
+    if url == "memory":
+        return MemoryStorage()
+    if url.startswith(("redis://", "rediss://")):
+        from aiogram.fsm.storage.redis import RedisStorage
+        return RedisStorage.from_url(url, key_builder=create_key_builder())
+    raise ValueError(f"Неизвестное хранилище FSM: {url}")
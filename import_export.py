@@ -0,0 +1,207 @@
+# import_export.py
+"""
+Массовый импорт и экспорт партнеров и клиентов (CSV или JSONL, формат — по расширению файла).
+
+    python import_export.py export partners partners.csv
+    python import_export.py export clients - --format jsonl       # в stdout
+    python import_export.py import partners realtors.csv --create-deals
+    python import_export.py import clients clients.jsonl
+
+Файлы читаются и пишутся потоково, в базу строки идут пачками по --chunk в одной
+транзакции, поэтому память не растет с размером файла.
+--create-deals создает в Битрикс сделки для импортированных партнеров без сделки
+(не больше --concurrency запросов одновременно; они собираются в batch-запросы).
+Строки без обязательных колонок или с нечисловыми ID пропускаются с указанием номера строки,
+код выхода тогда 1. Для экспорта переменные окружения бота не нужны.
+"""
+import argparse
+import asyncio
+import csv
+import json
+import sys
+
+import database as db
+
+TABLES = {
+    "partners": (db.PARTNER_COLUMNS, db.iter_partners, db.import_partners),
+    "clients": (db.CLIENT_COLUMNS, db.iter_clients, db.import_clients),
+}
+
+# Колонки, которые в файле хранятся строками, а в базе — числами
+INT_COLUMNS = {"user_id", "bitrix_deal_id", "client_id", "partner_user_id"}
+FLOAT_COLUMNS = {"payout_amount", "opportunity"}
+# Колонки, без которых строку не импортируем
+REQUIRED_COLUMNS = {"partners": ("user_id", "full_name"), "clients": ("partner_user_id", "client_name")}
+# Значения по умолчанию, если колонки нет в файле
+# (для партнеров пустые поля не меняют существующую запись, см. db.import_partners)
+DEFAULTS = {"partners": {}, "clients": {"status": "new", "payout_amount": 0}}
+
+
+def _detect_format(path: str, fmt: str = None) -> str:
+    if fmt:
+        return fmt
+    return "jsonl" if path.endswith((".jsonl", ".ndjson")) else "csv"
+
+
+def _open(path: str, mode: str):
+    if path == "-":
+        return sys.stdin if mode == "r" else sys.stdout
+    return open(path, mode, encoding="utf-8", newline="")
+
+
+def _read_records(stream, fmt: str):
+    """Построчно отдает (номер строки в файле, словарь или ValueError, если строку не разобрать)."""
+    if fmt == "csv":
+        reader = csv.DictReader(stream)
+        for record in reader:
+            yield reader.line_num, record
+    else:
+        for line_no, line in enumerate(stream, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                yield line_no, ValueError(f"некорректный JSON: {e}")
+                continue
+            yield line_no, record if isinstance(record, dict) else ValueError("ожидался объект JSON")
+
+
+def _to_row(record: dict, table: str) -> tuple:
+    """Кортеж в порядке колонок таблицы. ValueError — строку импортировать нельзя."""
+    columns = TABLES[table][0]
+    defaults = DEFAULTS[table]
+    missing = [column for column in REQUIRED_COLUMNS[table] if record.get(column) in (None, "")]
+    if missing:
+        raise ValueError(f"нет обязательных колонок: {', '.join(missing)}")
+    row = []
+    for column in columns:
+        value = record.get(column)
+        if value in (None, ""):
+            value = defaults.get(column)
+        elif column in INT_COLUMNS or column in FLOAT_COLUMNS:
+            try:
+                value = int(value) if column in INT_COLUMNS else float(value)
+            except (TypeError, ValueError):
+                raise ValueError(f"{column}: ожидалось число, получено {value!r}") from None
+        row.append(value)
+    return tuple(row)
+
+
+async def export_table(table: str, path: str, fmt: str):
+    columns, iterate, _ = TABLES[table]
+    stream = _open(path, "w")
+    count = 0
+    try:
+        writer = csv.writer(stream) if fmt == "csv" else None
+        if writer:
+            writer.writerow(columns)
+        async for row in iterate():
+            if writer:
+                writer.writerow(["" if value is None else value for value in row])
+            else:
+                stream.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + "\n")
+            count += 1
+    finally:
+        if stream is not sys.stdout:
+            stream.close()
+    print(f"Экспортировано {table}: {count}", file=sys.stderr)
+
+
+async def _create_partner_deals(rows: list, concurrency: int) -> int:
+    """Создает сделки для партнеров пачки, у которых их нет. Возвращает число созданных."""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    import bitrix_api  # Нужен только для --create-deals (требует настроек бота)
+
+    async def create(row):
+        user_id, full_name, phone_number, _, _, role = row
+        if await db.get_partner_deal_id_by_user_id(user_id):
+            return "linked"  # Сделка была привязана раньше (повторный импорт)
+        async with semaphore:
+            deal_id = await bitrix_api.create_partner_deal(full_name, phone_number, user_id, role=role)
+        return (int(deal_id), user_id) if deal_id else None
+
+    results = await asyncio.gather(*(create(row) for row in rows if row[4] is None))
+    created = [pair for pair in results if isinstance(pair, tuple)]
+    if created:
+        await db.set_partner_deal_ids(created)
+    failed = results.count(None)
+    if failed:
+        print(f"Не удалось создать сделок: {failed} (запустите импорт повторно)", file=sys.stderr)
+    return len(created)
+
+
+async def import_table(table: str, path: str, fmt: str, chunk: int, create_deals: bool, concurrency: int) -> int:
+    """Импортирует файл. Возвращает число пропущенных (некорректных) строк."""
+    _, _, import_rows = TABLES[table]
+    stream = _open(path, "r")
+    count = deals = skipped = 0
+    try:
+        batch = []
+        for line_no, record in _read_records(stream, fmt):
+            try:
+                if isinstance(record, ValueError):
+                    raise record
+                batch.append(_to_row(record, table))
+            except ValueError as e:
+                print(f"Строка {line_no} пропущена: {e}", file=sys.stderr)
+                skipped += 1
+                continue
+            if len(batch) < chunk:
+                continue
+            await import_rows(batch)
+            if create_deals:
+                deals += await _create_partner_deals(batch, concurrency)
+            count += len(batch)
+            batch = []
+            print(f"... {count}", file=sys.stderr)
+        if batch:
+            await import_rows(batch)
+            if create_deals:
+                deals += await _create_partner_deals(batch, concurrency)
+            count += len(batch)
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+    print(f"Импортировано {table}: {count}" + (f", создано сделок: {deals}" if create_deals else "")
+          + (f", пропущено строк: {skipped}" if skipped else ""), file=sys.stderr)
+    return skipped
+
+
+async def run(args) -> int:
+    """Возвращает код выхода: 1, если при импорте были пропущены строки."""
+    await db.init_db()
+    try:
+        fmt = _detect_format(args.path, args.format)
+        if args.action == "export":
+            await export_table(args.table, args.path, fmt)
+            return 0
+        skipped = await import_table(args.table, args.path, fmt, args.chunk, args.create_deals, args.concurrency)
+        return 1 if skipped else 0
+    finally:
+        if args.create_deals:
+            import bitrix_api
+            await bitrix_api.client.close()
+        await db.close_db()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Импорт и экспорт партнеров и клиентов")
+    parser.add_argument("action", choices=["import", "export"])
+    parser.add_argument("table", choices=list(TABLES))
+    parser.add_argument("path", help="Файл .csv или .jsonl ('-' — stdin/stdout)")
+    parser.add_argument("--format", choices=["csv", "jsonl"], help="Формат, если не ясен из расширения")
+    parser.add_argument("--chunk", type=int, default=1000, help="Строк в одной транзакции")
+    parser.add_argument("--create-deals", action="store_true",
+                        help="Создать сделки в Битрикс для партнеров без сделки")
+    parser.add_argument("--concurrency", type=int, default=25, help="Одновременных запросов к Битрикс")
+    args = parser.parse_args()
+
+    if args.create_deals and (args.action, args.table) != ("import", "partners"):
+        parser.error("--create-deals работает только при импорте партнеров")
+    sys.exit(asyncio.run(run(args)))
+
+
+if __name__ == "__main__":
+    main()
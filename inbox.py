@@ -0,0 +1,182 @@
+# inbox.py
+import asyncio
+import hashlib
+import json
+import logging
+import random
+import time
+
+import config
+import database as db
+
+
+class WebhookInbox:
+    """
+    Журнал входящих вебхуков Битрикс (таблица webhook_inbox).
+    append() только дописывает событие в SQLite — Битрикс получает ответ сразу, а события
+    разбирает фоновый воркер. Событие считается обработанным только после успешного вызова
+    обработчика, поэтому после сбоя или рестарта оно обрабатывается повторно (at-least-once);
+    обработчик должен быть идемпотентным. Повторная доставка того же события — дубль: по ID
+    доставки (delivery_id_field), если Битрикс его передает, иначе — если событие совпадает
+    с последним по тому же ключу. Разобранные события хранятся retention_days и затем удаляются.
+    Серии событий по одному ключу схлопываются: обработчик получает последнее, когда по ключу
+    window секунд не было новых событий (но не позже max_delay от первого).
+    """
+
+    def __init__(self, handler, window: float = config.BITRIX_DEAL_DEBOUNCE_WINDOW,
+                 max_delay: float = config.BITRIX_DEAL_DEBOUNCE_MAX_DELAY,
+                 batch: int = config.WEBHOOK_INBOX_BATCH, dedup_window: float = config.WEBHOOK_DEDUP_WINDOW,
+                 max_attempts: int = config.WEBHOOK_MAX_ATTEMPTS, base_delay: float = config.JOB_RETRY_BASE_DELAY,
+                 max_retry_delay: float = config.JOB_RETRY_MAX_DELAY, poll_interval: float = 0.5,
+                 delivery_id_field: str = config.WEBHOOK_DELIVERY_ID_FIELD,
+                 retention_days: float = config.WEBHOOK_RETENTION_DAYS, prune_interval: float = 3600):
+        self._handler = handler  # async (payload: dict) -> None
+        self.window = window
+        self.max_delay = max_delay
+        self.batch = batch
+        self.dedup_window = dedup_window
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_retry_delay = max_retry_delay
+        self.poll_interval = poll_interval
+        self.delivery_id_field = delivery_id_field
+        self.retention_days = retention_days
+        self.prune_interval = prune_interval
+        self._pruned_at = 0.0
+        # Ключи с необработанными событиями (на момент последнего прохода). Ведется только там,
+        # где запущен воркер: на остальных репликах его некому очищать
+        self._pending_keys = set()
+        self._task = None
+        self._wakeup = asyncio.Event()
+        self.received = 0
+        self.duplicates = 0
+        self.processed = 0
+        self.failed = 0
+
+    def __contains__(self, key) -> bool:
+        """Есть ли по ключу необработанные события."""
+        return key in self._pending_keys
+
+    def __len__(self):
+        return len(self._pending_keys)
+
+    async def append(self, key: str, payload: dict) -> bool:
+        """Сохраняет событие. Возвращает False, если это дубль уже полученного."""
+        delivery_id = payload.get(self.delivery_id_field) if self.delivery_id_field else None
+        if delivery_id:
+            dedup_key = hashlib.sha1(f"{key}\n{delivery_id}".encode()).hexdigest()
+        else:
+            dedup_key = hashlib.sha1(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+        is_new = await db.append_webhook_event(key, dedup_key, payload, self.dedup_window, bool(delivery_id))
+        self.received += 1
+        if is_new:
+            if self._task:
+                self._pending_keys.add(key)
+            self._wakeup.set()
+        else:
+            self.duplicates += 1
+        return is_new
+
+    async def start(self, requeue: bool = True):
+        if requeue:
+            requeued = await db.requeue_processing_webhook_events()
+            if requeued:
+                logging.info(f"Журнал вебхуков: {requeued} прерванных событий возвращены в очередь")
+        self._task = asyncio.create_task(self._worker())
+
+    async def stop(self):
+        # Необработанные события остаются в журнале и будут разобраны после запуска
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def flush(self):
+        """Обрабатывает все накопившиеся события сразу, не дожидаясь окна (тесты и loadtest.py)."""
+        while True:
+            if await self._poll(force=True):
+                continue
+            # Часть событий мог забрать фоновый воркер — дожидаемся и их
+            if not (await db.count_webhook_events()).get('processing'):
+                return
+            await asyncio.sleep(0.05)
+
+    async def replay(self, since: float, until: float) -> int:
+        """Повторно обрабатывает события, полученные в интервале (см. db.replay_webhook_events)."""
+        count = await db.replay_webhook_events(since, until)
+        self._wakeup.set()
+        return count
+
+    def stats(self) -> dict:
+        return {
+            "pending_keys": len(self._pending_keys),
+            "received": self.received,
+            "duplicates": self.duplicates,
+            "processed": self.processed,
+            "failed": self.failed,
+        }
+
+    def _retry_delay(self, attempts: int) -> float:
+        delay = min(self.max_retry_delay, self.base_delay * 2 ** (attempts - 1))
+        return delay * random.uniform(0.5, 1.0)
+
+    async def _worker(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                await self._poll()
+                await self._prune()
+            except Exception as e:
+                logging.error(f"Журнал вебхуков: {e}", exc_info=True)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _prune(self):
+        """Раз в prune_interval удаляет разобранные события старше retention_days."""
+        now = time.time()
+        if now - self._pruned_at < self.prune_interval:
+            return
+        self._pruned_at = now
+        deleted = await db.prune_webhook_events(now - self.retention_days * 86400)
+        if deleted:
+            logging.info(f"Журнал вебхуков: удалено старых событий: {deleted}")
+
+    async def _poll(self, force: bool = False) -> int:
+        """Один проход: обрабатывает готовые ключи (не больше batch). Возвращает их число."""
+        now = time.time()
+        ready = []
+        pending = set()
+        for key, last_event_id, first_at, last_at, next_run_at in await db.get_pending_webhook_keys():
+            pending.add(key)
+            quiet = last_at <= now - self.window or first_at <= now - self.max_delay
+            if (force or quiet) and next_run_at <= now and len(ready) < self.batch:
+                ready.append((key, last_event_id))
+        self._pending_keys = pending
+        # Разные ключи независимы — обрабатываем параллельно, события одного ключа идут по порядку
+        await asyncio.gather(*(self._process(key, last_event_id) for key, last_event_id in ready))
+        return len(ready)
+
+    async def _process(self, key: str, last_event_id: int):
+        claimed = await db.claim_webhook_events(key, last_event_id)
+        if claimed is None:
+            return
+        payload, attempts = claimed
+        try:
+            await self._handler(payload)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"[:500]
+            attempts += 1
+            if attempts >= self.max_attempts:
+                logging.error(f"Событие Битрикс {key} (#{last_event_id}) не обработано после {attempts} попыток: {error}")
+                await db.retry_webhook_events(key, last_event_id, 0, error, failed=True)
+                self.failed += 1
+            else:
+                delay = self._retry_delay(attempts)
+                logging.warning(f"Событие Битрикс {key} (#{last_event_id}), попытка {attempts}: {error}. "
+                                f"Повтор через {delay:.0f} с")
+                await db.retry_webhook_events(key, last_event_id, time.time() + delay, error)
+        else:
+            await db.finish_webhook_events(key, last_event_id)
+            self.processed += 1
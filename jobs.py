@@ -0,0 +1,121 @@
+# jobs.py
+import asyncio
+import logging
+import random
+import time
+
+import config
+import database as db
+
+
+class JobQueue:
+    """
+    Надежная очередь фоновых задач поверх SQLite (таблица jobs).
+    Задача переживает рестарт бота; при ошибке повторяется с экспоненциальной
+    задержкой, после max_attempts неудач вызывается on_failure. Выполненные задачи удаляются
+    сразу, проваленные хранятся retention_days (для разбора) и затем удаляются.
+    """
+
+    def __init__(self, workers: int = config.JOB_WORKERS, max_attempts: int = config.JOB_MAX_ATTEMPTS,
+                 base_delay: float = config.JOB_RETRY_BASE_DELAY, max_delay: float = config.JOB_RETRY_MAX_DELAY,
+                 poll_interval: float = 1.0, retention_days: float = config.JOB_RETENTION_DAYS,
+                 prune_interval: float = 3600):
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.poll_interval = poll_interval
+        self.retention_days = retention_days
+        self.prune_interval = prune_interval
+        self._pruned_at = 0.0
+        self._handlers = {}
+        self._tasks = []
+        self._wakeup = asyncio.Event()
+
+    def handler(self, kind: str, on_failure=None):
+        """
+        Декоратор: регистрирует обработчик задач вида kind.
+        Обработчик — async (payload: dict) -> None, при неудаче выбрасывает исключение.
+        on_failure — async (payload: dict, error: str) -> None, когда попытки исчерпаны.
+        """
+        def decorator(func):
+            self._handlers[kind] = (func, on_failure)
+            return func
+        return decorator
+
+    async def enqueue(self, kind: str, payload: dict, delay: float = 0) -> int:
+        job_id = await db.enqueue_job(kind, payload, delay)
+        self.notify()
+        return job_id
+
+    def notify(self):
+        """Будит воркеры (после добавления задачи в БД)."""
+        self._wakeup.set()
+
+    async def start(self, requeue: bool = True):
+        # Задачи, которые выполнялись в момент остановки, возвращаем в очередь.
+        # Если реплик несколько, это делает только основная: у остальных они могут выполняться прямо сейчас
+        if requeue:
+            await db.requeue_running_jobs()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def _retry_delay(self, attempts: int) -> float:
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+        return delay * random.uniform(0.5, 1.0)
+
+    async def _worker(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                await self._prune()
+                job = await db.claim_job()
+                if job is not None:
+                    await self._process(*job)
+                    continue
+            except Exception as e:
+                logging.error(f"Очередь задач: {e}", exc_info=True)
+
+            # Новых задач нет — ждем сигнала или следующего опроса (для отложенных повторов)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _prune(self):
+        """Раз в prune_interval удаляет проваленные задачи старше retention_days."""
+        now = time.time()
+        if now - self._pruned_at < self.prune_interval:
+            return
+        self._pruned_at = now
+        deleted = await db.prune_failed_jobs(self.retention_days)
+        if deleted:
+            logging.info(f"Очередь задач: удалено старых проваленных задач: {deleted}")
+
+    async def _process(self, job_id: int, kind: str, payload: dict, attempts: int):
+        func, on_failure = self._handlers.get(kind, (None, None))
+        try:
+            if func is None:
+                raise RuntimeError(f"Нет обработчика для задачи '{kind}'")
+            await func(payload)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"[:500]
+            if attempts >= self.max_attempts or func is None:
+                logging.error(f"Задача #{job_id} ({kind}) провалена после {attempts} попыток: {error}")
+                await db.fail_job(job_id, error)
+                if on_failure:
+                    try:
+                        await on_failure(payload, error)
+                    except Exception as fe:
+                        logging.error(f"Задача #{job_id}: ошибка в on_failure: {fe}")
+            else:
+                delay = self._retry_delay(attempts)
+                logging.warning(f"Задача #{job_id} ({kind}), попытка {attempts}: {error}. Повтор через {delay:.0f} с")
+                await db.retry_job(job_id, time.time() + delay, error)
+        else:
+            await db.complete_job(job_id)
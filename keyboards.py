@@ -1,72 +1,107 @@
 # keyboards.py
+"""
+Клавиатуры бота.
+Статичные клавиатуры создаются один раз при импорте, функции get_* возвращают один и тот же объект.
+Клавиатуры с параметрами запоминаются по аргументам (lru_cache), поэтому повторный вызов
+тоже не создает новых объектов. Это общие объекты, а модели aiogram изменяемы: правка
+клавиатуры в обработчике попадет во все следующие ответы. Правьте клавиатуры здесь,
+а если в обработчике нужен вариант — берите копию (markup.model_copy(deep=True)).
+"""
+from functools import lru_cache
+
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
 import math
 
+# Сколько разных клавиатур с параметрами держать в памяти (~1 КБ на клавиатуру)
+KEYBOARD_CACHE_SIZE = 4096
+
 # --- Регистрация ---
 
+AGREE_KEYBOARD = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="✅ Я согласен с условиями", callback_data="agree_to_terms")]
+])
+
+# Клавиатура для выбора роли партнера
+ROLE_KEYBOARD = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="Риэлтор"), KeyboardButton(text="Дизайнер")],
+        [KeyboardButton(text="Приемщик"), KeyboardButton(text="Другое")]
+    ],
+    resize_keyboard=True,
+    one_time_keyboard=True
+)
+
+REQUEST_PHONE_KEYBOARD = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="📱 Поделиться номером телефона", request_contact=True)]
+    ],
+    resize_keyboard=True,
+    one_time_keyboard=True
+)
+
+
 def get_agree_keyboard():
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="✅ Я согласен с условиями", callback_data="agree_to_terms")]
-    ])
+    return AGREE_KEYBOARD
 
 def get_role_keyboard():
     """Клавиатура для выбора роли партнера."""
-    return ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="Риэлтор"), KeyboardButton(text="Дизайнер")],
-            [KeyboardButton(text="Приемщик"), KeyboardButton(text="Другое")]
-        ],
-        resize_keyboard=True,
-        one_time_keyboard=True
-    )
+    return ROLE_KEYBOARD
 
 def get_request_phone_keyboard():
-    return ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="📱 Поделиться номером телефона", request_contact=True)]
-        ],
-        resize_keyboard=True,
-        one_time_keyboard=True
-    )
+    return REQUEST_PHONE_KEYBOARD
 
 # --- Меню партнера ---
 
-def get_verified_partner_menu():
-    """Главное меню с кнопкой статистики."""
-    keyboard = [
+# Главное меню с кнопкой статистики
+VERIFIED_PARTNER_MENU = ReplyKeyboardMarkup(
+    keyboard=[
         [KeyboardButton(text="🚀 Отправить клиента")],
-        [KeyboardButton(text="📊 Мои клиенты"), KeyboardButton(text="📈 Статистика")], # <-- НОВОЕ
+        [KeyboardButton(text="📊 Мои клиенты"), KeyboardButton(text="📈 Статистика")],
         [KeyboardButton(text="ℹ️ Инфо Программа")]
-    ]
-    return ReplyKeyboardMarkup(keyboard=keyboard, resize_keyboard=True)
+    ],
+    resize_keyboard=True
+)
+
+
+def get_verified_partner_menu():
+    """Главное меню с кнопкой статистики."""
+    return VERIFIED_PARTNER_MENU
 
 # --- FSM / Служебные ---
 
+CANCEL_KEYBOARD = ReplyKeyboardMarkup(
+    keyboard=[[KeyboardButton(text="❌ Отмена")]],
+    resize_keyboard=True,
+    one_time_keyboard=True
+)
+
+SKIP_KEYBOARD = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="➡️ Пропустить")],
+        [KeyboardButton(text="❌ Отмена")]
+    ],
+    resize_keyboard=True,
+    one_time_keyboard=True
+)
+
+CLIENT_CONFIRMATION_KEYBOARD = InlineKeyboardMarkup(inline_keyboard=[
+    [
+        InlineKeyboardButton(text="✅ Подтвердить", callback_data="confirm_client_submission"),
+        InlineKeyboardButton(text="🔄 Заполнить заново", callback_data="retry_client_submission")
+    ]
+])
+
+
 def get_cancel_keyboard():
-    return ReplyKeyboardMarkup(
-        keyboard=[[KeyboardButton(text="❌ Отмена")]],
-        resize_keyboard=True,
-        one_time_keyboard=True
-    )
+    return CANCEL_KEYBOARD
 
 def get_skip_keyboard():
-    return ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="➡️ Пропустить")],
-            [KeyboardButton(text="❌ Отмена")]
-        ],
-        resize_keyboard=True,
-        one_time_keyboard=True
-    )
+    return SKIP_KEYBOARD
 
 def get_client_confirmation_keyboard():
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [
-            InlineKeyboardButton(text="✅ Подтвердить", callback_data="confirm_client_submission"),
-            InlineKeyboardButton(text="🔄 Заполнить заново", callback_data="retry_client_submission")
-        ]
-    ])
+    return CLIENT_CONFIRMATION_KEYBOARD
 
+@lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
 def get_verification_keyboard(partner_user_id: int):
     return InlineKeyboardMarkup(inline_keyboard=[
         [
@@ -75,20 +110,37 @@ def get_verification_keyboard(partner_user_id: int):
         ]
     ])
 
+# --- Статистика ---
+
+@lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
+def get_stats_more_keyboard(cursor_client_id: int):
+    """Кнопка продолжения детализации (полный отчет порциями)."""
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="📄 Показать еще", callback_data=f"stats_more:{cursor_client_id}")]
+    ])
+
 # --- Пагинация ---
 CLIENTS_PER_PAGE = 5
 
-def get_clients_pagination_keyboard(current_offset: int, total_clients: int):
+@lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
+def get_clients_pagination_keyboard(current_offset: int, total_clients: int,
+                                    first_client_id: int = None, last_client_id: int = None):
+    """
+    Кнопки листания. В callback_data передается курсор (client_id крайнего клиента
+    на странице) и смещение следующей страницы — только для нумерации.
+    """
     if total_clients <= CLIENTS_PER_PAGE:
         return None
     current_page = current_offset // CLIENTS_PER_PAGE + 1
     total_pages = math.ceil(total_clients / CLIENTS_PER_PAGE)
     buttons = []
-    if current_offset > 0:
+    if current_offset > 0 and first_client_id is not None:
         prev_offset = max(0, current_offset - CLIENTS_PER_PAGE)
-        buttons.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"prev_clients:{prev_offset}"))
+        buttons.append(InlineKeyboardButton(text="⬅️ Назад",
+                                            callback_data=f"prev_clients:{first_client_id}:{prev_offset}"))
     buttons.append(InlineKeyboardButton(text=f"{current_page}/{total_pages}", callback_data="noop"))
-    if current_offset + CLIENTS_PER_PAGE < total_clients:
+    if current_offset + CLIENTS_PER_PAGE < total_clients and last_client_id is not None:
         next_offset = current_offset + CLIENTS_PER_PAGE
-        buttons.append(InlineKeyboardButton(text="Вперед ➡️", callback_data=f"next_clients:{next_offset}"))
-    return InlineKeyboardMarkup(inline_keyboard=[buttons])
\ No newline at end of file
+        buttons.append(InlineKeyboardButton(text="Вперед ➡️",
+                                            callback_data=f"next_clients:{last_client_id}:{next_offset}"))
+    return InlineKeyboardMarkup(inline_keyboard=[buttons])
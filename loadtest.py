@@ -0,0 +1,388 @@
+# loadtest.py
+"""
+Нагрузочный тест без сети: приложение bot.py запускается в этом же процессе,
+а вместо Telegram Bot API и REST Битрикс работают локальные заглушки
+с настраиваемой задержкой и долей ошибок.
+
+    python benchmark.py load [--partners 50] [--clients 3] [--deal-updates 200] [--recipients 500]
+                             [--bitrix-latency 0.05] [--bitrix-error-rate 0.01]
+                             [--telegram-latency 0.02] [--telegram-error-rate 0.0]
+
+Сценарии: регистрация партнеров, передача клиентов, вебхуки смены стадии, рассылка.
+Для каждого шага печатаются p50/p99 и пропускная способность, чтобы сравнивать
+изменения производительности с прошлым прогоном.
+"""
+import asyncio
+import itertools
+import json
+import os
+import random
+import statistics
+import tempfile
+import time
+from collections import Counter, defaultdict
+
+import aiohttp
+from aiohttp import web
+
+TELEGRAM_TOKEN = "123456:LOADTEST"
+INCOMING_SECRET = "loadtest"
+ADMIN_ID = 1
+# Сколько ждать ответа бота на шаг сценария, секунд
+REPLY_TIMEOUT = 10
+
+
+class FakeTelegram:
+    """Заглушка Bot API: отвечает на все методы, запоминает, кому бот писал."""
+
+    def __init__(self, latency: float, error_rate: float):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.calls = Counter()
+        self._message_ids = itertools.count(1)
+        self._waiters = defaultdict(list)  # chat_id -> [(фрагмент текста, future)]
+        self.app = web.Application()
+        self.app.router.add_post("/bot{token}/{method}", self.handle)
+
+    def expect_reply(self, chat_id: int, marker: str) -> asyncio.Future:
+        """Future, которая завершится, когда бот напишет в этот чат текст с фрагментом marker."""
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[chat_id].append((marker, future))
+        return future
+
+    async def handle(self, request: web.Request):
+        method = request.match_info["method"]
+        self.calls[method] += 1
+        data = dict(await request.post())
+        if self.latency:
+            await asyncio.sleep(random.expovariate(1 / self.latency))
+        if random.random() < self.error_rate:
+            return web.json_response({"ok": False, "error_code": 500, "description": "Internal Server Error"},
+                                     status=500)
+
+        result = True
+        if method in ("sendMessage", "editMessageText"):
+            chat_id = int(data.get("chat_id", 0))
+            text = data.get("text", "")
+            result = {
+                "message_id": int(data.get("message_id") or next(self._message_ids)),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": text,
+            }
+            for waiter in self._waiters.get(chat_id, []):
+                marker, future = waiter
+                if marker in text:
+                    self._waiters[chat_id].remove(waiter)
+                    if not future.done():
+                        future.set_result(method)
+                    break
+        return web.json_response({"ok": True, "result": result})
+
+
+class FakeBitrix:
+    """Заглушка REST Битрикс: crm.*-методы и batch, с задержкой и QUERY_LIMIT_EXCEEDED."""
+
+    def __init__(self, latency: float, error_rate: float):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.calls = Counter()
+        self._ids = itertools.count(1000)
+        self.app = web.Application()
+        self.app.router.add_post("/rest/{hook}/{method}.json", self.handle)
+
+    def _execute(self, method: str, params: dict):
+        self.calls[method] += 1
+        if method in ("crm.contact.list", "crm.deal.list"):
+            return []
+        if method in ("crm.contact.add", "crm.deal.add"):
+            return next(self._ids)
+        if method == "crm.deal.get":
+            return {"ID": params.get("id"), "OPPORTUNITY": "1000000", "STAGE_ID": "C2:NEW",
+                    "DATE_MODIFY": time.strftime("%Y-%m-%dT%H:%M:%S+03:00")}
+        return True
+
+    async def handle(self, request: web.Request):
+        method = request.match_info["method"]
+        params = await request.json() if request.can_read_body else {}
+        if self.latency:
+            await asyncio.sleep(random.expovariate(1 / self.latency))
+        if random.random() < self.error_rate:
+            self.calls["QUERY_LIMIT_EXCEEDED"] += 1
+            return web.json_response({"error": "QUERY_LIMIT_EXCEEDED", "error_description": "Too many requests"},
+                                     status=503)
+
+        if method == "batch":
+            self.calls["batch"] += 1
+            results = {}
+            for key, command in (params.get("cmd") or {}).items():
+                sub_method, _, _ = command.partition("?")
+                results[key] = self._execute(sub_method, {})
+            return web.json_response({"result": {"result": results, "result_error": {}}})
+        return web.json_response({"result": self._execute(method, params)})
+
+
+class Recorder:
+    """Задержки по шагам сценариев."""
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.errors = Counter()
+        self.phases = {}  # фаза -> длительность, секунд
+
+    def add(self, name: str, seconds: float):
+        self.samples[name].append(seconds)
+
+    def report(self):
+        print(f"\n{'шаг':<34}{'n':>7}{'ошибок':>8}{'p50, мс':>10}{'p99, мс':>10}{'mean, мс':>10}{'в сек':>9}")
+        for name, samples in self.samples.items():
+            ordered = sorted(samples)
+            p50 = ordered[len(ordered) // 2]
+            p99 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+            phase = self.phases.get(name.split(":")[0]) or sum(samples)
+            print(f"{name:<34}{len(samples):>7}{self.errors[name]:>8}{p50 * 1000:>10.1f}{p99 * 1000:>10.1f}"
+                  f"{statistics.mean(samples) * 1000:>10.1f}{len(samples) / phase:>9.1f}")
+        for name in self.errors.keys() - self.samples.keys():
+            print(f"{name:<34}{0:>7}{self.errors[name]:>8}")
+
+
+def _configure_env(telegram_url: str, bitrix_url: str, bitrix_rate: float):
+    """Настройки бота для теста. Адреса API задаются принудительно, чтобы тест не ушел в сеть."""
+    os.environ["BOT_TOKEN"] = TELEGRAM_TOKEN
+    os.environ["BITRIX_PARTNER_WEBHOOK"] = f"{bitrix_url}/rest/partner/"
+    os.environ["BITRIX_CLIENT_WEBHOOK"] = f"{bitrix_url}/rest/client/"
+    os.environ["BITRIX_INCOMING_SECRET"] = INCOMING_SECRET
+    os.environ["BASE_WEBHOOK_URL"] = telegram_url
+    os.environ["SUPER_ADMIN_ID"] = str(ADMIN_ID)
+    os.environ["BITRIX_RATE"] = str(bitrix_rate)
+    defaults = {
+        "PARTNER_DEAL_FIELD": "UF_PARTNER", "PARTNER_FUNNEL_ID": "1", "BITRIX_PARTNER_VERIFIED_STAGE_ID": "C1:WON",
+        "BITRIX_CLIENT_FUNNEL_ID": "2", "BITRIX_CLIENT_STAGE_1": "C2:NEW", "BITRIX_CLIENT_STAGE_2": "C2:MEETING",
+        "BITRIX_CLIENT_STAGE_3": "C2:ESTIMATE", "BITRIX_CLIENT_STAGE_WIN": "C2:WON", "BITRIX_CLIENT_STAGE_LOSE": "C2:LOSE",
+        "FSM_STORAGE": "sqlite", "PRIMARY_REPLICA": "1",
+    }
+    for key, value in defaults.items():
+        os.environ.setdefault(key, value)
+
+
+async def _start_site(app: web.Application):
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    return runner, f"http://{host}:{port}"
+
+
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.telegram = FakeTelegram(args.telegram_latency, args.telegram_error_rate)
+        self.bitrix = FakeBitrix(args.bitrix_latency, args.bitrix_error_rate)
+        self.rec = Recorder()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    # --- Апдейты Telegram ---
+
+    def _user(self, user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"user{user_id}"}
+
+    def _message(self, user_id: int, text: str = None, contact: dict = None) -> dict:
+        message = {"message_id": next(self._message_ids), "date": int(time.time()),
+                   "chat": {"id": user_id, "type": "private"}, "from": self._user(user_id)}
+        if text is not None:
+            message["text"] = text
+            if text.startswith("/"):
+                message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        if contact:
+            message["contact"] = contact
+        return {"update_id": next(self._update_ids), "message": message}
+
+    def _callback(self, user_id: int, data: str) -> dict:
+        message = {"message_id": next(self._message_ids), "date": int(time.time()),
+                   "chat": {"id": user_id, "type": "private"}, "text": "..."}
+        return {"update_id": next(self._update_ids), "callback_query": {
+            "id": str(next(self._update_ids)), "from": self._user(user_id), "chat_instance": str(user_id),
+            "message": message, "data": data}}
+
+    async def _post(self, name: str, url: str, **kwargs) -> bool:
+        started = time.perf_counter()
+        try:
+            async with self.session.post(url, **kwargs) as response:
+                ok = response.status == 200
+        except aiohttp.ClientError:
+            ok = False
+        self.rec.add(name, time.perf_counter() - started)
+        if not ok:
+            self.rec.errors[name] += 1
+        return ok
+
+    async def step(self, phase: str, name: str, user_id: int, update: dict, marker: str) -> bool:
+        """Шлет апдейт и ждет ответа бота с фрагментом marker (как живой пользователь)."""
+        reply = self.telegram.expect_reply(user_id, marker)
+        started = time.perf_counter()
+        if not await self._post(f"{phase}:ack", self.telegram_path, json=update):
+            return False
+        try:
+            await asyncio.wait_for(reply, REPLY_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.rec.errors[f"{phase}:{name}"] += 1
+            return False
+        self.rec.add(f"{phase}:{name}", time.perf_counter() - started)
+        return True
+
+    # --- Сценарии ---
+
+    async def register(self, user_id: int):
+        started = time.perf_counter()
+        steps = [
+            ("start", self._message(user_id, "/start"), "Приветствие"),
+            ("agree", self._callback(user_id, "agree_to_terms"), "кем вы являетесь"),
+            ("role", self._message(user_id, "Риэлтор"), "ФИО"),
+            ("name", self._message(user_id, f"Партнер {user_id}"), "номером телефона"),
+            ("phone", self._message(user_id, contact={"phone_number": f"+7900{user_id:07d}",
+                                                      "first_name": "P", "user_id": user_id}), "заявка принята"),
+        ]
+        for name, update, marker in steps:
+            if not await self.step("register", name, user_id, update, marker):
+                return
+        self.rec.add("register:total", time.perf_counter() - started)
+
+    async def submit_clients(self, user_id: int, count: int):
+        """Партнер передает клиентов по одному (сценарии одного чата не пересекаются)."""
+        for n in range(count):
+            await self.submit_client(user_id, n)
+
+    async def submit_client(self, user_id: int, n: int):
+        started = time.perf_counter()
+        steps = [
+            ("menu", self._message(user_id, "🚀 Отправить клиента"), "Имя и Фамилию"),
+            ("name", self._message(user_id, f"Клиент {user_id}-{n}"), "номер телефона клиента"),
+            ("phone", self._message(user_id, f"+7 91{random.randint(0, 99_999_999):08d}"), "адрес квартиры"),
+            ("address", self._message(user_id, "Москва, ул. Тестовая, 1"), "площадь квартиры"),
+            ("area", self._message(user_id, "➡️ Пропустить"), "комментарий"),
+            ("comment", self._message(user_id, "➡️ Пропустить"), "Проверьте данные"),
+            ("confirm", self._callback(user_id, "confirm_client_submission"), "принят, передаем"),
+        ]
+        for name, update, marker in steps:
+            if not await self.step("client", name, user_id, update, marker):
+                return
+        self.rec.add("client:total", time.perf_counter() - started)
+
+    async def _phase(self, name: str, coroutines):
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+
+        async def limited(coro):
+            async with semaphore:
+                await coro
+
+        started = time.perf_counter()
+        await asyncio.gather(*(limited(coro) for coro in coroutines))
+        self.rec.phases[name] = time.perf_counter() - started
+        print(f"  {name}: {self.rec.phases[name]:.2f} с")
+
+    async def _wait_jobs(self, timeout: float = 300):
+        """Ждет, пока фоновые задачи (создание сделок) разойдутся."""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            async with self.db.engine.read() as conn:
+                async with conn.execute("SELECT COUNT(*) FROM jobs WHERE status != 'failed'") as cursor:
+                    if (await cursor.fetchone())[0] == 0:
+                        return
+            await asyncio.sleep(0.1)
+
+    async def run(self):
+        args = self.args
+        tg_runner, tg_url = await _start_site(self.telegram.app)
+        bx_runner, bx_url = await _start_site(self.bitrix.app)
+        tmp = tempfile.TemporaryDirectory()
+        _configure_env(tg_url, bx_url, args.bitrix_rate)
+
+        # Бот импортируется только теперь, когда настройки указывают на заглушки
+        from aiogram.client.telegram import TelegramAPIServer
+        import bot
+        import config
+        import database as db
+        self.db = db
+        db.engine.path = os.path.join(tmp.name, "loadtest.db")
+        bot.bot.session.api = TelegramAPIServer.from_base(tg_url)
+
+        app_runner, app_url = await _start_site(bot.setup_app())
+        self.telegram_path = app_url + config.TELEGRAM_WEBHOOK_PATH
+        bitrix_path = app_url + config.BITRIX_WEBHOOK_PATH
+        self.session = aiohttp.ClientSession()
+        try:
+            partners = [100_000 + i for i in range(args.partners)]
+            print("Фазы:")
+            await self._phase("register", [self.register(uid) for uid in partners])
+
+            # Менеджер одобряет всех (через БД, как после вебхука верификации)
+            for uid in partners:
+                await db.set_partner_status(uid, "verified")
+            await self._phase("client", [self.submit_clients(uid, args.clients) for uid in partners])
+
+            started = time.perf_counter()
+            await self._wait_jobs()
+            self.rec.phases["jobs"] = time.perf_counter() - started
+            print(f"  jobs (сделки в Битрикс): {self.rec.phases['jobs']:.2f} с")
+
+            async with db.engine.read() as conn:
+                async with conn.execute("SELECT bitrix_deal_id FROM clients WHERE bitrix_deal_id IS NOT NULL") as c:
+                    deal_ids = [row[0] for row in await c.fetchall()]
+            if deal_ids:
+                stages = [config.BITRIX_CLIENT_STAGE_2, config.BITRIX_CLIENT_STAGE_3,
+                          config.BITRIX_CLIENT_STAGE_WIN, config.BITRIX_CLIENT_STAGE_LOSE]
+                await self._phase("bitrix", [self._post("bitrix:deal_update", bitrix_path, params={
+                    "secret": INCOMING_SECRET, "event_type": "client_deal_update",
+                    "deal_id": random.choice(deal_ids), "STAGE_ID": random.choice(stages),
+                }) for _ in range(args.deal_updates)])
+                started = time.perf_counter()
+                await bot.webhook_inbox.flush()
+                self.rec.phases["inbox"] = time.perf_counter() - started
+
+            # Рассылка: получатели — зарегистрированные и дополнительные верифицированные партнеры
+            extra = [(200_000 + i, f"Партнер {i}", "+7", "verified", None, "Риэлтор")
+                     for i in range(max(0, args.recipients - len(partners)))]
+            for i in range(0, len(extra), 1000):
+                await db.import_partners(extra[i:i + 1000])
+            started = time.perf_counter()
+            sent_before = self.telegram.calls["sendMessage"]
+            await self.step("broadcast", "command", ADMIN_ID, self._message(ADMIN_ID, "/broadcast Нагрузочный тест"),
+                            "Начинаю рассылку")
+            while await db.get_unfinished_broadcast_ids():
+                await asyncio.sleep(0.05)
+            elapsed = time.perf_counter() - started
+            sent = self.telegram.calls["sendMessage"] - sent_before
+            self.rec.phases["broadcast"] = elapsed
+            print(f"  broadcast: {sent} сообщений за {elapsed:.2f} с ({sent / elapsed:.1f} в сек)")
+        finally:
+            await self.session.close()
+            await app_runner.cleanup()
+            await tg_runner.cleanup()
+            await bx_runner.cleanup()
+            tmp.cleanup()
+
+        self.rec.report()
+        print(f"\nBot API: {dict(self.telegram.calls)}")
+        print(f"Битрикс: {dict(self.bitrix.calls)}")
+        print(f"Очередь апдейтов: {json.dumps(bot.update_queue.stats())}")
+        print(f"Очередь Битрикс: {json.dumps(bot.bitrix_api.client.stats())}")
+
+
+def add_arguments(parser):
+    group = parser.add_argument_group("load")
+    group.add_argument("--partners", type=int, default=50, help="Регистраций партнеров")
+    group.add_argument("--clients", type=int, default=3, help="Клиентов от каждого партнера")
+    group.add_argument("--deal-updates", type=int, default=200, help="Вебхуков смены стадии")
+    group.add_argument("--recipients", type=int, default=500, help="Получателей рассылки")
+    group.add_argument("--concurrency", type=int, default=50, help="Одновременных пользователей")
+    group.add_argument("--telegram-latency", type=float, default=0.02, help="Средняя задержка Bot API, с")
+    group.add_argument("--telegram-error-rate", type=float, default=0.0, help="Доля ответов 500 от Bot API")
+    group.add_argument("--bitrix-latency", type=float, default=0.05, help="Средняя задержка Битрикс, с")
+    group.add_argument("--bitrix-error-rate", type=float, default=0.01, help="Доля QUERY_LIMIT_EXCEEDED")
+    group.add_argument("--bitrix-rate", type=float, default=2, help="Лимит запросов к Битрикс в секунду")
+
+
+def run(args):
+    asyncio.run(LoadTest(args).run())
@@ -0,0 +1,145 @@
+# metrics.py
+"""
+Минимальные метрики в текстовом формате Prometheus (без внешних зависимостей).
+Запись значения — пара операций со словарем, поэтому метрики можно вешать на горячий путь.
+"""
+import functools
+import inspect
+import time
+from bisect import bisect_left
+
+# Границы корзин гистограмм задержки, секунд
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_registry = []
+
+
+def _format_labels(names, values, extra: str = "") -> str:
+    pairs = [f'{name}="{str(value)}"'.replace("\n", " ") for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        _registry.append(self)
+
+    def _samples(self):
+        return []
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+
+    def inc(self, *labels, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def _samples(self):
+        return [f"{self.name}{_format_labels(self.labelnames, labels)} {value}"
+                for labels, value in self._values.items()]
+
+
+class Gauge(_Metric):
+    """
+    Значение без меток: снимается в момент запроса /metrics функцией getter
+    или задается через set(), если его нельзя получить синхронно.
+    """
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, getter=None):
+        super().__init__(name, documentation)
+        self._getter = getter
+        self._value = 0
+
+    def set(self, value: float):
+        self._value = value
+
+    def _samples(self):
+        return [f"{self.name} {self._getter() if self._getter else self._value}"]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}  # метки -> [счетчики по корзинам (+Inf последняя), сумма]
+
+    def observe(self, value: float, *labels):
+        entry = self._values.get(labels)
+        if entry is None:
+            entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def _samples(self):
+        lines = []
+        for labels, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                le = _format_labels(self.labelnames, labels, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            plain = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{plain} {total}")
+            lines.append(f"{self.name}_count{plain} {cumulative}")
+        return lines
+
+
+def render() -> str:
+    """Все метрики в текстовом формате Prometheus."""
+    return "\n".join(metric.render() for metric in _registry) + "\n"
+
+
+# --- Общие метрики проекта ---
+
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "Время обработчиков aiogram", ["handler"])
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Исключения в обработчиках aiogram", ["handler"])
+DB_SECONDS = Histogram("bot_db_seconds", "Время функций database.py", ["function"])
+DB_ERRORS = Counter("bot_db_errors_total", "Исключения в функциях database.py", ["function"])
+BITRIX_SECONDS = Histogram("bot_bitrix_request_seconds", "Время HTTP-запросов к Битрикс", ["method"])
+BITRIX_ERRORS = Counter("bot_bitrix_errors_total", "Ответы Битрикс с ошибкой (после повторов)", ["method"])
+BITRIX_WAIT_SECONDS = Histogram("bot_bitrix_queue_wait_seconds", "Ожидание очереди лимита Битрикс")
+BITRIX_RETRIES = Counter("bot_bitrix_retries_total", "Повторы запросов к Битрикс", ["method", "reason"])
+UPDATE_LAG_SECONDS = Histogram("bot_update_queue_lag_seconds", "Ожидание апдейта Telegram в очереди до обработки")
+
+
+def timed(histogram: Histogram, errors: Counter, label: str):
+    """Декоратор для корутины: время выполнения в histogram, исключения в errors."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            except Exception:
+                errors.inc(label)
+                raise
+            finally:
+                histogram.observe(time.perf_counter() - started, label)
+        return wrapper
+    return decorator
+
+
+def instrument_module(namespace: dict, histogram: Histogram, errors: Counter):
+    """Оборачивает в timed() все публичные корутины модуля (вызывать в конце модуля с globals())."""
+    for name, obj in list(namespace.items()):
+        if (not name.startswith("_") and inspect.iscoroutinefunction(obj)
+                and obj.__module__ == namespace.get("__name__")):
+            namespace[name] = timed(histogram, errors, name)(obj)
@@ -0,0 +1,119 @@
+# notifier.py
+import asyncio
+import json
+import logging
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest
+from aiogram.types import InlineKeyboardMarkup, ReplyKeyboardMarkup, ReplyKeyboardRemove
+
+import config
+import database as db
+
+# Сколько раз повторять отправку, если Telegram просит подождать
+NOTIFY_RETRY_AFTER_ATTEMPTS = 3
+
+
+def _dump_markup(markup) -> str:
+    return markup.model_dump_json(exclude_none=True) if markup else None
+
+
+def _load_markup(raw: str):
+    if not raw:
+        return None
+    data = json.loads(raw)
+    if "inline_keyboard" in data:
+        return InlineKeyboardMarkup.model_validate(data)
+    if "keyboard" in data:
+        return ReplyKeyboardMarkup.model_validate(data)
+    return ReplyKeyboardRemove.model_validate(data)
+
+
+class Notifier:
+    """
+    Рассылка служебных уведомлений нескольким получателям (например, заявки партнеров админам).
+    send() только сохраняет уведомление в БД и сразу возвращает управление, отправка идет
+    в фоне параллельно (не больше concurrency одновременно). Итог по каждому получателю
+    сохраняется; заблокировавшим бота больше не пишем, после рестарта недоставленное досылается.
+    """
+
+    def __init__(self, bot: Bot, concurrency: int = config.NOTIFY_CONCURRENCY):
+        self.bot = bot
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._tasks = set()
+
+    async def send(self, kind: str, ref, user_ids, text: str, reply_markup=None) -> int:
+        """
+        Ставит уведомление в отправку. kind и ref (например, 'partner_application' и ID партнера)
+        нужны, чтобы потом поправить все разосланные копии через edit().
+        """
+        notification_id = await db.create_notification(kind, str(ref), text, _dump_markup(reply_markup),
+                                                       list(user_ids))
+        self._spawn(self._run(notification_id))
+        return notification_id
+
+    def edit(self, kind: str, ref, suffix: str):
+        """Дописывает suffix ко всем доставленным копиям уведомлений (и убирает кнопки). Не ждет отправки."""
+        self._spawn(self._edit(kind, str(ref), suffix))
+
+    async def resume(self):
+        """Досылает уведомления, прерванные остановкой бота."""
+        for notification_id in await db.get_unfinished_notification_ids():
+            self._spawn(self._run(notification_id))
+
+    async def stop(self, timeout: float = 5):
+        """Дает начатым отправкам завершиться; недоставленное останется 'pending' до resume()."""
+        tasks = list(self._tasks)
+        if tasks:
+            await asyncio.wait(tasks, timeout=timeout)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, notification_id: int):
+        try:
+            info = await db.get_notification(notification_id)
+            if not info:
+                return
+            markup = _load_markup(info['markup'])
+            user_ids = await db.get_pending_notification_recipients(notification_id)
+            results = await asyncio.gather(*(self._deliver(user_id, info['text'], markup) for user_id in user_ids))
+            await db.mark_notification_deliveries(notification_id, results)
+        except Exception as e:
+            logging.error(f"Ошибка отправки уведомления #{notification_id}: {e}", exc_info=True)
+
+    async def _deliver(self, user_id: int, text: str, markup):
+        """Отправляет одно сообщение. Возвращает (user_id, status, message_id, error)."""
+        async with self._semaphore:
+            for _ in range(NOTIFY_RETRY_AFTER_ATTEMPTS):
+                try:
+                    message = await self.bot.send_message(user_id, text, reply_markup=markup)
+                    return user_id, 'sent', message.message_id, None
+                except TelegramRetryAfter as e:
+                    await asyncio.sleep(e.retry_after)
+                except TelegramForbiddenError as e:
+                    return user_id, 'blocked', None, str(e)[:200]
+                except Exception as e:
+                    return user_id, 'failed', None, str(e)[:200]
+            return user_id, 'failed', None, "RetryAfter"
+
+    async def _edit(self, kind: str, ref: str, suffix: str):
+        async def edit_one(user_id, message_id, text):
+            async with self._semaphore:
+                try:
+                    await self.bot.edit_message_text(text + suffix, chat_id=user_id, message_id=message_id)
+                except TelegramBadRequest:
+                    pass  # Сообщение слишком старое или уже исправлено
+                except Exception as e:
+                    logging.warning(f"Не удалось исправить уведомление у {user_id}: {e}")
+
+        try:
+            copies = await db.get_delivered_notification_copies(kind, ref)
+            await asyncio.gather(*(edit_one(*copy) for copy in copies))
+        except Exception as e:
+            logging.error(f"Ошибка правки уведомлений {kind}/{ref}: {e}", exc_info=True)
@@ -0,0 +1,164 @@
+# phone_index.py
+import asyncio
+import hashlib
+import logging
+import math
+import re
+import time
+
+import bitrix_api
+import config
+import database as db
+
+# Водяной знак синхронизации контактов в таблице sync_state
+SYNC_STATE_NAME = "contacts_date_modify"
+
+
+def normalize_phone(raw: str):
+    """Приводит номер РФ к виду 7XXXXXXXXXX. Возвращает None, если это не номер РФ."""
+    cleaned = re.sub(r'\D', '', raw or '')
+    if cleaned.startswith('8') and len(cleaned) == 11:
+        cleaned = '7' + cleaned[1:]
+    elif len(cleaned) == 10:
+        cleaned = '7' + cleaned
+    if len(cleaned) == 11 and cleaned.startswith('7'):
+        return cleaned
+    return None
+
+
+class BloomFilter:
+    """Компактное множество с ложноположительными ответами (но без ложноотрицательных)."""
+
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item: str):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, item: str):
+        for pos in self._positions(item):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, item: str) -> bool:
+        return all(self._bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+
+class PhoneIndex:
+    """
+    Локальный индекс телефонов контактов Битрикс для проверки дублей клиентов.
+    Таблица phone_index пополняется контактами, которые создает бот, и периодической
+    инкрементальной синхронизацией crm.contact.list. Фильтр Блума в памяти отвечает
+    «точно нет» без обращения к диску; в CRM уходят только вероятные совпадения.
+    Фильтр у каждого процесса свой, поэтому раз в refresh_interval он догружает из таблицы
+    телефоны, записанные другими репликами. Синхронизацию с CRM ведет одна реплика (sync=True).
+    """
+
+    def __init__(self, sync_interval: float = config.PHONE_SYNC_INTERVAL,
+                 capacity: int = config.PHONE_BLOOM_CAPACITY,
+                 refresh_interval: float = config.PHONE_REFRESH_INTERVAL):
+        self.sync_interval = sync_interval
+        self.refresh_interval = refresh_interval
+        self.capacity = capacity
+        self._bloom = BloomFilter(capacity)
+        self._last_rowid = 0  # Последняя загруженная в фильтр строка phone_index
+        self._ready = False  # Была хотя бы одна полная синхронизация
+        self._task = None
+        self.local_negatives = 0
+        self.remote_checks = 0
+
+    async def start(self, sync: bool = True):
+        count = await self.refresh()
+        logging.info(f"Индекс телефонов: загружено {count}, синхронизирован: {self._ready}")
+        self._task = asyncio.create_task(self._loop(sync))
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def remember(self, phone: str, contact_id: int = None):
+        """Добавляет телефон созданного ботом контакта."""
+        normalized = normalize_phone(phone)
+        if normalized:
+            await db.add_phones([(normalized, contact_id)])
+            self._bloom.add(normalized)
+
+    async def find_contact(self, phone: str):
+        """
+        Проверяет, есть ли в CRM контакт с таким телефоном (аналог check_contact_exists_by_phone).
+        Возвращает ID контакта или None.
+        """
+        normalized = normalize_phone(phone)
+        if self._ready and normalized:
+            if normalized not in self._bloom:
+                self.local_negatives += 1
+                return None
+            found, _ = await db.get_phone_contact(normalized)
+            if not found:
+                self.local_negatives += 1
+                return None
+        # Вероятное совпадение (или индекс еще не готов) — подтверждаем в CRM
+        self.remote_checks += 1
+        return await bitrix_api.check_contact_exists_by_phone(phone)
+
+    def stats(self) -> dict:
+        return {"ready": self._ready, "local_negatives": self.local_negatives, "remote_checks": self.remote_checks}
+
+    async def refresh(self) -> int:
+        """Догружает в фильтр строки phone_index, добавленные с прошлого раза. Возвращает их число."""
+        count = 0
+        async for rowid, phone in db.iter_indexed_phones(self._last_rowid):
+            self._bloom.add(phone)
+            self._last_rowid = rowid
+            count += 1
+        if not self._ready:
+            self._ready = await db.get_sync_state(SYNC_STATE_NAME) is not None
+        return count
+
+    async def sync(self):
+        """Забирает контакты, измененные с прошлой синхронизации, и пополняет индекс."""
+        since = await db.get_sync_state(SYNC_STATE_NAME)
+        start = 0
+        watermark = since
+        while True:
+            page = await bitrix_api.list_contacts_modified_since(since, start)
+            if page is None:
+                return  # Ошибка — продолжим со старого водяного знака в следующий раз
+            contacts, next_start = page
+
+            rows = []
+            for contact in contacts:
+                for item in contact.get('PHONE') or []:
+                    normalized = normalize_phone(item.get('VALUE'))
+                    if normalized:
+                        rows.append((normalized, int(contact['ID'])))
+                if contact.get('DATE_MODIFY') and (watermark is None or contact['DATE_MODIFY'] > watermark):
+                    watermark = contact['DATE_MODIFY']
+            await db.add_phones(rows)
+            for phone, _ in rows:
+                self._bloom.add(phone)
+
+            if next_start is None:
+                break
+            start = next_start
+
+        await db.set_sync_state(SYNC_STATE_NAME, watermark or "")
+        self._ready = True
+
+    async def _loop(self, sync: bool):
+        next_sync = 0.0
+        while True:
+            try:
+                if sync and time.monotonic() >= next_sync:
+                    next_sync = time.monotonic() + self.sync_interval
+                    await self.sync()
+                await self.refresh()
+            except Exception as e:
+                logging.error(f"Ошибка синхронизации индекса телефонов: {e}", exc_info=True)
+            await asyncio.sleep(self.refresh_interval)
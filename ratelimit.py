@@ -0,0 +1,88 @@
+# ratelimit.py
+import asyncio
+import heapq
+import itertools
+import time
+
+
+class TokenBucket:
+    """
+    Ограничитель частоты «ведро с токенами»: в среднем rate операций в секунду,
+    кратковременно — до capacity подряд. Ожидающие обслуживаются по очереди.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        """Останавливает выдачу токенов (например, после ответа 429 с retry_after)."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class PriorityBucket(TokenBucket):
+    """
+    То же ведро, но ожидающие обслуживаются по приоритету (меньше — раньше),
+    а при равном приоритете — в порядке прихода. Ведет статистику ожидания.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        super().__init__(rate, capacity)
+        self._waiters = []  # куча (приоритет, номер, future)
+        self._seq = itertools.count()
+        self._drainer = None
+        self.granted = 0
+        self.last_wait = 0.0
+        self.max_wait = 0.0
+
+    def __len__(self):
+        return sum(1 for *_, future in self._waiters if not future.done())
+
+    async def acquire(self, priority: int = 0) -> float:
+        """Ждет своей очереди и токена. Возвращает время ожидания в секундах."""
+        started = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        if self._drainer is None or self._drainer.done():
+            self._drainer = asyncio.create_task(self._drain())
+        await future
+
+        waited = time.monotonic() - started
+        self.granted += 1
+        self.last_wait = waited
+        self.max_wait = max(self.max_wait, waited)
+        return waited
+
+    async def _drain(self):
+        while self._waiters:
+            await TokenBucket.acquire(self)
+            while self._waiters:
+                *_, future = heapq.heappop(self._waiters)
+                if not future.done():  # Ожидающий мог быть отменен
+                    future.set_result(None)
+                    break
+            else:
+                # Токен никому не достался — возвращаем его
+                self._tokens = min(self.capacity, self._tokens + 1)
+
+    def stats(self) -> dict:
+        return {"depth": len(self), "granted": self.granted,
+                "last_wait": self.last_wait, "max_wait": self.max_wait}
@@ -0,0 +1,83 @@
+# templates.py
+"""
+Шаблоны сообщений бота.
+Шаблон пишется как обычная строка с полями {name} / {name:спецификация}. Разбор и проверка
+полей выполняются один раз при создании, render() — это один вызов str.format_map.
+Строковые значения экранируются для HTML (escape), остальные подставляются как есть,
+поэтому поля со спецификацией (например {payout:,.0f}) форматируются как числа.
+"""
+from html import escape
+from string import Formatter
+
+
+class _Escaped(dict):
+    """Значения для format_map: строки отдаются экранированными."""
+    __slots__ = ()
+
+    def __getitem__(self, name):
+        value = dict.__getitem__(self, name)
+        return escape(value) if isinstance(value, str) else value
+
+
+class Template:
+    __slots__ = ("source", "fields")
+
+    def __init__(self, source: str):
+        self.source = source
+        fields = []
+        for _, name, _, conversion in Formatter().parse(source):
+            if name is None:
+                continue
+            if not name.isidentifier() or conversion:
+                raise ValueError(f"Поле шаблона должно быть простым именем: {{{name}}}")
+            if name not in fields:
+                fields.append(name)
+        self.fields = tuple(fields)
+
+    def render(self, **values) -> str:
+        # Недостающее поле — KeyError из format_map; число полей сверяем, чтобы не терять лишние
+        if len(values) != len(self.fields):
+            raise TypeError(f"Шаблон ожидает поля {self.fields}, переданы {tuple(values)}")
+        return self.source.format_map(_Escaped(values))
+
+    def __repr__(self):
+        return f"Template({self.source!r})"
+
+
+# --- Регистрация партнера ---
+
+PARTNER_APPLICATION = Template(
+    "🔔 <b>Новая заявка на партнерство!</b>\n"
+    "<b>ФИО:</b> {full_name}\n"
+    "<b>Роль:</b> {role}\n"
+    "<b>Телефон:</b> {phone}\n"
+)
+
+# --- Отправка клиента ---
+
+CLIENT_CONFIRMATION = Template(
+    "<b>Проверьте данные:</b>\n\n"
+    "👤 <b>Имя:</b> {name}\n"
+    "📞 <b>Тел:</b> {phone}\n"
+    "🏠 <b>Адрес:</b> {address}\n"
+    "📐 <b>Площадь:</b> {area}\n"
+    "💬 <b>Коммент:</b> {comment}\n\n"
+    "Все верно?"
+)
+CLIENT_ACCEPTED = Template("⏳ Клиент '{name}' принят, передаем менеджеру...")
+CLIENT_SENT = Template("✅ Клиент '{name}' отправлен!")
+CLIENT_SEND_FAILED = Template("Ошибка при отправке клиента '{name}'. Попробуйте еще раз.")
+
+# --- Статистика и списки ---
+
+STATS_LINE = Template("• {name}: <b>{payout:,.0f} ₽</b> {icon}\n")
+CLIENTS_PAGE_HEADER = Template("<b>Ваши клиенты ({first}-{last} из {total}):</b>\n\n")
+CLIENTS_PAGE_LINE = Template("{number}. <b>{name}</b>{address}\n   Статус: <i>{status}</i>\n")
+# Служебные статусы клиента — понятным текстом (остальные статусы — названия стадий Битрикс)
+CLIENT_STATUS_LABELS = {"pending": "передается менеджеру"}
+
+# --- Уведомления о стадии сделки клиента ---
+
+DEAL_WIN = Template("✅ С клиентом <b>{name}</b> заключен договор! Ваша выплата: {payout:,.0f} руб.")
+DEAL_LOSE = Template("❌ Клиент <b>{name}</b> отказ. Выплата отменена.")
+DEAL_MEETING = Template("ℹ️ Встреча с клиентом <b>{name}</b> назначена.")
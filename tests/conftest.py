@@ -0,0 +1,37 @@
+# tests/conftest.py
+import asyncio
+import os
+import sys
+
+import pytest
+
+# config.py требует переменные окружения бота — для тестов хватает заглушек
+for name, value in {
+    "BOT_TOKEN": "1:test", "BITRIX_PARTNER_WEBHOOK": "http://bitrix.test/partner/",
+    "BITRIX_CLIENT_WEBHOOK": "http://bitrix.test/client/", "PARTNER_DEAL_FIELD": "UF_PARTNER",
+    "BITRIX_INCOMING_SECRET": "secret", "PARTNER_FUNNEL_ID": "1", "BITRIX_PARTNER_VERIFIED_STAGE_ID": "VERIFIED",
+    "BITRIX_CLIENT_FUNNEL_ID": "2", "BITRIX_CLIENT_STAGE_WIN": "WON", "BITRIX_CLIENT_STAGE_LOSE": "LOSE",
+    "BASE_WEBHOOK_URL": "http://bot.test", "SUPER_ADMIN_ID": "1",
+}.items():
+    os.environ.setdefault(name, value)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database as db  # noqa: E402
+
+
+@pytest.fixture
+def run(tmp_path, monkeypatch):
+    """Выполняет корутину на чистой базе во временном каталоге."""
+    monkeypatch.setattr(db, "engine", db.Database(str(tmp_path / "test.db")))
+
+    def runner(coro_fn):
+        async def main():
+            await db.init_db()
+            try:
+                return await coro_fn()
+            finally:
+                await db.close_db()
+        return asyncio.run(main())
+
+    return runner
@@ -0,0 +1,83 @@
+# tests/test_bitrix_batch.py
+import asyncio
+from urllib.parse import unquote
+
+import bitrix_api
+
+
+class FakeBitrix:
+    """Заглушка метода batch: выполняет команды по порядку, как Битрикс, с учетом halt."""
+
+    def __init__(self, failing=()):
+        self.failing = set(failing)  # Методы, которые возвращают ошибку
+        self.requests = []
+        self.executed = []  # Выполненные (успешно или с ошибкой) методы
+
+    async def call(self, webhook, method, params=None, priority=bitrix_api.PRIORITY_INTERACTIVE):
+        assert method == "batch"
+        self.requests.append(params)
+        results, errors = {}, {}
+        for key, command in params['cmd'].items():
+            name = command.split('?', 1)[0]
+            self.executed.append(name)
+            if name in self.failing:
+                errors[key] = {'error': 'ERROR_CORE', 'error_description': f"{name} failed"}
+                if params['halt']:
+                    break
+            else:
+                results[key] = len(self.requests) * 100 + len(results) + 1
+        return {'result': {'result': results, 'result_error': errors}}
+
+
+def run_batches(fake, monkeypatch, *groups):
+    monkeypatch.setattr(bitrix_api.client, "call", fake.call)
+    monkeypatch.setattr(bitrix_api.client, "_collectors", {})
+
+    async def main():
+        return await asyncio.gather(*(bitrix_api.client.batch("http://bitrix.test/", group) for group in groups))
+
+    return asyncio.run(main())
+
+
+def test_dependent_group_stops_after_failed_first_command(monkeypatch):
+    fake = FakeBitrix(failing={"crm.contact.add"})
+    result, = run_batches(fake, monkeypatch, {
+        'contact': ('crm.contact.add', {'fields': {'NAME': 'Иван'}}),
+        'deal': ('crm.deal.add', {'fields': {'CONTACT_ID': '$result[contact]'}}),
+    })
+    assert fake.requests[0]['halt'] == 1
+    assert result['contact']['error'] == 'ERROR_CORE'
+    assert result['deal'] == {'error': 'BATCH_NO_RESULT'}
+
+
+def test_dependent_groups_are_not_coalesced(monkeypatch):
+    fake = FakeBitrix()
+    group = {
+        'contact': ('crm.contact.add', {'fields': {'NAME': 'Иван'}}),
+        'deal': ('crm.deal.add', {'fields': {'CONTACT_ID': '$result[contact]'}}),
+    }
+    first, second = run_batches(fake, monkeypatch, group, group)
+    assert len(fake.requests) == 2
+    assert all(len(request['cmd']) == 2 for request in fake.requests)
+    assert 'result' in first['deal'] and 'result' in second['deal']
+    assert '$result[contact]' in unquote(fake.requests[0]['cmd']['deal'])
+
+
+def test_independent_calls_share_one_batch(monkeypatch):
+    fake = FakeBitrix(failing={"crm.deal.get"})
+    ok, failed = run_batches(fake, monkeypatch,
+                             {'cmd': ('crm.contact.list', {'filter': {'PHONE': '7900'}})},
+                             {'cmd': ('crm.deal.get', {'id': 1})})
+    assert len(fake.requests) == 1
+    assert fake.requests[0]['halt'] == 0
+    assert 'result' in ok['cmd']
+    assert failed['cmd']['error'] == 'ERROR_CORE'
+
+
+def test_create_client_deal_reports_failed_contact(monkeypatch):
+    fake = FakeBitrix(failing={"crm.contact.add"})
+    monkeypatch.setattr(bitrix_api.client, "call", fake.call)
+    monkeypatch.setattr(bitrix_api.client, "_collectors", {})
+    deal_id = asyncio.run(bitrix_api.create_client_deal("Иван", "79000000000", "ул. Ленина", "Партнер"))
+    assert deal_id is None
+    assert fake.executed == ["crm.contact.add"]
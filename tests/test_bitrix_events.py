@@ -0,0 +1,20 @@
+# tests/test_bitrix_events.py
+import pytest
+
+import bot
+import database as db
+
+
+def test_partner_verification_error_reaches_inbox(run, monkeypatch):
+    """Ошибка обработки вебхука не должна глотаться — иначе журнал пометит событие обработанным."""
+    async def broken(*args):
+        raise RuntimeError("db is down")
+
+    monkeypatch.setattr(db, "set_partner_status", broken)
+
+    async def main():
+        await db.add_partner_with_job(5, "Иван", "79000000000", "Риэлтор", "create_partner_deal", {"user_id": 5})
+        await bot.process_bitrix_event({"event_type": "partner_verification", "user_id": "5", "status": "verified"})
+
+    with pytest.raises(RuntimeError, match="db is down"):
+        run(main)
@@ -0,0 +1,14 @@
+# tests/test_bot.py
+import bot
+import database as db
+
+
+def test_clients_page_shows_pending_status_as_text(run):
+    async def main():
+        await db.add_client_with_job(10, "Иван", "ул. Ленина", "create_client_deal", {})
+        text, _ = await bot.render_clients_page(10)
+        return text
+
+    text = run(main)
+    assert "передается менеджеру" in text
+    assert "pending" not in text
@@ -0,0 +1,13 @@
+# tests/test_database.py
+import database as db
+
+
+def test_start_clears_block_mark_only_when_present(run):
+    async def main():
+        first = await db.mark_chat_reachable(7)
+        await db.mark_chat_unreachable(7, "Forbidden: bot was blocked by the user")
+        blocked = await db.is_chat_reachable(7)
+        second = await db.mark_chat_reachable(7)
+        return first, blocked, second, await db.is_chat_reachable(7)
+
+    assert run(main) == (False, False, True, True)
@@ -0,0 +1,35 @@
+# tests/test_import_export.py
+import io
+
+import pytest
+
+import database as db
+import import_export
+
+
+def test_row_without_user_id_is_rejected():
+    with pytest.raises(ValueError, match="user_id"):
+        import_export._to_row({"full_name": "Иван"}, "partners")
+
+
+def test_non_numeric_id_is_rejected():
+    with pytest.raises(ValueError, match="partner_user_id"):
+        import_export._to_row({"partner_user_id": "abc", "client_name": "Иван"}, "clients")
+
+
+def test_csv_records_carry_line_numbers():
+    stream = io.StringIO("user_id,full_name\n1,Иван\n2,Петр\n")
+    assert [line for line, _ in import_export._read_records(stream, "csv")] == [2, 3]
+
+
+def test_import_skips_bad_lines(run, tmp_path):
+    path = tmp_path / "partners.csv"
+    path.write_text("user_id,full_name,phone_number\n1,Иван,7900\n,Без ID,7901\nx,Петр,7902\n", encoding="utf-8")
+
+    async def main():
+        skipped = await import_export.import_table("partners", str(path), "csv", 100, False, 1)
+        return skipped, [row async for row in db.iter_partners()]
+
+    skipped, rows = run(main)
+    assert skipped == 2
+    assert [row[0] for row in rows] == [1]
@@ -0,0 +1,132 @@
+# tests/test_inbox.py
+import time
+
+import database as db
+from inbox import WebhookInbox
+
+
+def make_inbox(handled, fail=0, **kwargs):
+    """Журнал, обработчик которого запоминает payload и первые fail раз падает."""
+    failures = [fail]
+
+    async def handler(payload):
+        if failures[0]:
+            failures[0] -= 1
+            raise RuntimeError("boom")
+        handled.append(payload)
+
+    params = dict(window=0, max_delay=0, base_delay=0, max_retry_delay=0)
+    params.update(kwargs)
+    return WebhookInbox(handler, **params)
+
+
+def test_same_event_twice_is_duplicate(run):
+    async def main():
+        inbox = make_inbox([])
+        return [await inbox.append("deal:1", {"STAGE_ID": "A"}) for _ in range(2)]
+
+    assert run(main) == [True, False]
+
+
+def test_return_to_previous_stage_is_not_duplicate(run):
+    async def main():
+        inbox = make_inbox([])
+        return [await inbox.append("deal:1", {"STAGE_ID": stage}) for stage in "ABA"]
+
+    assert run(main) == [True, True, True]
+
+
+def test_dedup_by_delivery_id(run):
+    async def main():
+        inbox = make_inbox([])
+        return [await inbox.append("deal:1", {"STAGE_ID": "A", "event_id": event_id}) for event_id in (1, 1, 2)]
+
+    assert run(main) == [True, False, True]
+
+
+def test_series_is_coalesced_after_quiet_window(run):
+    async def main():
+        handled = []
+        inbox = make_inbox(handled, window=60, max_delay=600)
+        for stage in "ABC":
+            await inbox.append("deal:1", {"STAGE_ID": stage})
+        await inbox.append("deal:2", {"STAGE_ID": "X"})
+        processed_early = await inbox._poll()
+        await inbox.flush()
+        return processed_early, handled
+
+    processed_early, handled = run(main)
+    assert processed_early == 0
+    assert sorted(payload["STAGE_ID"] for payload in handled) == ["C", "X"]
+
+
+def test_claim_is_exclusive(run):
+    async def main():
+        await db.append_webhook_event("deal:1", "a", {"STAGE_ID": "A"}, 300)
+        (_, last_event_id, *_), = await db.get_pending_webhook_keys()
+        return (await db.claim_webhook_events("deal:1", last_event_id),
+                await db.claim_webhook_events("deal:1", last_event_id))
+
+    first, second = run(main)
+    assert first == ({"STAGE_ID": "A"}, 0)
+    assert second is None
+
+
+def test_failed_event_is_retried_then_marked_failed(run):
+    async def main():
+        handled = []
+        inbox = make_inbox(handled, fail=1, max_attempts=2)
+        await inbox.append("deal:1", {"STAGE_ID": "A"})
+        await inbox.flush()
+        retried = (handled[:], await db.count_webhook_events())
+
+        broken = make_inbox([], fail=5, max_attempts=2)
+        await broken.append("deal:2", {"STAGE_ID": "B"})
+        await broken.flush()
+        await broken.flush()
+        return retried, await db.count_webhook_events()
+
+    (handled, after_retry), final = run(main)
+    assert handled == [{"STAGE_ID": "A"}]
+    assert after_retry == {"done": 1}
+    assert final == {"done": 1, "failed": 1}
+
+
+def test_replay_takes_latest_event_per_key(run):
+    async def main():
+        handled = []
+        inbox = make_inbox(handled)
+        since = time.time() - 1
+        for stage in "AB":
+            await inbox.append("deal:1", {"STAGE_ID": stage})
+        await inbox.flush()
+        handled.clear()
+        count = await inbox.replay(since, time.time() + 1)
+        await inbox.flush()
+        return count, handled
+
+    count, handled = run(main)
+    assert count == 1
+    assert handled == [{"STAGE_ID": "B"}]
+
+
+def test_prune_keeps_recent_and_pending_events(run):
+    async def main():
+        inbox = make_inbox([], retention_days=1)
+        await inbox.append("deal:1", {"STAGE_ID": "A"})
+        await inbox.flush()
+        await inbox.append("deal:2", {"STAGE_ID": "B"})
+        async with db.engine.write() as conn:
+            await conn.execute("UPDATE webhook_inbox SET received_at = received_at - 2 * 86400")
+        await inbox.append("deal:3", {"STAGE_ID": "C"})
+        await inbox.flush()
+        await db.append_webhook_event("deal:4", "d", {"STAGE_ID": "D"}, 300)
+        async with db.engine.write() as conn:
+            await conn.execute("UPDATE webhook_inbox SET received_at = received_at - 2 * 86400 WHERE key = 'deal:4'")
+        await inbox._prune()
+        async with db.engine.read() as conn:
+            async with conn.execute("SELECT key, status FROM webhook_inbox ORDER BY key") as cursor:
+                return await cursor.fetchall()
+
+    # Старые обработанные события удалены, свежее и необработанное остаются
+    assert run(main) == [("deal:3", "done"), ("deal:4", "pending")]
@@ -0,0 +1,117 @@
+# update_queue.py
+import asyncio
+import logging
+import time
+from collections import deque
+
+import metrics
+
+# Типы апдейтов Telegram, из которых берем чат для сохранения порядка
+_CHAT_UPDATE_TYPES = (
+    "message", "edited_message", "callback_query", "channel_post", "edited_channel_post",
+    "my_chat_member", "chat_member", "chat_join_request", "inline_query", "pre_checkout_query",
+    "shipping_query", "chosen_inline_result", "poll_answer",
+)
+
+
+def update_chat_key(update: dict):
+    """Ключ очереди для апдейта: ID чата (или пользователя), иначе update_id."""
+    for update_type in _CHAT_UPDATE_TYPES:
+        payload = update.get(update_type)
+        if not isinstance(payload, dict):
+            continue
+        chat = payload.get("chat") or (payload.get("message") or {}).get("chat")
+        if chat and "id" in chat:
+            return chat["id"]
+        user = payload.get("from") or payload.get("user")
+        if user and "id" in user:
+            return user["id"]
+    return ("update", update.get("update_id"))
+
+
+class UpdateQueue:
+    """
+    Очередь входящих апдейтов Telegram с пулом воркеров.
+    Апдейты одного чата обрабатываются строго по очереди, разных чатов — параллельно.
+    Размер очереди ограничен: при переполнении put() возвращает False.
+    """
+
+    def __init__(self, handler, workers: int, max_size: int):
+        self._handler = handler  # async (update: dict) -> None
+        self.workers = workers
+        self.max_size = max_size
+        self._chats = {}  # ключ чата -> deque[(время постановки, апдейт)]
+        self._ready = asyncio.Queue()  # ключи чатов, у которых есть необработанные апдейты
+        self._size = 0
+        self._tasks = []
+        self.processed = 0
+        self.rejected = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+    def __len__(self):
+        return self._size
+
+    def put(self, update: dict) -> bool:
+        if self._size >= self.max_size:
+            self.rejected += 1
+            return False
+        key = update_chat_key(update)
+        pending = self._chats.get(key)
+        if pending is None:
+            pending = self._chats[key] = deque()
+            self._ready.put_nowait(key)
+        pending.append((time.monotonic(), update))
+        self._size += 1
+        return True
+
+    def oldest_age(self) -> float:
+        """Сколько ждет самый старый необработанный апдейт (0, если очередь пуста)."""
+        oldest = min((pending[0][0] for pending in self._chats.values() if pending), default=None)
+        return time.monotonic() - oldest if oldest is not None else 0.0
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float = 10):
+        """Дает дообработать очередь (не дольше timeout секунд) и останавливает воркеры."""
+        deadline = time.monotonic() + timeout
+        while self._size and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def stats(self) -> dict:
+        return {
+            "depth": self._size,
+            "chats": len(self._chats),
+            "processed": self.processed,
+            "rejected": self.rejected,
+            "last_lag": self.last_lag,
+            "max_lag": self.max_lag,
+        }
+
+    async def _worker(self):
+        while True:
+            key = await self._ready.get()
+            pending = self._chats[key]
+            enqueued_at, update = pending.popleft()
+            self._size -= 1
+
+            lag = time.monotonic() - enqueued_at
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+            metrics.UPDATE_LAG_SECONDS.observe(lag)
+            try:
+                await self._handler(update)
+            except Exception as e:
+                logging.error(f"Ошибка обработки апдейта {update.get('update_id')}: {e}", exc_info=True)
+            finally:
+                self.processed += 1
+                # Чат снова в очереди, только если у него остались апдейты
+                if pending:
+                    self._ready.put_nowait(key)
+                else:
+                    del self._chats[key]